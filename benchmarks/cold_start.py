@@ -0,0 +1,275 @@
+import argparse
+import base64
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+from run_benchmarks import BUCKET_NAME, CONFIG, REPO_ROOT
+
+"""
+Measures how long each service takes to start: importing its module, create_app() and
+serving its first request. Every service is started in a fresh interpreter with
+python -X importtime, so the slowest imports are reported along with the totals.
+
+The prediction service is also started as a pre-fork server (python -m
+services.prediction.prediction --workers 2, or workers = 2 in config.ini), which
+downloads, loads and warms the model before it serves anything. The model is a small one in a moto S3 bucket.
+
+    python benchmarks/cold_start.py
+    python benchmarks/cold_start.py --check     fails if a service is over its budget
+"""
+
+SERVICES = {
+    "frontend": "services.frontend.frontend",
+    "scraper": "services.scraper.scraper",
+    "prediction": "services.prediction.prediction",
+    "twitter": "services.twitter.twitter",
+}
+BUDGETS = {  # seconds from starting the interpreter to the first response
+    "frontend": 1.0,
+    "scraper": 1.0,
+    "prediction": 1.0,
+    "twitter": 1.0,
+    "prediction_pre_fork": 2.0,
+}
+SLOWEST_IMPORTS = 10
+PRE_FORK_WORKERS = 2
+PRE_FORK_TIMEOUT = 60  # seconds to wait for the pre-fork server's first response
+
+# Run in the fresh interpreter. Timings leave out the start of the interpreter itself
+STARTUP = """
+import base64, json, sys, time
+sys.path.insert(0, {repo_root!r})
+start = time.perf_counter()
+import {module} as service
+imported = time.perf_counter()
+app = service.create_app()
+created = time.perf_counter()
+credentials = base64.b64encode(b"admin:benchmark").decode()
+with app.test_client() as client:
+    response = client.get("/metrics", headers={{"Authorization": "Basic " + credentials}})
+served = time.perf_counter()
+print(json.dumps({{
+    "import_seconds": round(imported - start, 4),
+    "create_app_seconds": round(created - imported, 4),
+    "first_request_seconds": round(served - created, 4),
+    "status_code": response.status_code,
+    "modules": sorted(sys.modules),
+}}))
+"""
+
+# Run in the fresh interpreter, which serves until it is sent SIGTERM
+PRE_FORK_STARTUP = """
+import configparser, json, sys, time
+sys.path[:0] = [{repo_root!r}, {benchmarks!r}]
+from moto import mock_aws
+from run_benchmarks import upload_benchmark_model
+mock_aws().start()  # the forked workers inherit the mocked bucket
+config = configparser.ConfigParser()
+config.read("config.ini")
+upload_benchmark_model(config)
+started = time.time()
+start = time.perf_counter()
+import services.prediction.prediction as service
+print(json.dumps({{
+    "started": started,
+    "import_seconds": round(time.perf_counter() - start, 4),
+}}), flush=True)
+service.serve("127.0.0.1", {port}, {workers})
+"""
+
+
+def parse_importtime(output: str, module: str) -> list:
+    """Finds the slowest imports of a module in the output of python -X importtime.
+    Only the modules it imports itself are counted, since theirs include the time of
+    everything they import in turn.
+
+    Returns:
+        list: (module, cumulative microseconds) of the slowest imports, slowest first
+    """
+    imports = []
+    children = []  # python -X importtime lists the imports of a module before it
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        if not cumulative.strip().isdigit():
+            continue  # the header
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 1:
+            children.append((name.strip(), int(cumulative)))
+        elif depth == 0:
+            if name.strip() == module:
+                imports = children
+            children = []
+    imports.sort(key=lambda item: item[1], reverse=True)
+    return imports[:SLOWEST_IMPORTS]
+
+
+def measure(name: str, workdir: str) -> dict:
+    """Starts a service in a fresh interpreter and serves its first request.
+
+    Returns:
+        dict: the seconds each startup phase took, the total and the slowest imports
+    """
+    script = STARTUP.format(repo_root=REPO_ROOT, module=SERVICES[name])
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", script],
+        cwd=workdir,  # the services read config.ini from the working directory
+        capture_output=True,
+        text=True,
+    )
+    if output.returncode != 0:
+        raise RuntimeError(f"{name} failed to start:\n{output.stderr}")
+    result = json.loads(output.stdout.strip().splitlines()[-1])
+    modules = set(result.pop("modules"))
+    result["total_seconds"] = round(
+        result["import_seconds"]
+        + result["create_app_seconds"]
+        + result["first_request_seconds"],
+        4,
+    )
+    result["slowest_imports"] = [
+        {"module": module, "seconds": round(microseconds / 1e6, 4)}
+        for module, microseconds in parse_importtime(output.stderr, SERVICES[name])
+    ]
+    result["heavy_modules_loaded"] = sorted(
+        module
+        for module in ["boto3", "bs4", "numpy", "pandas", "sklearn", "tweepy"]
+        if module in modules
+    )
+    return result
+
+
+def measure_pre_fork(workdir: str) -> dict:
+    """Starts the prediction service as a pre-fork server in a fresh interpreter and
+    waits for its first response.
+
+    Returns:
+        dict: the seconds importing the module took, from then until the first
+            response, and the total
+    """
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    script = PRE_FORK_STARTUP.format(
+        repo_root=REPO_ROOT,
+        benchmarks=os.path.dirname(os.path.abspath(__file__)),
+        port=port,
+        workers=PRE_FORK_WORKERS,
+    )
+    server = subprocess.Popen(
+        [sys.executable, "-c", script],
+        cwd=workdir,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    credentials = base64.b64encode(b"admin:benchmark").decode()
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{port}/metrics",
+        headers={"Authorization": "Basic " + credentials},
+    )
+    deadline = time.monotonic() + PRE_FORK_TIMEOUT
+    served = status_code = None
+    try:
+        while served is None and server.poll() is None:
+            if time.monotonic() > deadline:
+                break
+            try:
+                with urllib.request.urlopen(request, timeout=1) as response:
+                    status_code = response.status
+                served = time.time()
+            except (urllib.error.URLError, ConnectionError, TimeoutError):
+                time.sleep(0.01)
+    finally:
+        server.terminate()
+        output, errors = server.communicate(timeout=30)
+    if served is None:
+        raise RuntimeError(f"The pre-fork prediction server did not serve:\n{errors}")
+    result = json.loads(output.strip().splitlines()[0])
+    total = served - result.pop("started")
+    return {
+        "import_seconds": result["import_seconds"],
+        "serve_seconds": round(total - result["import_seconds"], 4),
+        "status_code": status_code,
+        "total_seconds": round(total, 4),
+        "workers": PRE_FORK_WORKERS,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures the services' cold starts")
+    parser.add_argument("--services", nargs="+", choices=SERVICES, default=SERVICES)
+    parser.add_argument(
+        "--skip-pre-fork",
+        action="store_true",
+        help="do not start the prediction service as a pre-fork server",
+    )
+    parser.add_argument(
+        "--check", action="store_true", help="fail if a service is over its budget"
+    )
+    parser.add_argument("--output", help="write the JSON report here")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="pdga-cold-start-")
+    os.environ.pop("PDGA_CONFIG", None)  # the services read the config.ini written here
+    try:
+        with open(os.path.join(workdir, "config.ini"), "w") as file:
+            file.write(
+                CONFIG.format(
+                    mongo_uri="mongodb://localhost:27017/?serverSelectionTimeoutMS=500",
+                    bucket_name=BUCKET_NAME,
+                    pdga_url="http://127.0.0.1:1",
+                    storage="mongodb",
+                )
+            )
+
+        report = {}
+        over_budget = []
+        for name in args.services:
+            report[name] = measure(name, workdir)
+            print(
+                f"{name}: {report[name]['total_seconds']}s "
+                f"(import {report[name]['import_seconds']}s, "
+                f"create_app {report[name]['create_app_seconds']}s, "
+                f"first request {report[name]['first_request_seconds']}s)",
+                file=sys.stderr,
+            )
+        if "prediction" in args.services and not args.skip_pre_fork:
+            report["prediction_pre_fork"] = measure_pre_fork(workdir)
+            print(
+                f"prediction_pre_fork: "
+                f"{report['prediction_pre_fork']['total_seconds']}s "
+                f"(import {report['prediction_pre_fork']['import_seconds']}s, "
+                f"model and workers until the first response "
+                f"{report['prediction_pre_fork']['serve_seconds']}s)",
+                file=sys.stderr,
+            )
+        for name, result in report.items():
+            if result["total_seconds"] > BUDGETS[name]:
+                over_budget.append(
+                    f"{name} took {result['total_seconds']}s, "
+                    f"over its budget of {BUDGETS[name]}s"
+                )
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.check:
+        for message in over_budget:
+            print(f"Over budget: {message}", file=sys.stderr)
+        if over_budget:
+            sys.exit(1)
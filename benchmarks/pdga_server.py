@@ -0,0 +1,182 @@
+import argparse
+import random
+import threading
+import time
+
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+"""
+Stand-in for the PDGA website which serves the approved disc list and a page for every
+disc on it, with the markup the scraper parses. Pages are synthetic and the same for a
+given seed, or a recorded disc page served for every disc.
+
+    python benchmarks/pdga_server.py --discs 1000 --latency 0.05 --port 8080
+"""
+
+DISC_LIST_PATH = "/technical-standards/equipment-certification/discs"
+MANUFACTURERS = [
+    "Innova Champion Discs",
+    "Discraft",
+    "Dynamic Discs",
+    "Latitude 64",
+    "MVP Disc Sports",
+    "Kastaplast",
+    "Prodigy Disc",
+    "Westside Discs",
+]
+FIRST_APPROVAL = date(2010, 1, 1)
+
+DISC_PAGE = """<html><body>
+<div class="views-field-field-equipment-manuf-ref"><span>{manufacturer}</span></div>
+<span class="date-display-single">{approved_date}</span>
+<div class="views-field-field-disc-max-weight"><span class="field-content">{max_weight:.1f}gr</span></div>
+<div class="views-field-field-disc-outside-diameter"><span class="field-content">{diameter:.1f}cm</span></div>
+<div class="views-field-field-disc-height"><span class="field-content">{height:.1f}cm</span></div>
+<div class="views-field-field-disc-rim-depth"><span class="field-content">{rim_depth:.1f}cm</span></div>
+<div class="views-field-field-disc-rim-thickness"><span class="field-content">{rim_thickness:.1f}cm</span></div>
+<div class="views-field-field-disc-inside-rim-diameter"><span class="field-content">{inside_rim_diameter:.1f}cm</span></div>
+<div class="views-field-field-disc-depth-diameter-ratio"><span class="field-content">{ratio:.1f}%</span></div>
+<div class="views-field-field-disc-rim-config"><span class="field-content">{rim_config:.2f}</span></div>
+<div class="views-field-field-disc-flexibility"><span class="field-content">{flexibility:.2f}kg</span></div>
+</body></html>"""
+
+
+def disc_slug(index: int) -> str:
+    """Returns the URL slug of a synthetic disc e.g., bench-disc-42."""
+    return f"bench-disc-{index}"
+
+
+def render_disc_page(index: int, seed: int = 0) -> bytes:
+    """Renders the page of a synthetic disc. Measurements are drawn from the ranges of
+    real discs, the same for a given index and seed.
+
+    Args:
+        index (int): number of the disc
+        seed (int, optional): seed of the measurements. Defaults to 0.
+
+    Returns:
+        bytes: HTML of the disc's page
+    """
+    rng = random.Random(seed * 1_000_003 + index)
+    diameter = rng.uniform(20.0, 22.5)
+    rim_thickness = rng.uniform(0.8, 2.6)
+    rim_depth = rng.uniform(1.0, 1.8)
+    return DISC_PAGE.format(
+        manufacturer=rng.choice(MANUFACTURERS),
+        approved_date=(FIRST_APPROVAL + timedelta(days=index % 5000)).strftime(
+            "%b %d, %Y"
+        ),
+        max_weight=rng.uniform(165.0, 180.0),
+        diameter=diameter,
+        height=rng.uniform(1.4, 2.4),
+        rim_depth=rim_depth,
+        rim_thickness=rim_thickness,
+        inside_rim_diameter=diameter - 2 * rim_thickness,
+        ratio=rim_depth / diameter * 100,
+        rim_config=rng.uniform(20.0, 60.0),
+        flexibility=rng.uniform(5.0, 15.0),
+    ).encode("utf-8")
+
+
+def render_disc_list(discs: int) -> bytes:
+    """Renders the approved disc list linking to every disc, plus the kind of paging
+    link the scraper skips."""
+    links = "\n".join(
+        f'<a href="{DISC_LIST_PATH}/{disc_slug(index)}">Disc {index}</a>'
+        for index in range(discs)
+    )
+    return (
+        f'<html><body>{links}\n<a href="{DISC_LIST_PATH}?page=1">next</a></body></html>'
+    ).encode("utf-8")
+
+
+class PDGAServer(ThreadingHTTPServer):
+    """Serves the stand-in site, waiting latency seconds before every response.
+    Requests are counted so the benchmark can check what the scraper fetched."""
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address: tuple,
+        discs: int,
+        latency: float = 0,
+        seed: int = 0,
+        recorded_page: bytes = None,
+    ):
+        super().__init__(address, PDGARequestHandler)
+        self.discs = discs
+        self.latency = latency
+        self.seed = seed
+        self.recorded_page = recorded_page
+        self.disc_list = render_disc_list(discs)
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> threading.Thread:
+        """Serves in a background thread.
+
+        Returns:
+            threading.Thread: the serving thread
+        """
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+class PDGARequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        if server.latency:
+            time.sleep(server.latency)
+
+        prefix = DISC_LIST_PATH + "/bench-disc-"
+        if self.path == DISC_LIST_PATH:
+            body = server.disc_list
+        elif self.path.startswith(prefix) and self.path[len(prefix) :].isdigit():
+            index = int(self.path[len(prefix) :])
+            if index >= server.discs:
+                return self.send_error(404)
+            body = server.recorded_page or render_disc_page(index, server.seed)
+        else:
+            return self.send_error(404)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves a stand-in PDGA website")
+    parser.add_argument("--discs", type=int, default=100)
+    parser.add_argument(
+        "--latency", type=float, default=0, help="seconds to wait before responding"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--recorded", help="recorded disc page to serve for every disc")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+
+    recorded_page = None
+    if args.recorded:
+        with open(args.recorded, "rb") as file:
+            recorded_page = file.read()
+    server = PDGAServer(
+        (args.host, args.port), args.discs, args.latency, args.seed, recorded_page
+    )
+    print(f"Serving {args.discs} discs at {server.url}{DISC_LIST_PATH}")
+    server.serve_forever()
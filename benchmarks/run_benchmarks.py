@@ -0,0 +1,449 @@
+import argparse
+import io
+import json
+import os
+import platform
+import pymongo
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+from datetime import datetime, timezone
+from unittest.mock import patch
+
+"""
+End-to-end benchmark of the pipeline, run entirely offline: scrape_and_store against a
+stand-in PDGA website, predict with a small model in a moto S3 bucket, create_tweet
+against a fake X API, and the front end's / page. MongoDB is mongomock unless
+--mongo-uri points at a real mongod. With --storage sqlite the discs, predictions and
+usage logs are stored in an embedded SQLite database instead.
+
+Each scale runs in a fresh process so that its peak RSS is its own.
+
+    pip install -r requirements.txt -r benchmarks/requirements.txt
+    python benchmarks/run_benchmarks.py --scales 100 1000 10000 --output report.json
+    python benchmarks/run_benchmarks.py --compare report.json
+    python benchmarks/run_benchmarks.py --storage sqlite
+"""
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SCALES = [100, 1000, 10000]
+BUCKET_NAME = "benchmark-models"
+MODEL_FEATURES = [
+    "DIAMETER (cm)",
+    "HEIGHT (cm)",
+    "RIM DEPTH (cm)",
+    "INSIDE RIM DIAMETER (cm)",
+    "RIM DEPTH / DIAMETER RATION (%)",
+    "RIM CONFIGURATION",
+]
+ROUND_TRIP_METHODS = [  # mongomock Collection methods that are a round trip to mongod
+    "aggregate",
+    "bulk_write",
+    "count_documents",
+    "create_index",
+    "delete_many",
+    "delete_one",
+    "distinct",
+    "find",
+    "find_one",
+    "find_one_and_update",
+    "insert_many",
+    "insert_one",
+    "replace_one",
+    "update_many",
+    "update_one",
+]
+CONFIG = """[mongodb]
+uri = {mongo_uri}
+db_name = benchmark
+scraper_collection = discs
+prediction_collection = predictions
+frontend_usage = frontend_usage
+scraper_usage = scraper_usage
+prediction_usage = prediction_usage
+twitter_usage = twitter_usage
+[admin]
+username = admin
+password = benchmark
+[auth]
+api_key = benchmark
+[tebi]
+access_key = benchmark
+secret_key = benchmark
+endpoint_url = https://s3.amazonaws.com
+bucket_name = {bucket_name}
+[twitter]
+api_key = benchmark
+api_key_secret = benchmark
+access_token = benchmark
+access_token_secret = benchmark
+[urls]
+pdga = {pdga_url}
+[queue]
+backend = sqlite
+sqlite_path = jobs.db
+[snapshots]
+path = snapshots
+[storage]
+backend = {storage}
+sqlite_path = pdga.db
+"""
+
+
+class RoundTripCounter(pymongo.monitoring.CommandListener):
+    """Counts the round trips the services make to MongoDB. With a real mongod every
+    command is counted; with mongomock every call of a method in ROUND_TRIP_METHODS,
+    so iterating a large cursor counts once rather than once per batch."""
+
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def install_mongomock(self):
+        import mongomock
+
+        def counted(method):
+            def wrapper(*args, **kwargs):
+                self.count += 1
+                return method(*args, **kwargs)
+
+            return wrapper
+
+        for name in ROUND_TRIP_METHODS:
+            method = getattr(mongomock.collection.Collection, name)
+            setattr(mongomock.collection.Collection, name, counted(method))
+
+    def install_pymongo(self):
+        pymongo.monitoring.register(self)
+
+
+class FakeXClient:
+    """Stands in for the tweepy clients of the Twitter service, taking latency seconds
+    per tweet and per media upload like a call to the X API would."""
+
+    def __init__(self, latency: float = 0):
+        self.latency = latency
+        self.tweets = []
+        self.media = []
+
+    def create_tweet(
+        self, text: str, user_auth: bool = True, media_ids: list = None
+    ) -> dict:
+        if self.latency:
+            time.sleep(self.latency)
+        self.tweets.append(text)
+        return {"data": {"id": str(len(self.tweets)), "text": text}}
+
+    def media_upload(self, filename: str, file=None):
+        if self.latency:
+            time.sleep(self.latency)
+        self.media.append(file.read())
+        return types.SimpleNamespace(media_id=len(self.media))
+
+
+def upload_benchmark_model(config):
+    """Trains a small linear model on random measurements and uploads it to the
+    (mocked) S3 bucket the prediction service downloads models from."""
+    import boto3
+    import joblib
+    import numpy as np
+    import pandas as pd
+    from sklearn.linear_model import LinearRegression
+
+    rng = np.random.default_rng(0)
+    X = pd.DataFrame(
+        rng.uniform(0, 60, (200, len(MODEL_FEATURES))), columns=MODEL_FEATURES
+    )
+    y = rng.uniform(-3, 14, (200, 4))
+    model = LinearRegression().fit(X, y)
+    buffer = io.BytesIO()
+    joblib.dump(model, buffer)
+
+    s3 = boto3.client(
+        service_name="s3",
+        aws_access_key_id=config["tebi"]["access_key"],
+        aws_secret_access_key=config["tebi"]["secret_key"],
+        endpoint_url=config["tebi"]["endpoint_url"],
+        region_name="us-east-1",
+    )
+    s3.create_bucket(Bucket=BUCKET_NAME)
+    s3.put_object(Bucket=BUCKET_NAME, Key="benchmark-model.pkl", Body=buffer.getvalue())
+
+
+def peak_rss_mb() -> float:
+    """Returns the peak resident set size of this process in megabytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_scale(
+    discs: int, latency: float, tweet_latency: float, mongo_uri: str, storage: str
+) -> dict:
+    """Runs the pipeline once over a fresh database and a stand-in site with the given
+    number of discs, in a temporary directory that is removed afterwards.
+
+    Returns:
+        dict: wall time, peak RSS and the time, round trips and status of every stage
+    """
+    import configparser
+
+    from moto import mock_aws
+    from pdga_server import PDGAServer
+
+    workdir = tempfile.mkdtemp(prefix="pdga-benchmark-")
+    try:
+        os.chdir(workdir)  # the services read config.ini from the working directory
+        os.environ.pop("PDGA_CONFIG", None)
+        server = PDGAServer(("127.0.0.1", 0), discs, latency)
+        server.start()
+        with open("config.ini", "w") as file:
+            file.write(
+                CONFIG.format(
+                    mongo_uri=mongo_uri or "mongodb://localhost:27017",
+                    bucket_name=BUCKET_NAME,
+                    pdga_url=server.url,
+                    storage=storage,
+                )
+            )
+        config = configparser.ConfigParser()
+        config.read("config.ini")
+
+        counter = RoundTripCounter()
+        patches = [mock_aws()]
+        if mongo_uri:
+            counter.install_pymongo()
+        else:
+            import mongomock
+
+            counter.install_mongomock()
+            client = mongomock.MongoClient()
+            patches.append(patch("pymongo.MongoClient", return_value=client))
+        for active in patches:
+            active.start()
+
+        upload_benchmark_model(config)
+
+        sys.path.insert(0, REPO_ROOT)
+        from services.common.storage import connect_to_mongodb
+        from services.common.usage import flush_usage_logs
+        from services.frontend import frontend
+        from services.prediction import prediction
+        from services.scraper import scraper
+        from services.twitter import twitter
+
+        x_client = FakeXClient(tweet_latency)
+        twitter.twitter_client = x_client
+        twitter.twitter_api = x_client
+        frontend.start_replica_sync = lambda: None  # mongomock has no change streams
+
+        headers = {"X-API-KEY": config["auth"]["api_key"]}
+        stages = [
+            (
+                "scrape_and_store",
+                scraper,
+                lambda client: client.post("/scrape_and_store", headers=headers),
+            ),
+            (
+                "predict",
+                prediction,
+                lambda client: client.post("/predict", headers=headers),
+            ),
+            (
+                "create_tweet",
+                twitter,
+                lambda client: client.post("/create_tweet", headers=headers),
+            ),
+            ("frontend_index", frontend, lambda client: client.get("/")),
+            ("frontend_index_cached", frontend, lambda client: client.get("/")),
+        ]
+
+        results = {}
+        wall_start = time.perf_counter()
+        for name, service, call in stages:
+            round_trips = counter.count
+            start = time.perf_counter()
+            with service.app.test_client() as client:
+                response = call(client)
+            flush_usage_logs()
+            results[name] = {
+                "seconds": round(time.perf_counter() - start, 4),
+                "round_trips": counter.count - round_trips,
+                "status_code": response.status_code,
+            }
+        wall_seconds = time.perf_counter() - wall_start
+
+        if storage == "sqlite":
+            connection = sqlite3.connect(config["storage"]["sqlite_path"])
+            discs_stored, predictions_stored = connection.execute(
+                "SELECT (SELECT COUNT(*) FROM discs), (SELECT COUNT(*) FROM predictions)"
+            ).fetchone()
+            connection.close()
+        else:
+            db = connect_to_mongodb()
+            discs_stored = db[scraper.COLLECTION].count_documents({})
+            predictions_stored = db[prediction.PREDICTION_COLLECTION].count_documents(
+                {}
+            )
+        report = {
+            "discs": discs,
+            "wall_seconds": round(wall_seconds, 4),
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            "round_trips": sum(stage["round_trips"] for stage in results.values()),
+            "stages": results,
+            "counts": {
+                "pages_fetched": server.requests,
+                "discs_stored": discs_stored,
+                "predictions_stored": predictions_stored,
+                "tweets": len(x_client.tweets),
+                "charts_attached": len(x_client.media),
+            },
+        }
+        for active in reversed(patches):
+            active.stop()
+        server.shutdown()
+        return report
+    finally:
+        os.chdir(REPO_ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=REPO_ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """Finds the scales whose wall time or round trips regressed by more than the
+    tolerance against a baseline report.
+
+    Returns:
+        list: descriptions of the regressions
+    """
+    regressions = []
+    baseline_results = {result["discs"]: result for result in baseline["results"]}
+    for result in report["results"]:
+        previous = baseline_results.get(result["discs"])
+        if previous is None:
+            continue
+        for metric in ["wall_seconds", "round_trips", "peak_rss_mb"]:
+            if result[metric] > previous[metric] * (1 + tolerance):
+                regressions.append(
+                    f"{result['discs']} discs: {metric} {previous[metric]} -> {result[metric]}"
+                )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the whole pipeline offline"
+    )
+    parser.add_argument("--scales", type=int, nargs="+", default=DEFAULT_SCALES)
+    parser.add_argument(
+        "--latency", type=float, default=0, help="seconds per PDGA page request"
+    )
+    parser.add_argument(
+        "--tweet-latency", type=float, default=0, help="seconds per X API call"
+    )
+    parser.add_argument("--mongo-uri", help="benchmark against a real mongod")
+    parser.add_argument(
+        "--storage",
+        choices=["mongodb", "sqlite"],
+        default="mongodb",
+        help="storage backend of the discs, predictions and usage logs",
+    )
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--compare", help="baseline report to check for regressions")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed regression against the baseline. Defaults to 20%%",
+    )
+    parser.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        result = run_scale(
+            args.scales[0],
+            args.latency,
+            args.tweet_latency,
+            args.mongo_uri,
+            args.storage,
+        )
+        print(json.dumps(result))
+        sys.exit(0)
+
+    results = []
+    for discs in args.scales:
+        command = [
+            sys.executable,
+            os.path.abspath(__file__),
+            "--single",
+            "--scales",
+            str(discs),
+            "--latency",
+            str(args.latency),
+            "--tweet-latency",
+            str(args.tweet_latency),
+            "--storage",
+            args.storage,
+        ]
+        if args.mongo_uri:
+            command += ["--mongo-uri", args.mongo_uri]
+        output = subprocess.run(command, capture_output=True, text=True)
+        if output.returncode != 0:
+            print(output.stderr, file=sys.stderr)
+            sys.exit(f"Benchmark at {discs} discs failed")
+        results.append(json.loads(output.stdout.strip().splitlines()[-1]))
+        print(
+            f"{discs} discs: {results[-1]['wall_seconds']}s, "
+            f"{results[-1]['round_trips']} round trips, {results[-1]['peak_rss_mb']} MB",
+            file=sys.stderr,
+        )
+
+    report = {
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "mongodb": "mongod" if args.mongo_uri else "mongomock",
+        "storage": args.storage,
+        "latency": args.latency,
+        "tweet_latency": args.tweet_latency,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(report, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
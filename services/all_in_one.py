@@ -0,0 +1,255 @@
+import argparse
+import collections
+import itertools
+import json
+import queue
+import signal
+import sys
+import threading
+import time
+
+from datetime import datetime
+from werkzeug.middleware.dispatcher import DispatcherMiddleware
+from werkzeug.serving import run_simple
+
+from services.common import jobs
+from services.common.storage import set_app_name
+from services.frontend import frontend
+from services.prediction import prediction
+from services.scraper import scraper
+from services.twitter import twitter
+
+"""
+All-in-one mode which runs the scraper, prediction, Twitter and front end services in a
+single process, for development, CI and small self-hosted deployments.
+
+Run it from the directory with config.ini:
+    python -m services.all_in_one            serves every service on one port
+    python -m services.all_in_one --once     runs the pipeline once and exits
+"""
+
+APP_NAME = "pdga-all-in-one"
+MOUNTS = {  # path prefix: service
+    "/scraper": scraper.app,
+    "/prediction": prediction.app,
+    "/twitter": twitter.app,
+}
+CLAIM_TIMEOUT = 1  # seconds a worker waits for a job before checking whether to stop
+
+
+class InMemoryJobQueue:
+    """The services' job queue kept in process memory, so a stage hands its event to
+    the next stage as soon as it is published. It has the same methods as the MongoDB
+    and SQLite job queues. Jobs do not survive the process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queues = collections.defaultdict(queue.Queue)
+        self.dedup_keys = set()
+        self.statuses = {}  # job id: (event, status)
+        self.ids = itertools.count(1)
+
+    def publish(self, event: str, payload: dict, dedup_key: str, trace: dict) -> bool:
+        """Adds a job unless a job with the same dedup key has been published.
+
+        Returns:
+            bool: whether the job was added
+        """
+        with self.lock:
+            if dedup_key in self.dedup_keys:
+                return False
+            self.dedup_keys.add(dedup_key)
+            job = {
+                "id": next(self.ids),
+                "event": event,
+                "payload": payload,
+                "trace": trace,
+                "attempts": 0,
+                "lease_id": None,
+            }
+            self.statuses[job["id"]] = (event, "pending")
+            self.queues[event].put(job)
+        return True
+
+    def claim(self, event: str) -> dict:
+        """Takes the oldest job for an event, waiting up to CLAIM_TIMEOUT for one.
+
+        Returns:
+            dict: the job, None if there are none
+        """
+        with self.lock:
+            queued = self.queues[event]
+        try:
+            job = queued.get(timeout=CLAIM_TIMEOUT)
+        except queue.Empty:
+            return None
+        job["attempts"] += 1
+        return job
+
+    def ack(self, job: dict):
+        """Marks a job as done."""
+        with self.lock:
+            self.statuses[job["id"]] = (job["event"], "done")
+
+    def fail(self, job: dict, error: str):
+        """Queues a job again after the retry delay, or gives up on it once it has been
+        tried JOB_MAX_ATTEMPTS times."""
+        if job["attempts"] >= jobs.JOB_MAX_ATTEMPTS:
+            with self.lock:
+                self.statuses[job["id"]] = (job["event"], "dead")
+            return
+        with self.lock:
+            queued = self.queues[job["event"]]
+        retry = threading.Timer(
+            jobs.job_retry_delay(job["attempts"]), queued.put, args=(job,)
+        )
+        retry.daemon = True
+        retry.start()
+
+    def counts(self) -> dict:
+        """Counts the jobs of each event by status.
+
+        Returns:
+            dict: {event: {status: count}}
+        """
+        counts = {}
+        with self.lock:
+            for event, status in self.statuses.values():
+                counts.setdefault(event, {}).setdefault(status, 0)
+                counts[event][status] += 1
+        return counts
+
+
+def install_job_queue(job_queue):
+    """Makes every pipeline service publish to and claim from the given job queue.
+
+    Args:
+        job_queue (InMemoryJobQueue): the shared job queue
+    """
+    jobs.job_queue = job_queue
+    jobs.JOB_POLL_INTERVAL = 0  # claim() waits for jobs itself
+
+
+def create_app(start_workers: bool = True):
+    """Mounts the pipeline services under MOUNTS, with the front end at the root,
+    and hands the pipeline events between them through an in-memory job queue.
+
+    Args:
+        start_workers (bool, optional): whether to start the prediction and Twitter
+            workers. Defaults to True.
+
+    Returns:
+        DispatcherMiddleware: WSGI application serving every service
+    """
+    set_app_name(APP_NAME)
+    install_job_queue(InMemoryJobQueue())
+    if start_workers:
+        jobs.start_job_worker(
+            jobs.EVENT_DISCS_SCRAPED,
+            prediction.handle_discs_scraped,
+            prediction.APP_NAME,
+            prediction.USAGE_COLLECTION,
+        )
+        jobs.start_job_worker(
+            jobs.EVENT_PREDICTIONS_READY,
+            twitter.handle_predictions_ready,
+            twitter.APP_NAME,
+            twitter.USAGE_COLLECTION,
+        )
+    return DispatcherMiddleware(frontend.app, MOUNTS)
+
+
+def run_pipeline() -> dict:
+    """Runs the whole pipeline once. The scraped discs are handed to prediction and
+    the predictions to the Twitter stage in memory. Everything is written to the
+    storage backend in batches before anything is tweeted, so a run that fails
+    halfway does not scrape and tweet the same discs again. Like the Twitter service,
+    each prediction is marked as tweeted before it is posted, so it is tweeted at most
+    once.
+
+    Returns:
+        dict: how many discs went through each stage and the seconds each stage took
+    """
+    seconds = {}
+    start = time.perf_counter()
+    discs = scraper.scrape_discs(scraper.get_repository().disc_urls())
+    scraper.last_scraped = datetime.now()
+    seconds["scrape"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    # Copies, since storing the discs adds their _id
+    predictions = (
+        prediction.predict_discs([dict(disc) for disc in discs]) if discs else []
+    )
+    try:
+        prediction.render_flight_charts(predictions)
+    except Exception as e:
+        print(f"Error rendering the flight charts: {e}")
+    seconds["predict"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if discs:
+        scraper.get_repository().insert_discs(discs)
+    if predictions:
+        repository = prediction.get_repository()
+        predictions = repository.insert_predictions(predictions)
+        try:
+            repository.update_prediction_stats(predictions)
+        except Exception as e:
+            print(f"Error updating the aggregate rollups: {e}")
+        try:
+            prediction.update_similarity_index(predictions)
+        except Exception as e:
+            print(f"Error updating the similarity index: {e}")
+        try:
+            uploaded = {entry["url"] for entry in predictions}
+            prediction.catch_up_snapshot(
+                repository, [disc for disc in discs if disc["url"] in uploaded]
+            )
+        except Exception as e:
+            print(f"Error exporting the snapshot: {e}")
+    if predictions and frontend.STATIC_EXPORT_PATH:
+        try:
+            frontend.export_static_site(
+                frontend.refresh_prediction_snapshot(frontend.get_repository())
+            )
+        except Exception as e:
+            print(f"Error exporting the static site: {e}")
+    seconds["store"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    tweets = 0
+    repository = twitter.get_repository()
+    for entry in predictions:
+        try:
+            repository.mark_tweeted(entry)
+            twitter.post_tweet(entry, repository)
+            tweets += 1
+        except Exception as e:
+            print(f"Error tweeting {entry['url']}: {e}")
+    seconds["tweet"] = time.perf_counter() - start
+
+    return {
+        "discs": len(discs),
+        "predictions": len(predictions),
+        "tweets": tweets,
+        "seconds": seconds,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Runs every PDGA Flight Forecast service in one process"
+    )
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--once", action="store_true", help="run the pipeline once and exit"
+    )
+    args = parser.parse_args()
+
+    # Exit normally on SIGTERM so that buffered usage logs are flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if args.once:
+        print(json.dumps(run_pipeline(), indent=2))
+    else:
+        run_simple("0.0.0.0", args.port, create_app(), threaded=True)
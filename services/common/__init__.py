@@ -0,0 +1,6 @@
+"""
+Infrastructure shared by the scraper, prediction, Twitter and front end services:
+storage, usage logs, request metrics and profiling, tracing, the job queue and the
+pipeline locks. Each service imports what it uses from these modules and keeps only
+its own routes and logic.
+"""
@@ -0,0 +1,42 @@
+from flask import jsonify, request
+from functools import wraps
+
+from services.common.config import config
+
+"""
+Basic auth of the admin pages and the API key the services call each other with.
+"""
+ADMIN_USERNAME = config["admin"]["username"]
+ADMIN_PASSWORD = config["admin"]["password"]
+
+
+def verify_api_key(func):
+    """Used to verify access across APIs"""
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        provided_api_key = request.headers.get("X-API-KEY")
+        if not provided_api_key:
+            return jsonify({"message": "API key is missing"}), 401
+
+        config_api_key = config["auth"]["api_key"]
+        if provided_api_key != config_api_key:
+            return jsonify({"message": "Invalid API key"}), 401
+
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
+def check_auth(username, password):
+    """Check if a username and password are valid to view the admin page."""
+    return username == ADMIN_USERNAME and password == ADMIN_PASSWORD
+
+
+def authenticate():
+    """Send a 401 response that enables basic auth."""
+    return (
+        "Unauthorized access. Please provide valid credentials.",
+        401,
+        {"WWW-Authenticate": 'Basic realm="Login Required"'},
+    )
@@ -0,0 +1,10 @@
+import configparser
+import os
+
+"""
+The configuration every service reads from config.ini in the working directory, or
+from the file named by the PDGA_CONFIG environment variable.
+"""
+CONFIG_PATH = os.environ.get("PDGA_CONFIG", "config.ini")
+config = configparser.ConfigParser()
+config.read(CONFIG_PATH)
@@ -0,0 +1,481 @@
+import contextlib
+import hashlib
+import json
+import pymongo
+import secrets
+import sqlite3
+import threading
+import time
+
+from datetime import datetime, timedelta
+
+from services.common.config import config
+from services.common.storage import connect_to_mongodb, get_repository
+from services.common.tracing import (
+    PARENT_SPAN_ID_HEADER,
+    SPAN_ID_PATTERN,
+    TRACE_ID_HEADER,
+    TRACE_ID_PATTERN,
+    Trace,
+    current_trace,
+    span,
+    trace_headers,
+    write_trace,
+)
+from services.common.usage import write_usage_log
+
+"""
+The durable job queue the pipeline stages hand their events to: the scraper publishes
+discs_scraped for the prediction service, which publishes predictions_ready for the
+Twitter service. Each consuming service runs a worker thread per event.
+"""
+JOB_BACKEND = config.get("queue", "backend", fallback="mongodb")  # mongodb or sqlite
+JOB_COLLECTION = config.get("queue", "collection", fallback="jobs")
+JOB_SQLITE_PATH = config.get("queue", "sqlite_path", fallback="jobs.db")
+JOB_VISIBILITY_TIMEOUT = timedelta(
+    seconds=config.getfloat("queue", "visibility_timeout", fallback=600)
+)
+JOB_MAX_ATTEMPTS = config.getint("queue", "max_attempts", fallback=5)
+JOB_RETRY_DELAY = config.getfloat(
+    "queue", "retry_delay", fallback=30
+)  # seconds, doubled after each failed attempt
+JOB_POLL_INTERVAL = config.getfloat("queue", "poll_interval", fallback=5)  # seconds
+JOB_RETENTION = timedelta(days=7)  # also how long a dedup key is remembered
+EVENT_DISCS_SCRAPED = "discs_scraped"
+EVENT_PREDICTIONS_READY = "predictions_ready"
+PIPELINE_EVENTS = {  # event: required payload fields
+    EVENT_DISCS_SCRAPED: ["urls"],
+    EVENT_PREDICTIONS_READY: ["urls"],
+}
+
+job_queue = None
+job_queue_lock = threading.Lock()
+job_worker_stop = threading.Event()
+
+
+def job_retry_delay(attempts: int) -> float:
+    """Returns how long to wait before retrying a job that has failed.
+
+    Args:
+        attempts (int): number of times the job has been tried
+
+    Returns:
+        float: seconds until the job is available again
+    """
+    return JOB_RETRY_DELAY * 2 ** (attempts - 1)
+
+
+class MongoJobQueue:
+    """Durable job queue in a MongoDB collection. Claiming a job leases it for
+    JOB_VISIBILITY_TIMEOUT, after which a job that was never acknowledged is delivered
+    again, so every job is delivered at least once. Finished jobs are kept for
+    JOB_RETENTION so that publishing the same dedup key again is a no-op."""
+
+    def __init__(self, collection_name: str = JOB_COLLECTION):
+        self.collection_name = collection_name
+        self.indexed = False
+
+    def collection(self):
+        collection = connect_to_mongodb()[self.collection_name]
+        if not self.indexed:
+            collection.create_index("dedup_key", unique=True)
+            collection.create_index([("event", 1), ("status", 1), ("available_at", 1)])
+            collection.create_index("expire_at", expireAfterSeconds=0)
+            self.indexed = True
+        return collection
+
+    def publish(self, event: str, payload: dict, dedup_key: str, trace: dict) -> bool:
+        """Adds a job unless a job with the same dedup key already exists.
+
+        Returns:
+            bool: whether the job was added
+        """
+        now = datetime.now()
+        job = {
+            "event": event,
+            "payload": payload,
+            "dedup_key": dedup_key,
+            "trace": trace,
+            "status": "pending",
+            "attempts": 0,
+            "available_at": now,
+            "created_at": now,
+        }
+        try:
+            result = self.collection().update_one(
+                {"dedup_key": dedup_key}, {"$setOnInsert": job}, upsert=True
+            )
+        except pymongo.errors.DuplicateKeyError:  # published concurrently
+            return False
+        return result.upserted_id is not None
+
+    def claim(self, event: str) -> dict:
+        """Leases the oldest available job for an event.
+
+        Returns:
+            dict: the job, None if there are none available
+        """
+        now = datetime.now()
+        job = self.collection().find_one_and_update(
+            {"event": event, "status": "pending", "available_at": {"$lte": now}},
+            {
+                "$set": {
+                    "available_at": now + JOB_VISIBILITY_TIMEOUT,
+                    "lease_id": secrets.token_hex(8),
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("available_at", 1)],
+            return_document=pymongo.ReturnDocument.AFTER,
+        )
+        if job is None:
+            return None
+        return {
+            "id": job["_id"],
+            "event": job["event"],
+            "payload": job["payload"],
+            "trace": job.get("trace") or {},
+            "attempts": job["attempts"],
+            "lease_id": job["lease_id"],
+        }
+
+    def ack(self, job: dict):
+        """Marks a leased job as done."""
+        now = datetime.now()
+        self.collection().update_one(
+            {"_id": job["id"], "lease_id": job["lease_id"]},
+            {
+                "$set": {
+                    "status": "done",
+                    "finished_at": now,
+                    "expire_at": now + JOB_RETENTION,
+                }
+            },
+        )
+
+    def fail(self, job: dict, error: str):
+        """Schedules a leased job to be retried, or gives up on it once it has been
+        tried JOB_MAX_ATTEMPTS times."""
+        now = datetime.now()
+        if job["attempts"] >= JOB_MAX_ATTEMPTS:
+            update = {
+                "status": "dead",
+                "finished_at": now,
+                "expire_at": now + JOB_RETENTION,
+            }
+        else:
+            update = {
+                "available_at": now
+                + timedelta(seconds=job_retry_delay(job["attempts"]))
+            }
+        self.collection().update_one(
+            {"_id": job["id"], "lease_id": job["lease_id"]},
+            {"$set": {**update, "error": error}},
+        )
+
+    def counts(self) -> dict:
+        """Counts the jobs of each event by status.
+
+        Returns:
+            dict: {event: {status: count}}
+        """
+        counts = {}
+        for row in self.collection().aggregate(
+            [
+                {
+                    "$group": {
+                        "_id": {"event": "$event", "status": "$status"},
+                        "count": {"$sum": 1},
+                    }
+                }
+            ]
+        ):
+            counts.setdefault(row["_id"]["event"], {})[row["_id"]["status"]] = row[
+                "count"
+            ]
+        return counts
+
+
+class SQLiteJobQueue:
+    """The same job queue in an SQLite database, for running the pipeline locally
+    without MongoDB. Times are stored as Unix timestamps."""
+
+    def __init__(self, path: str = JOB_SQLITE_PATH):
+        self.path = path
+        with contextlib.closing(self.connect()) as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    event TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    dedup_key TEXT NOT NULL UNIQUE,
+                    trace TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL,
+                    available_at REAL NOT NULL,
+                    created_at REAL NOT NULL,
+                    lease_id TEXT,
+                    finished_at REAL,
+                    expire_at REAL,
+                    error TEXT
+                )"""
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_available "
+                "ON jobs (event, status, available_at)"
+            )
+
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def publish(self, event: str, payload: dict, dedup_key: str, trace: dict) -> bool:
+        """Adds a job unless a job with the same dedup key already exists.
+
+        Returns:
+            bool: whether the job was added
+        """
+        now = time.time()
+        with contextlib.closing(self.connect()) as connection:
+            connection.execute("DELETE FROM jobs WHERE expire_at <= ?", (now,))
+            cursor = connection.execute(
+                "INSERT OR IGNORE INTO jobs (event, payload, dedup_key, trace, status, "
+                "attempts, available_at, created_at) "
+                "VALUES (?, ?, ?, ?, 'pending', 0, ?, ?)",
+                (event, json.dumps(payload), dedup_key, json.dumps(trace), now, now),
+            )
+            return cursor.rowcount == 1
+
+    def claim(self, event: str) -> dict:
+        """Leases the oldest available job for an event.
+
+        Returns:
+            dict: the job, None if there are none available
+        """
+        now = time.time()
+        lease_id = secrets.token_hex(8)
+        with contextlib.closing(self.connect()) as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute(
+                    "SELECT * FROM jobs WHERE event = ? AND status = 'pending' "
+                    "AND available_at <= ? ORDER BY available_at LIMIT 1",
+                    (event, now),
+                ).fetchone()
+                if row is not None:
+                    connection.execute(
+                        "UPDATE jobs SET available_at = ?, lease_id = ?, "
+                        "attempts = attempts + 1 WHERE id = ?",
+                        (
+                            now + JOB_VISIBILITY_TIMEOUT.total_seconds(),
+                            lease_id,
+                            row["id"],
+                        ),
+                    )
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        return {
+            "id": row["id"],
+            "event": row["event"],
+            "payload": json.loads(row["payload"]),
+            "trace": json.loads(row["trace"]),
+            "attempts": row["attempts"] + 1,
+            "lease_id": lease_id,
+        }
+
+    def ack(self, job: dict):
+        """Marks a leased job as done."""
+        now = time.time()
+        with contextlib.closing(self.connect()) as connection:
+            connection.execute(
+                "UPDATE jobs SET status = 'done', finished_at = ?, expire_at = ? "
+                "WHERE id = ? AND lease_id = ?",
+                (now, now + JOB_RETENTION.total_seconds(), job["id"], job["lease_id"]),
+            )
+
+    def fail(self, job: dict, error: str):
+        """Schedules a leased job to be retried, or gives up on it once it has been
+        tried JOB_MAX_ATTEMPTS times."""
+        now = time.time()
+        with contextlib.closing(self.connect()) as connection:
+            if job["attempts"] >= JOB_MAX_ATTEMPTS:
+                connection.execute(
+                    "UPDATE jobs SET status = 'dead', finished_at = ?, expire_at = ?, "
+                    "error = ? WHERE id = ? AND lease_id = ?",
+                    (
+                        now,
+                        now + JOB_RETENTION.total_seconds(),
+                        error,
+                        job["id"],
+                        job["lease_id"],
+                    ),
+                )
+            else:
+                connection.execute(
+                    "UPDATE jobs SET available_at = ?, error = ? "
+                    "WHERE id = ? AND lease_id = ?",
+                    (
+                        now + job_retry_delay(job["attempts"]),
+                        error,
+                        job["id"],
+                        job["lease_id"],
+                    ),
+                )
+
+    def counts(self) -> dict:
+        """Counts the jobs of each event by status.
+
+        Returns:
+            dict: {event: {status: count}}
+        """
+        counts = {}
+        with contextlib.closing(self.connect()) as connection:
+            for row in connection.execute(
+                "SELECT event, status, COUNT(*) AS count FROM jobs GROUP BY event, status"
+            ):
+                counts.setdefault(row["event"], {})[row["status"]] = row["count"]
+        return counts
+
+
+def get_job_queue():
+    """Returns the job queue of the configured backend, creating it on first use.
+
+    Returns:
+        MongoJobQueue | SQLiteJobQueue: the job queue
+    """
+    global job_queue
+    with job_queue_lock:
+        if job_queue is None:
+            if JOB_BACKEND == "sqlite":
+                job_queue = SQLiteJobQueue(JOB_SQLITE_PATH)
+            else:
+                job_queue = MongoJobQueue(JOB_COLLECTION)
+        return job_queue
+
+
+def publish_event(event: str, payload: dict) -> bool:
+    """Publishes a pipeline event for the next stage to pick up. The dedup key is
+    derived from the event and its payload, so publishing the same event twice only
+    queues one job.
+
+    Args:
+        event (str): one of PIPELINE_EVENTS
+        payload (dict): the event's fields
+
+    Raises:
+        ValueError: when the event is unknown or missing fields
+
+    Returns:
+        bool: whether a job was queued
+    """
+    if event not in PIPELINE_EVENTS:
+        raise ValueError(f"Unknown event: {event}")
+    missing = [field for field in PIPELINE_EVENTS[event] if field not in payload]
+    if missing:
+        raise ValueError(f"{event} is missing {', '.join(missing)}")
+    digest = hashlib.sha1(
+        json.dumps(payload, sort_keys=True, default=str).encode()
+    ).hexdigest()
+    return get_job_queue().publish(event, payload, f"{event}:{digest}", trace_headers())
+
+
+def process_job(queue, job: dict, handler, service: str, usage_collection: str):
+    """Runs the handler for a job as the root span of a trace that continues the
+    publisher's trace, then acknowledges the job. When the handler fails the job is
+    retried later.
+
+    Args:
+        queue (MongoJobQueue | SQLiteJobQueue): the queue the job was claimed from
+        job (dict): the claimed job
+        handler (function): takes the job's payload and returns a status message
+        service (str): name of the service running the job
+        usage_collection (str): collection of the service's usage logs
+    """
+    start_time = datetime.now()
+    trace_id = job["trace"].get(TRACE_ID_HEADER, "")
+    parent_span_id = job["trace"].get(PARENT_SPAN_ID_HEADER, "")
+    trace = Trace(
+        service,
+        trace_id if TRACE_ID_PATTERN.fullmatch(trace_id) else None,
+        parent_span_id if SPAN_ID_PATTERN.fullmatch(parent_span_id) else None,
+    )
+    token = current_trace.set(trace)
+    try:
+        with span(
+            f"job_{job['event']}", job_id=str(job["id"]), attempt=job["attempts"]
+        ):
+            message = handler(job["payload"])
+        queue.ack(job)
+        status_code = 200
+    except Exception as e:
+        print(f"Error running {job['event']} job {job['id']}: {e}")
+        message, status_code = str(e), 500
+        try:
+            queue.fail(job, message)
+        except Exception as e:  # the lease expires and the job is delivered again
+            print(f"Error failing {job['event']} job {job['id']}: {e}")
+    finally:
+        current_trace.reset(token)
+        try:
+            write_trace(trace)
+        except Exception as e:
+            print(f"Error writing trace {trace.trace_id}: {e}")
+    try:
+        write_usage_log(
+            get_repository(),
+            usage_collection,
+            f"/jobs/{job['event']}",
+            "JOB",
+            status_code,
+            message,
+            start_time,
+        )
+    except Exception as e:
+        print(f"Error logging {job['event']} job {job['id']}: {e}")
+
+
+def run_job_worker(event: str, handler, service: str, usage_collection: str):
+    """Claims and runs jobs for an event until the worker is stopped, waiting
+    JOB_POLL_INTERVAL seconds whenever there are none.
+
+    Args:
+        event (str): one of PIPELINE_EVENTS
+        handler (function): takes a job's payload and returns a status message
+        service (str): name of the service running the jobs
+        usage_collection (str): collection of the service's usage logs
+    """
+    queue = get_job_queue()
+    while not job_worker_stop.is_set():
+        try:
+            job = queue.claim(event)
+        except Exception as e:
+            print(f"Error claiming a {event} job: {e}")
+            job = None
+        if job is None:
+            job_worker_stop.wait(JOB_POLL_INTERVAL)
+        else:
+            process_job(queue, job, handler, service, usage_collection)
+
+
+def start_job_worker(
+    event: str, handler, service: str, usage_collection: str
+) -> threading.Thread:
+    """Starts a worker thread for an event, as run_job_worker describes.
+
+    Returns:
+        threading.Thread: the worker
+    """
+    worker = threading.Thread(
+        target=run_job_worker,
+        args=(event, handler, service, usage_collection),
+        name=f"{event}-worker",
+        daemon=True,
+    )
+    worker.start()
+    return worker
@@ -0,0 +1,23 @@
+import importlib
+import threading
+import types
+
+
+class LazyModule(types.ModuleType):
+    """Stands in for a module that is only imported when one of its attributes is
+    first used, which keeps heavy dependencies off the startup path."""
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self._lazy_lock = threading.Lock()
+        self._lazy_module = None
+
+    def __getattr__(self, attr: str):
+        # Only called for attributes that are not set on the stand-in itself
+        module = self._lazy_module
+        if module is None:
+            with self._lazy_lock:
+                if self._lazy_module is None:
+                    self._lazy_module = importlib.import_module(self.__name__)
+                module = self._lazy_module
+        return getattr(module, attr)
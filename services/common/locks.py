@@ -0,0 +1,141 @@
+import contextvars
+import secrets
+import threading
+import time
+
+from services.common.storage import LOCK_LEASE, get_repository
+
+"""
+Lease locks that keep a pipeline stage from running twice at once, across the
+processes and replicas of a service.
+"""
+current_lock = contextvars.ContextVar("current_lock", default=None)  # (stage, lost)
+
+
+class LockLost(Exception):
+    """Raised in a run whose lease lock expired and may have been taken over."""
+
+
+def acquire_lock(stage: str, owner: str) -> bool:
+    """Takes the lease lock of a pipeline stage unless another run holds it. A lock
+    whose lease has expired is taken over, so a crashed run cannot hold it forever.
+
+    Args:
+        stage (str): name of the stage
+        owner (str): id of the run taking the lock
+
+    Returns:
+        bool: whether the lock was taken
+    """
+    return get_repository().acquire_lock(stage, owner)
+
+
+def request_follow_up(stage: str) -> bool:
+    """Asks the run holding a stage's lock to run the stage once more when it finishes.
+
+    Returns:
+        bool: whether a run was holding the lock
+    """
+    return get_repository().request_follow_up(stage)
+
+
+def renew_lock(stage: str, owner: str) -> bool:
+    """Extends the lease of a held lock.
+
+    Returns:
+        bool: whether the lock is still held
+    """
+    return get_repository().renew_lock(stage, owner)
+
+
+def release_lock(stage: str, owner: str) -> bool:
+    """Releases a held lock unless a follow-up run was requested, in which case the
+    request is cleared and the lock is kept for the follow-up.
+
+    Returns:
+        bool: whether a follow-up run was requested
+    """
+    return get_repository().release_lock(stage, owner)
+
+
+def check_lock():
+    """Raises LockLost when the run calling it has lost its stage's lease lock, so
+    that it stops before writing what another run may be writing too. Does nothing
+    outside run_exclusively."""
+    lock = current_lock.get()
+    if lock is not None and lock[1].is_set():
+        raise LockLost(f"Lost the {lock[0]} lock")
+
+
+def run_exclusively(stage: str, func):
+    """Runs a pipeline stage while holding its lease lock, renewing the lease until it
+    finishes. A trigger that arrives during a run does not run the stage alongside it
+    but has the run go once more after it finishes, so any number of overlapping
+    triggers cause at most one follow-up run. The triggers it coalesces have been
+    acknowledged, so the follow-up runs even when the run before it failed.
+
+    Once the lease cannot be renewed, check_lock raises LockLost in func and no
+    follow-up is run, since another run may hold the lock by then.
+
+    Args:
+        stage (str): name of the stage
+        func (function): runs the stage and returns its status message
+
+    Returns:
+        str: status message of the last run, None when the trigger was coalesced into
+             a run that is already in progress
+    """
+    owner = secrets.token_hex(8)
+    while not acquire_lock(stage, owner):
+        if request_follow_up(stage):
+            return None
+        # The lock expired or was released in between
+
+    stop = threading.Event()
+    lost = threading.Event()
+
+    def renew():
+        renewed = time.monotonic()
+        while not stop.wait(LOCK_LEASE.total_seconds() / 3):
+            try:
+                held = renew_lock(stage, owner)
+            except Exception as e:
+                print(f"Error renewing the {stage} lock: {e}")
+                held = time.monotonic() - renewed < LOCK_LEASE.total_seconds()
+            else:
+                if held:
+                    renewed = time.monotonic()
+            if not held:
+                print(f"Lost the {stage} lock")
+                lost.set()
+                return
+
+    renewer = threading.Thread(target=renew, name=f"{stage}-lock", daemon=True)
+    renewer.start()
+    token = current_lock.set((stage, lost))
+    try:
+        while True:
+            try:
+                message = func()
+            except LockLost:
+                raise
+            except Exception:
+                # Without a follow-up the lock is dropped and the trigger is retried
+                if not release_lock(stage, owner):
+                    raise
+                print(
+                    f"Running {stage} again after a failure for the triggers received"
+                )
+                continue
+            if lost.is_set() or not release_lock(stage, owner):
+                return message  # a lost lock has expired and is taken over as it is
+            print(f"Running {stage} again for the triggers received during the run")
+    except Exception:
+        try:
+            get_repository().drop_lock(stage, owner)
+        except Exception as e:  # the lease expires instead
+            print(f"Error releasing the {stage} lock: {e}")
+        raise
+    finally:
+        current_lock.reset(token)
+        stop.set()
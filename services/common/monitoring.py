@@ -0,0 +1,554 @@
+import bisect
+import collections
+import cProfile
+import functools
+import io
+import math
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+from datetime import datetime
+from flask import Blueprint, Response, g, jsonify, request
+
+from services.common import storage
+from services.common.auth import authenticate, check_auth
+from services.common.usage import usage_log_stats
+
+"""
+In-process request metrics, exposed on /metrics in the Prometheus text format, and
+the on-demand profiler behind /admin/profile. Every service registers the blueprint,
+whose hooks time each request of the app.
+"""
+LATENCY_BUCKETS_PER_DOUBLING = 4
+LATENCY_BUCKET_BOUNDS = [  # milliseconds, from 0.1ms to about 105s
+    0.1 * 2 ** (i / LATENCY_BUCKETS_PER_DOUBLING)
+    for i in range(20 * LATENCY_BUCKETS_PER_DOUBLING + 1)
+]
+LATENCY_QUANTILES = [0.5, 0.95, 0.99]
+PROFILE_MAX_REQUESTS = 1000
+PROFILE_MAX_SECONDS = 600
+PROFILE_SAMPLE_INTERVAL = 0.005  # seconds
+PROFILE_TOP_FUNCTIONS = 50
+
+blueprint = Blueprint("monitoring", __name__)
+
+request_metrics = {}
+request_metrics_lock = threading.Lock()
+profiler = None
+profile_result = None
+profiler_lock = threading.Lock()
+memory_tracing_lock = threading.Lock()
+memory_tracing_users = 0  # profiles and measurements tracing memory
+memory_tracing_started = False  # whether they started tracemalloc themselves
+
+
+class LatencyHistogram:
+    """Log-bucketed latency histogram with LATENCY_BUCKETS_PER_DOUBLING buckets per
+    doubling, so quantiles are accurate to within about 19%. Histograms share their
+    bucket bounds and merge by adding counts."""
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def record(self, latency: float):
+        """Records one latency.
+
+        Args:
+            latency (float): latency in milliseconds
+        """
+        self.counts[bisect.bisect_left(LATENCY_BUCKET_BOUNDS, latency)] += 1
+        self.count += 1
+        self.sum += latency
+
+    def merge(self, other: "LatencyHistogram"):
+        """Adds the latencies recorded by another histogram to this one.
+
+        Args:
+            other (LatencyHistogram): histogram to merge in
+        """
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+
+    def quantile(self, q: float) -> float:
+        """Estimates a latency quantile as the upper bound of the bucket it falls in.
+
+        Args:
+            q (float): quantile between 0 and 1 e.g., 0.99
+
+        Returns:
+            float: latency in milliseconds, 0 when nothing has been recorded
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank and count:
+                return LATENCY_BUCKET_BOUNDS[min(index, len(LATENCY_BUCKET_BOUNDS) - 1)]
+        return LATENCY_BUCKET_BOUNDS[-1]
+
+
+def get_request_metrics(endpoint: str) -> dict:
+    """Returns the in-process metrics of an endpoint, creating them on first use.
+
+    Args:
+        endpoint (str): URL rule of the endpoint
+
+    Returns:
+        dict: latency histogram, error count and in-flight gauge of the endpoint
+    """
+    metrics = request_metrics.get(endpoint)
+    if metrics is None:
+        with request_metrics_lock:
+            metrics = request_metrics.setdefault(
+                endpoint, {"latency": LatencyHistogram(), "errors": 0, "in_flight": 0}
+            )
+    return metrics
+
+
+@blueprint.before_app_request
+def start_request_metrics():
+    # Prefixed with the mount point, so the services of one process stay apart
+    g.metrics_endpoint = (
+        request.script_root + request.url_rule.rule if request.url_rule else "unmatched"
+    )
+    g.metrics_start = time.perf_counter()
+    metrics = get_request_metrics(g.metrics_endpoint)
+    with request_metrics_lock:
+        metrics["in_flight"] += 1
+
+
+@blueprint.after_app_request
+def record_response_status(response):
+    g.metrics_status = response.status_code
+    if response.is_streamed and "metrics_start" in g:
+        # A streamed body is sent after the request ends, so it is timed to its end
+        g.metrics_deferred = True
+        response.call_on_close(
+            functools.partial(
+                record_request_metrics,
+                g.metrics_endpoint,
+                g.metrics_start,
+                response.status_code,
+            )
+        )
+    return response
+
+
+@blueprint.teardown_app_request
+def finish_request_metrics(error=None):
+    if "metrics_start" not in g or g.get("metrics_deferred"):
+        return
+    status = 500 if error is not None else g.get("metrics_status", 500)
+    record_request_metrics(g.metrics_endpoint, g.metrics_start, status)
+
+
+def record_request_metrics(endpoint: str, start: float, status: int):
+    """Records a finished request in the in-process metrics of its endpoint.
+
+    Args:
+        endpoint (str): the URL rule of the request
+        start (float): time.perf_counter() when the request started
+        status (int): status code of the response
+    """
+    latency = (time.perf_counter() - start) * 1000  # milliseconds
+    metrics = get_request_metrics(endpoint)
+    with request_metrics_lock:
+        metrics["in_flight"] -= 1
+        metrics["latency"].record(latency)
+        if status >= 500:
+            metrics["errors"] += 1
+
+
+def summarize_request_metrics() -> dict:
+    """Summarizes the in-process metrics of every endpoint for the admin page.
+
+    Returns:
+        dict: request count, errors, in-flight requests and latency quantiles per endpoint
+    """
+    with request_metrics_lock:
+        return {
+            endpoint: {
+                "count": metrics["latency"].count,
+                "errors": metrics["errors"],
+                "in_flight": metrics["in_flight"],
+                **{
+                    f"p{int(q * 100)}": round(metrics["latency"].quantile(q), 2)
+                    for q in LATENCY_QUANTILES
+                },
+            }
+            for endpoint, metrics in sorted(request_metrics.items())
+        }
+
+
+def format_prometheus_metrics() -> str:
+    """Renders the in-process metrics in the Prometheus text exposition format.
+
+    Returns:
+        str: metrics of every endpoint, the usage log writer and the MongoDB pool
+    """
+    service = f'service="{storage.app_name}"'
+    lines = [
+        "# HELP pdga_request_duration_seconds Request latency.",
+        "# TYPE pdga_request_duration_seconds histogram",
+    ]
+    with request_metrics_lock:
+        endpoints = sorted(request_metrics.items())
+        for endpoint, metrics in endpoints:
+            labels = f'{service},endpoint="{endpoint}"'
+            histogram = metrics["latency"]
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKET_BOUNDS, histogram.counts):
+                cumulative += count
+                lines.append(
+                    f'pdga_request_duration_seconds_bucket{{{labels},le="{bound / 1000:.6g}"}} {cumulative}'
+                )
+            lines.append(
+                f'pdga_request_duration_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}'
+            )
+            lines.append(
+                f"pdga_request_duration_seconds_sum{{{labels}}} {histogram.sum / 1000:.6f}"
+            )
+            lines.append(
+                f"pdga_request_duration_seconds_count{{{labels}}} {histogram.count}"
+            )
+
+        lines += [
+            "# HELP pdga_request_duration_quantile_seconds Estimated request latency quantiles.",
+            "# TYPE pdga_request_duration_quantile_seconds gauge",
+        ]
+        for endpoint, metrics in endpoints:
+            for q in LATENCY_QUANTILES:
+                lines.append(
+                    f'pdga_request_duration_quantile_seconds{{{service},endpoint="{endpoint}",quantile="{q}"}} '
+                    f'{metrics["latency"].quantile(q) / 1000:.6g}'
+                )
+
+        lines += [
+            "# HELP pdga_request_errors_total Requests answered with a 5xx status.",
+            "# TYPE pdga_request_errors_total counter",
+        ]
+        for endpoint, metrics in endpoints:
+            lines.append(
+                f'pdga_request_errors_total{{{service},endpoint="{endpoint}"}} {metrics["errors"]}'
+            )
+
+        lines += [
+            "# HELP pdga_requests_in_flight Requests currently being handled.",
+            "# TYPE pdga_requests_in_flight gauge",
+        ]
+        for endpoint, metrics in endpoints:
+            lines.append(
+                f'pdga_requests_in_flight{{{service},endpoint="{endpoint}"}} {metrics["in_flight"]}'
+            )
+
+    lines += [
+        "# HELP pdga_usage_logs_total Usage logs by outcome.",
+        "# TYPE pdga_usage_logs_total counter",
+    ]
+    for outcome, count in usage_log_stats.items():
+        lines.append(f'pdga_usage_logs_total{{{service},outcome="{outcome}"}} {count}')
+
+    lines += [
+        "# HELP pdga_mongodb_pool MongoDB connection pool of this process.",
+        "# TYPE pdga_mongodb_pool gauge",
+    ]
+    for name, value in storage.pool_metrics.snapshot().items():
+        lines.append(f'pdga_mongodb_pool{{{service},metric="{name}"}} {value}')
+
+    return "\n".join(lines) + "\n"
+
+
+def start_tracing_memory(frames: int = 1):
+    """Starts tracemalloc for a memory profile or measurement, unless it is already
+    tracing. Every call is paired with stop_tracing_memory.
+
+    Args:
+        frames (int, optional): frames of each allocation's traceback to store, if
+            tracing is started. Defaults to 1.
+    """
+    global memory_tracing_users, memory_tracing_started
+    with memory_tracing_lock:
+        if memory_tracing_users == 0:
+            memory_tracing_started = not tracemalloc.is_tracing()
+            if memory_tracing_started:
+                tracemalloc.start(frames)
+        memory_tracing_users += 1
+
+
+def stop_tracing_memory():
+    """Stops tracemalloc once the last profile or measurement tracing memory is done,
+    if one of them started it. Tracing started elsewhere is left running."""
+    global memory_tracing_users
+    with memory_tracing_lock:
+        memory_tracing_users -= 1
+        if memory_tracing_users == 0 and memory_tracing_started:
+            tracemalloc.stop()
+
+
+def fold_stack(frame) -> str:
+    """Folds a thread's stack into a single line, outermost frame first, in the format
+    flamegraph.pl and speedscope read.
+
+    Args:
+        frame: innermost frame of the thread
+
+    Returns:
+        str: frames separated by semicolons
+    """
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(
+            f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        )
+        frame = frame.f_back
+    return ";".join(reversed(frames))
+
+
+class Profiler:
+    """Profiles either the next given number of requests or every thread for a time
+    window. Requests are profiled with cProfile, and the stacks of the profiled threads
+    are sampled every PROFILE_SAMPLE_INTERVAL seconds for a flamegraph. With memory
+    profiling, tracemalloc snapshots are taken at the start and at the end and diffed.
+    """
+
+    def __init__(
+        self, requests: int = None, seconds: float = None, memory: bool = False
+    ):
+        self.remaining = requests
+        self.deadline = time.monotonic() + seconds if seconds else None
+        self.memory = memory
+        self.started = datetime.now()
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.threads = set()
+        self.requests = 0
+        self.stats = None
+        self.samples = collections.Counter()
+        self.snapshot = None
+        if memory:
+            start_tracing_memory(25)
+            self.snapshot = tracemalloc.take_snapshot()
+        self.sampler = threading.Thread(
+            target=self.sample, name="profiler", daemon=True
+        )
+        self.sampler.start()
+
+    def sample(self):
+        """Samples the stacks of the profiled threads until the profiler finishes."""
+        own_thread = threading.get_ident()
+        while not self.done.is_set():
+            for thread, frame in sys._current_frames().items():
+                if thread == own_thread:
+                    continue
+                if self.remaining is not None and thread not in self.threads:
+                    continue
+                self.samples[fold_stack(frame)] += 1
+            if self.deadline is not None and time.monotonic() >= self.deadline:
+                finish_profiling()
+                return
+            self.done.wait(PROFILE_SAMPLE_INTERVAL)
+
+    def start_request(self):
+        """Starts profiling the current request if any requests are still to be profiled.
+
+        Returns:
+            cProfile.Profile: the request's profile, or None if it is not profiled
+        """
+        with self.lock:
+            if self.remaining is not None:
+                if self.remaining <= 0:
+                    return None
+                self.remaining -= 1
+            self.threads.add(threading.get_ident())
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:  # another profiler is already active in this thread
+            profile = None
+        return profile
+
+    def finish_request(self, profile):
+        """Adds a finished request's profile to the results.
+
+        Args:
+            profile (cProfile.Profile): the request's profile
+        """
+        if profile is not None:
+            profile.disable()
+        with self.lock:
+            self.threads.discard(threading.get_ident())
+            self.requests += 1
+            if profile is not None:
+                if self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+            finished = self.remaining == 0 and not self.threads
+        if finished:
+            finish_profiling()
+
+    def result(self) -> dict:
+        """Stops sampling and collects the results.
+
+        Returns:
+            dict: cProfile statistics, folded stacks and tracemalloc diff
+        """
+        self.done.set()
+        result = {
+            "started": self.started,
+            "finished": datetime.now(),
+            "requests": self.requests,
+            "pstats": None,
+            "folded": "\n".join(
+                f"{stack} {count}" for stack, count in self.samples.most_common()
+            ),
+            "memory": None,
+        }
+        if self.stats is not None:
+            output = io.StringIO()
+            self.stats.stream = output
+            self.stats.sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+            result["pstats"] = output.getvalue()
+        if self.memory:
+            snapshot = tracemalloc.take_snapshot()
+            stop_tracing_memory()
+            result["memory"] = [
+                {
+                    "location": str(stat.traceback[0]),
+                    "size": stat.size,
+                    "size_diff": stat.size_diff,
+                    "count_diff": stat.count_diff,
+                }
+                for stat in snapshot.compare_to(self.snapshot, "lineno")[
+                    :PROFILE_TOP_FUNCTIONS
+                ]
+            ]
+        return result
+
+
+def finish_profiling() -> dict:
+    """Stops the active profiler, if any, and keeps its results.
+
+    Returns:
+        dict: results of the last profile, None if nothing has been profiled
+    """
+    global profiler, profile_result
+    with profiler_lock:
+        active, profiler = profiler, None
+    if active is not None:
+        profile_result = active.result()
+    return profile_result
+
+
+@blueprint.before_app_request
+def start_request_profile():
+    # A single global read when profiling is off
+    active = profiler
+    if active is not None and request.endpoint != "monitoring.profile":
+        g.profile = (active, active.start_request())
+
+
+@blueprint.teardown_app_request
+def finish_request_profile(error=None):
+    profile = g.pop("profile", None)
+    if profile is not None and profile[1] is not None:
+        profile[0].finish_request(profile[1])
+
+
+@blueprint.route("/admin/profile", methods=["GET", "POST", "DELETE"])
+def profile():
+    """Profiles this service. POST starts profiling the next "requests" requests or
+    every thread for "seconds" seconds, with tracemalloc when "memory" is set. DELETE
+    stops early. GET returns the status or the results, with ?format=folded returning
+    just the folded stacks for flamegraph tools.
+
+    Returns:
+        JSON: 200 with the status or results
+              202 when profiling has started
+              400 when the request is invalid
+              409 when profiling is already running
+    """
+    global profiler
+    auth = request.authorization
+
+    if not auth or not check_auth(auth.username, auth.password):
+        return authenticate()
+
+    if request.method == "POST":
+        options = request.get_json(silent=True) or request.form
+        requests_to_profile = options.get("requests")
+        seconds = options.get("seconds")
+        try:
+            # Fewer than one request would never finish and profile every request
+            if requests_to_profile is not None:
+                if isinstance(requests_to_profile, (bool, float)):
+                    raise ValueError(requests_to_profile)
+                requests_to_profile = int(requests_to_profile)
+                if requests_to_profile < 1:
+                    raise ValueError(requests_to_profile)
+                requests_to_profile = min(requests_to_profile, PROFILE_MAX_REQUESTS)
+            if seconds is not None:
+                if isinstance(seconds, bool):
+                    raise ValueError(seconds)
+                seconds = float(seconds)
+                if not 0 < seconds < math.inf:
+                    raise ValueError(seconds)
+                seconds = min(seconds, PROFILE_MAX_SECONDS)
+        except (TypeError, ValueError):
+            return (
+                jsonify(
+                    {
+                        "error": "requests must be a whole number of at least 1 "
+                        "and seconds a positive number"
+                    }
+                ),
+                400,
+            )
+        if (requests_to_profile is None) == (seconds is None):
+            return jsonify({"error": "Give either requests or seconds"}), 400
+        memory = str(options.get("memory", "")).lower() in ["1", "true", "yes"]
+
+        with profiler_lock:
+            if profiler is not None:
+                return jsonify({"error": "Profiling is already running"}), 409
+            profiler = Profiler(requests_to_profile, seconds, memory)
+        return jsonify({"message": "Profiling started"}), 202
+
+    if request.method == "DELETE":
+        finish_profiling()
+
+    active = profiler
+    if active is not None:
+        return jsonify(
+            {
+                "running": True,
+                "started": active.started,
+                "requests": active.requests,
+                "remaining_requests": active.remaining,
+            }
+        )
+    if profile_result is None:
+        return jsonify({"running": False, "message": "Nothing has been profiled yet"})
+    if request.args.get("format") == "folded":
+        return Response(profile_result["folded"], mimetype="text/plain")
+    return jsonify({"running": False, **profile_result})
+
+
+@blueprint.route("/metrics", methods=["GET"])
+def metrics():
+    auth = request.authorization
+
+    if not auth or not check_auth(auth.username, auth.password):
+        return authenticate()
+
+    return Response(format_prometheus_metrics(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,735 @@
+import contextlib
+import json
+import os
+import pymongo
+import sqlite3
+import threading
+import time
+
+from datetime import datetime, timedelta
+
+from services.common.config import config
+from services.common.usage import (
+    USAGE_LOG_RETENTION,
+    build_usage_rollups,
+    ensure_usage_log_indexes,
+    get_usage_log_page,
+    get_usage_summary,
+    group_usage_logs,
+    summarize_usage_rollups,
+)
+
+"""
+The MongoDB client shared by the whole process and the repositories every service
+stores its data through. Each service subclasses MongoRepository and SQLiteRepository
+with the methods of its own data; the ones here store the usage logs, traces and
+pipeline locks.
+"""
+URI = config["mongodb"]["uri"]
+DB_NAME = config["mongodb"]["db_name"]
+MONGO_MAX_POOL_SIZE = config.getint("mongodb", "max_pool_size", fallback=None)
+MONGO_TIMEOUT_MS = config.getint("mongodb", "timeout_ms", fallback=None)
+MONGO_WRITE_CONCERN = config.get("mongodb", "write_concern", fallback=None)
+MONGO_READ_CONCERN = config.get("mongodb", "read_concern", fallback=None)
+STORAGE_BACKEND = config.get(
+    "storage", "backend", fallback="mongodb"
+)  # mongodb or sqlite
+STORAGE_SQLITE_PATH = config.get("storage", "sqlite_path", fallback="pdga.db")
+TRACE_COLLECTION = config.get("mongodb", "trace_collection", fallback="traces")
+LOCK_COLLECTION = config.get("mongodb", "lock_collection", fallback="locks")
+LOCK_LEASE = timedelta(seconds=config.getfloat("locks", "lease", fallback=300))
+
+app_name = "pdga"  # set by the service running in this process
+
+mongo_client = None
+mongo_client_pid = None
+mongo_client_lock = threading.Lock()
+repository = None
+repository_lock = threading.Lock()
+
+
+class PoolMetrics(pymongo.monitoring.ConnectionPoolListener):
+    """Keeps track of how the shared MongoClient's connection pool is used."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.check_out_started = {}
+        self.reset()
+
+    def reset(self):
+        """Clears every counter, e.g. in a freshly forked process."""
+        with self.lock:
+            self.check_out_started.clear()
+            self.checked_out = 0
+            self.open_connections = 0
+            self.check_outs = 0
+            self.check_out_failures = 0
+            self.wait_time = 0.0  # milliseconds
+            self.max_wait_time = 0.0  # milliseconds
+
+    def snapshot(self) -> dict:
+        """Returns the current pool metrics.
+
+        Returns:
+            dict: pool metrics, wait times in milliseconds
+        """
+        with self.lock:
+            return {
+                "checked_out": self.checked_out,
+                "open_connections": self.open_connections,
+                "check_outs": self.check_outs,
+                "check_out_failures": self.check_out_failures,
+                "average_wait_time": (
+                    round(self.wait_time / self.check_outs, 3) if self.check_outs else 0
+                ),
+                "max_wait_time": round(self.max_wait_time, 3),
+            }
+
+    def connection_check_out_started(self, event):
+        self.check_out_started[threading.get_ident()] = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        started = self.check_out_started.pop(threading.get_ident(), None)
+        wait_time = (time.perf_counter() - started) * 1000 if started else 0.0
+        with self.lock:
+            self.checked_out += 1
+            self.check_outs += 1
+            self.wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    def connection_check_out_failed(self, event):
+        self.check_out_started.pop(threading.get_ident(), None)
+        with self.lock:
+            self.check_out_failures += 1
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.checked_out -= 1
+
+    def connection_created(self, event):
+        with self.lock:
+            self.open_connections += 1
+
+    def connection_closed(self, event):
+        with self.lock:
+            self.open_connections -= 1
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+
+pool_metrics = PoolMetrics()
+
+
+def set_app_name(name: str):
+    """Names the process in the MongoDB client metadata and the Prometheus metrics.
+
+    Args:
+        name (str): name of the service, e.g., pdga-prediction
+    """
+    global app_name
+    app_name = name
+
+
+def get_mongo_client() -> pymongo.MongoClient:
+    """Returns the MongoClient shared by the whole process, creating it on first use.
+    A forked process gets its own client since connections cannot be shared across a fork.
+
+    Returns:
+        MongoClient: Instance of MongoDB
+    """
+    global mongo_client, mongo_client_pid
+    if mongo_client is None or mongo_client_pid != os.getpid():
+        with mongo_client_lock:
+            if mongo_client is None or mongo_client_pid != os.getpid():
+                options = {"appname": app_name, "event_listeners": [pool_metrics]}
+                if MONGO_MAX_POOL_SIZE:
+                    options["maxPoolSize"] = MONGO_MAX_POOL_SIZE
+                if MONGO_TIMEOUT_MS:
+                    options["connectTimeoutMS"] = MONGO_TIMEOUT_MS
+                    options["serverSelectionTimeoutMS"] = MONGO_TIMEOUT_MS
+                    options["waitQueueTimeoutMS"] = MONGO_TIMEOUT_MS
+                if MONGO_WRITE_CONCERN:
+                    options["w"] = (
+                        int(MONGO_WRITE_CONCERN)
+                        if MONGO_WRITE_CONCERN.isdigit()
+                        else MONGO_WRITE_CONCERN
+                    )
+                if MONGO_READ_CONCERN:
+                    options["readConcernLevel"] = MONGO_READ_CONCERN
+                mongo_client = pymongo.MongoClient(URI, **options)
+                mongo_client_pid = os.getpid()
+    return mongo_client
+
+
+def close_mongo_client():
+    """Closes the shared MongoClient. The next connection creates a new one."""
+    global mongo_client
+    with mongo_client_lock:
+        if mongo_client is not None and mongo_client_pid == os.getpid():
+            mongo_client.close()
+        mongo_client = None
+
+
+def reset_mongo_client_after_fork():
+    """Drops the parent's client and lock in a forked child without touching its sockets."""
+    global mongo_client, mongo_client_lock
+    mongo_client = None
+    mongo_client_lock = threading.Lock()
+    pool_metrics.lock = threading.Lock()
+    pool_metrics.reset()
+
+
+os.register_at_fork(after_in_child=reset_mongo_client_after_fork)
+
+
+def connect_to_mongodb() -> pymongo.MongoClient:
+    """Makes connection to MongoDB using the shared client
+
+    Returns:
+        MongoClient: Instance of MongoDB
+    """
+
+    return get_mongo_client()[DB_NAME]
+
+
+SQLITE_SCHEMA = """
+PRAGMA journal_mode=WAL;
+CREATE TABLE IF NOT EXISTS discs (
+    url TEXT PRIMARY KEY,
+    specs_version INTEGER,
+    created_at REAL NOT NULL,
+    document TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS predictions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    url TEXT NOT NULL UNIQUE,
+    manufacturer TEXT,
+    approved_month TEXT,
+    speed INTEGER,
+    glide INTEGER,
+    turn INTEGER,
+    fade INTEGER,
+    tweeted INTEGER NOT NULL DEFAULT 0,
+    document TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS predictions_untweeted ON predictions (id) WHERE tweeted = 0;
+CREATE INDEX IF NOT EXISTS predictions_manufacturer ON predictions (manufacturer);
+CREATE INDEX IF NOT EXISTS predictions_month ON predictions (approved_month, speed);
+CREATE TABLE IF NOT EXISTS manufacturer_rollups (
+    manufacturer TEXT PRIMARY KEY,
+    count INTEGER NOT NULL,
+    speed_sum INTEGER NOT NULL,
+    glide_sum INTEGER NOT NULL,
+    turn_sum INTEGER NOT NULL,
+    fade_sum INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS month_rollups (
+    month TEXT NOT NULL,
+    disc_class TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (month, disc_class)
+);
+CREATE TABLE IF NOT EXISTS usage_logs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    collection TEXT NOT NULL,
+    time REAL NOT NULL,
+    document TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS usage_logs_time ON usage_logs (collection, time);
+CREATE TABLE IF NOT EXISTS usage_rollups (
+    collection TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    granularity TEXT NOT NULL,
+    bucket REAL NOT NULL,
+    count INTEGER NOT NULL,
+    error_count INTEGER NOT NULL,
+    latency_sum REAL NOT NULL,
+    latency_min REAL NOT NULL,
+    latency_max REAL NOT NULL,
+    last_run REAL NOT NULL,
+    expire_at REAL,
+    PRIMARY KEY (collection, granularity, bucket, endpoint)
+);
+CREATE INDEX IF NOT EXISTS usage_rollups_expire_at ON usage_rollups (expire_at);
+CREATE TABLE IF NOT EXISTS spans (
+    span_id TEXT NOT NULL,
+    trace_id TEXT NOT NULL,
+    parent_span_id TEXT,
+    start_time INTEGER NOT NULL,
+    time REAL NOT NULL,
+    document TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS spans_trace ON spans (trace_id);
+CREATE INDEX IF NOT EXISTS spans_roots ON spans (start_time) WHERE parent_span_id IS NULL;
+CREATE INDEX IF NOT EXISTS spans_time ON spans (time);
+CREATE TABLE IF NOT EXISTS locks (
+    stage TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    acquired_at REAL NOT NULL,
+    expires_at REAL NOT NULL,
+    follow_up INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS charts (
+    key TEXT PRIMARY KEY,
+    flight_numbers TEXT NOT NULL,
+    svg BLOB NOT NULL,
+    png BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS models (
+    key TEXT PRIMARY KEY,
+    promoted_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS shadow_predictions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    model TEXT NOT NULL,
+    url TEXT NOT NULL,
+    document TEXT NOT NULL,
+    UNIQUE (model, url)
+);
+CREATE TABLE IF NOT EXISTS model_runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    candidate TEXT NOT NULL,
+    time REAL NOT NULL,
+    document TEXT NOT NULL
+);
+"""  # shared by every service using the database; bucket is 0 for all-time totals
+
+
+def encode_value(value):
+    """Serializes the values json does not know. Datetimes become {"$date": ...} so
+    that decode_document turns them back into datetimes."""
+    if isinstance(value, datetime):
+        return {"$date": value.isoformat()}
+    if hasattr(value, "item"):  # numpy scalars
+        return value.item()
+    return str(value)  # e.g., ObjectId
+
+
+def decode_value(value: dict):
+    if len(value) == 1 and "$date" in value:
+        return datetime.fromisoformat(value["$date"])
+    return value
+
+
+def encode_document(document: dict) -> str:
+    """Serializes a document for the SQLite repository.
+
+    Args:
+        document (dict): document as it would be stored in MongoDB
+
+    Returns:
+        str: JSON of the document
+    """
+    return json.dumps(document, default=encode_value)
+
+
+def decode_document(text: str) -> dict:
+    """Reads a document stored by encode_document.
+
+    Args:
+        text (str): JSON of the document
+
+    Returns:
+        dict: the document, with its datetimes
+    """
+    return json.loads(text, object_hook=decode_value)
+
+
+class MongoRepository:
+    """Stores the usage logs, traces and pipeline locks of the services in MongoDB.
+
+    Args:
+        db (Database, optional): database to use. Defaults to the one of the shared
+            MongoClient.
+    """
+
+    def __init__(self, db=None):
+        self._db = db
+        self.traces_indexed = False
+
+    def db(self):
+        return self._db if self._db is not None else connect_to_mongodb()
+
+    def insert_usage_logs(self, collection: str, logs: list):
+        """Stores usage logs and folds them into the usage rollups."""
+        db = self.db()
+        ensure_usage_log_indexes(db, collection)
+        db[collection].insert_many(logs, ordered=False)
+        db[f"{collection}_rollup"].bulk_write(build_usage_rollups(logs), ordered=False)
+
+    def usage_summary(self, collection: str) -> tuple:
+        """Returns the usage totals and hourly buckets as get_usage_summary does."""
+        return get_usage_summary(self.db(), collection)
+
+    def usage_log_page(
+        self, collection: str, before: datetime, limit: int, before_id: str = None
+    ) -> tuple:
+        """Returns a page of usage logs as get_usage_log_page does."""
+        return get_usage_log_page(self.db(), collection, before, limit, before_id)
+
+    def insert_spans(self, spans: list):
+        """Stores the spans of a trace, which expire along with the usage logs."""
+        collection = self.db()[TRACE_COLLECTION]
+        if not self.traces_indexed:
+            collection.create_index("traceId")
+            collection.create_index([("parentSpanId", 1), ("startTimeUnixNano", -1)])
+            collection.create_index(
+                "time", expireAfterSeconds=int(USAGE_LOG_RETENTION.total_seconds())
+            )
+            self.traces_indexed = True
+        collection.insert_many(
+            [
+                {
+                    **record,
+                    "time": datetime.fromtimestamp(record["startTimeUnixNano"] / 1e9),
+                }
+                for record in spans
+            ]
+        )
+
+    def recent_trace_ids(self, limit: int) -> list:
+        """Returns the ids of the traces whose root span started last, newest first."""
+        roots = self.db()[TRACE_COLLECTION].find({"parentSpanId": None}, {"traceId": 1})
+        return [
+            root["traceId"] for root in roots.sort("startTimeUnixNano", -1).limit(limit)
+        ]
+
+    def trace_spans(self, trace_ids: list) -> list:
+        """Returns every span of the given traces."""
+        return list(
+            self.db()[TRACE_COLLECTION].find(
+                {"traceId": {"$in": trace_ids}}, {"_id": 0}
+            )
+        )
+
+    def acquire_lock(self, stage: str, owner: str) -> bool:
+        """Takes a stage's lock unless another run holds an unexpired lease on it."""
+        now = datetime.now()
+        try:
+            self.db()[LOCK_COLLECTION].update_one(
+                {
+                    "_id": stage,
+                    "$or": [{"expires_at": {"$lte": now}}, {"owner": owner}],
+                },
+                {
+                    "$set": {
+                        "owner": owner,
+                        "acquired_at": now,
+                        "expires_at": now + LOCK_LEASE,
+                        "follow_up": False,
+                    }
+                },
+                upsert=True,
+            )
+        except pymongo.errors.DuplicateKeyError:  # held by another run
+            return False
+        return True
+
+    def request_follow_up(self, stage: str) -> bool:
+        """Flags a held lock for a follow-up run."""
+        result = self.db()[LOCK_COLLECTION].update_one(
+            {"_id": stage, "expires_at": {"$gt": datetime.now()}},
+            {"$set": {"follow_up": True}},
+        )
+        return result.matched_count == 1
+
+    def renew_lock(self, stage: str, owner: str) -> bool:
+        """Extends the lease of a held lock."""
+        result = self.db()[LOCK_COLLECTION].update_one(
+            {"_id": stage, "owner": owner},
+            {"$set": {"expires_at": datetime.now() + LOCK_LEASE}},
+        )
+        return result.matched_count == 1
+
+    def release_lock(self, stage: str, owner: str) -> bool:
+        """Releases a held lock, or keeps it for the follow-up run if one was requested."""
+        collection = self.db()[LOCK_COLLECTION]
+        if collection.delete_one(
+            {"_id": stage, "owner": owner, "follow_up": False}
+        ).deleted_count:
+            return False
+        result = collection.update_one(
+            {"_id": stage, "owner": owner, "follow_up": True},
+            {"$set": {"follow_up": False, "expires_at": datetime.now() + LOCK_LEASE}},
+        )
+        return result.matched_count == 1
+
+    def drop_lock(self, stage: str, owner: str):
+        """Releases a held lock, dropping any follow-up request."""
+        self.db()[LOCK_COLLECTION].delete_one({"_id": stage, "owner": owner})
+
+
+class SQLiteRepository:
+    """Stores the same data in an embedded SQLite database in WAL mode, for
+    single-node deployments without MongoDB. Documents are stored as JSON, next to
+    indexed columns for the fields they are queried by. Times are stored as Unix
+    timestamps, and expired rows are deleted as new ones are written.
+
+    Args:
+        path (str, optional): path of the database file. Defaults to
+            STORAGE_SQLITE_PATH.
+    """
+
+    def __init__(self, path: str = STORAGE_SQLITE_PATH):
+        self.path = path
+        self.local = threading.local()
+        self.connection().executescript(SQLITE_SCHEMA)
+
+    def connection(self) -> sqlite3.Connection:
+        """Returns the calling thread's connection, opening it on first use.
+        Connections are not shared between threads or carried over a fork."""
+        connection = getattr(self.local, "connection", None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA synchronous=NORMAL")  # durable enough with WAL
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Runs statements in one write transaction. It is taken up front, so that
+        concurrent writers wait for each other instead of failing."""
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def insert_usage_logs(self, collection: str, logs: list):
+        """Stores usage logs and folds them into the usage rollups."""
+        now = time.time()
+        rollups = [
+            (
+                collection,
+                endpoint,
+                granularity,
+                bucket.timestamp() if bucket else 0,
+                rollup["count"],
+                rollup["error_count"],
+                rollup["latency_sum"],
+                rollup["latency_min"],
+                rollup["latency_max"],
+                rollup["last_run"].timestamp(),
+                rollup["expire_at"].timestamp() if rollup["expire_at"] else None,
+            )
+            for (endpoint, granularity, bucket), rollup in group_usage_logs(
+                logs
+            ).items()
+        ]
+        with self.transaction() as connection:
+            connection.execute(
+                "DELETE FROM usage_logs WHERE collection = ? AND time < ?",
+                (collection, now - USAGE_LOG_RETENTION.total_seconds()),
+            )
+            connection.execute("DELETE FROM usage_rollups WHERE expire_at <= ?", (now,))
+            connection.executemany(
+                "INSERT INTO usage_logs (collection, time, document) VALUES (?, ?, ?)",
+                [
+                    (collection, log["time"].timestamp(), encode_document(log))
+                    for log in logs
+                ],
+            )
+            connection.executemany(
+                "INSERT INTO usage_rollups (collection, endpoint, granularity, bucket, "
+                "count, error_count, latency_sum, latency_min, latency_max, last_run, "
+                "expire_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (collection, granularity, bucket, endpoint) DO UPDATE SET "
+                "count = count + excluded.count, "
+                "error_count = error_count + excluded.error_count, "
+                "latency_sum = latency_sum + excluded.latency_sum, "
+                "latency_min = min(latency_min, excluded.latency_min), "
+                "latency_max = max(latency_max, excluded.latency_max), "
+                "last_run = max(last_run, excluded.last_run), "
+                "expire_at = excluded.expire_at",
+                rollups,
+            )
+
+    @staticmethod
+    def rollup(row: sqlite3.Row) -> dict:
+        rollup = dict(row)
+        rollup["bucket"] = (
+            datetime.fromtimestamp(rollup["bucket"]) if rollup["bucket"] else None
+        )
+        rollup["last_run"] = datetime.fromtimestamp(rollup["last_run"])
+        return rollup
+
+    def usage_summary(self, collection: str) -> tuple:
+        """Returns the usage totals and hourly buckets as get_usage_summary does."""
+        connection = self.connection()
+        totals = connection.execute(
+            "SELECT * FROM usage_rollups WHERE collection = ? AND granularity = 'total'",
+            (collection,),
+        )
+        hourly = connection.execute(
+            "SELECT * FROM usage_rollups WHERE collection = ? AND granularity = 'hour' "
+            "AND bucket >= ? ORDER BY bucket DESC, endpoint",
+            (collection, (datetime.now() - timedelta(hours=24)).timestamp()),
+        )
+        return summarize_usage_rollups(
+            [self.rollup(row) for row in totals], [self.rollup(row) for row in hourly]
+        )
+
+    def usage_log_page(
+        self, collection: str, before: datetime, limit: int, before_id: str = None
+    ) -> tuple:
+        """Returns a page of usage logs as get_usage_log_page does."""
+        last_id = int(before_id) if before_id is not None and before_id.isdigit() else 0
+        rows = (
+            self.connection()
+            .execute(
+                "SELECT id, document FROM usage_logs WHERE collection = ? "
+                "AND (time < ? OR (time = ? AND id < ?)) ORDER BY time DESC, id DESC LIMIT ?",
+                (collection, before.timestamp(), before.timestamp(), last_id, limit),
+            )
+            .fetchall()
+        )
+        entries = [decode_document(row["document"]) for row in rows]
+        next_before = None
+        if len(entries) == limit:
+            next_before = f"{entries[-1]['time'].isoformat()},{rows[-1]['id']}"
+        return entries, next_before
+
+    def insert_spans(self, spans: list):
+        """Stores the spans of a trace, which expire along with the usage logs."""
+        now = time.time()
+        with self.transaction() as connection:
+            connection.execute(
+                "DELETE FROM spans WHERE time < ?",
+                (now - USAGE_LOG_RETENTION.total_seconds(),),
+            )
+            connection.executemany(
+                "INSERT INTO spans (span_id, trace_id, parent_span_id, start_time, "
+                "time, document) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        record["spanId"],
+                        record["traceId"],
+                        record["parentSpanId"],
+                        record["startTimeUnixNano"],
+                        record["startTimeUnixNano"] / 1e9,
+                        encode_document(record),
+                    )
+                    for record in spans
+                ],
+            )
+
+    def recent_trace_ids(self, limit: int) -> list:
+        """Returns the ids of the traces whose root span started last, newest first."""
+        rows = self.connection().execute(
+            "SELECT trace_id FROM spans WHERE parent_span_id IS NULL "
+            "ORDER BY start_time DESC LIMIT ?",
+            (limit,),
+        )
+        return [row["trace_id"] for row in rows]
+
+    def trace_spans(self, trace_ids: list) -> list:
+        """Returns every span of the given traces."""
+        if not trace_ids:
+            return []
+        rows = self.connection().execute(
+            "SELECT document FROM spans WHERE trace_id IN "
+            f"({', '.join('?' * len(trace_ids))})",
+            trace_ids,
+        )
+        return [decode_document(row["document"]) for row in rows]
+
+    def acquire_lock(self, stage: str, owner: str) -> bool:
+        """Takes a stage's lock unless another run holds an unexpired lease on it."""
+        now = time.time()
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                "INSERT INTO locks (stage, owner, acquired_at, expires_at, follow_up) "
+                "VALUES (?, ?, ?, ?, 0) ON CONFLICT (stage) DO UPDATE SET "
+                "owner = excluded.owner, acquired_at = excluded.acquired_at, "
+                "expires_at = excluded.expires_at, follow_up = 0 "
+                "WHERE expires_at <= ? OR owner = ?",
+                (stage, owner, now, now + LOCK_LEASE.total_seconds(), now, owner),
+            )
+            return cursor.rowcount == 1
+
+    def request_follow_up(self, stage: str) -> bool:
+        """Flags a held lock for a follow-up run."""
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE locks SET follow_up = 1 WHERE stage = ? AND expires_at > ?",
+                (stage, time.time()),
+            )
+            return cursor.rowcount == 1
+
+    def renew_lock(self, stage: str, owner: str) -> bool:
+        """Extends the lease of a held lock."""
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE locks SET expires_at = ? WHERE stage = ? AND owner = ?",
+                (time.time() + LOCK_LEASE.total_seconds(), stage, owner),
+            )
+            return cursor.rowcount == 1
+
+    def release_lock(self, stage: str, owner: str) -> bool:
+        """Releases a held lock, or keeps it for the follow-up run if one was requested."""
+        with self.transaction() as connection:
+            if connection.execute(
+                "DELETE FROM locks WHERE stage = ? AND owner = ? AND follow_up = 0",
+                (stage, owner),
+            ).rowcount:
+                return False
+            cursor = connection.execute(
+                "UPDATE locks SET follow_up = 0, expires_at = ? "
+                "WHERE stage = ? AND owner = ? AND follow_up = 1",
+                (time.time() + LOCK_LEASE.total_seconds(), stage, owner),
+            )
+            return cursor.rowcount == 1
+
+    def drop_lock(self, stage: str, owner: str):
+        """Releases a held lock, dropping any follow-up request."""
+        with self.transaction() as connection:
+            connection.execute(
+                "DELETE FROM locks WHERE stage = ? AND owner = ?", (stage, owner)
+            )
+
+
+def create_repository(mongo_class=MongoRepository, sqlite_class=SQLiteRepository):
+    """Creates the repository of the configured storage backend.
+
+    Args:
+        mongo_class (type, optional): MongoRepository or a service's subclass of it
+        sqlite_class (type, optional): SQLiteRepository or a service's subclass of it
+
+    Returns:
+        MongoRepository | SQLiteRepository: the repository
+    """
+    if STORAGE_BACKEND == "sqlite":
+        return sqlite_class(STORAGE_SQLITE_PATH)
+    return mongo_class()
+
+
+def get_repository():
+    """Returns the repository the usage logs, traces and locks are written through,
+    creating it on first use.
+
+    Returns:
+        MongoRepository | SQLiteRepository: the repository
+    """
+    global repository
+    with repository_lock:
+        if repository is None:
+            repository = create_repository()
+        return repository
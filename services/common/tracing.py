@@ -0,0 +1,282 @@
+import contextlib
+import contextvars
+import re
+import secrets
+import time
+
+from datetime import datetime
+from flask import Blueprint, jsonify, make_response, render_template, request
+from functools import wraps
+
+from services.common.auth import authenticate, check_auth
+from services.common.storage import get_repository
+
+"""
+Traces of the pipeline runs. Every service records its part of a run as spans, which
+join into one trace across services through the X-Trace-Id and X-Parent-Span-Id
+headers and the jobs they publish. The pipeline services register the blueprint,
+which lays the recent traces out as waterfalls on /admin/traces.
+"""
+TRACE_ID_HEADER = "X-Trace-Id"
+PARENT_SPAN_ID_HEADER = "X-Parent-Span-Id"
+TRACE_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+SPAN_ID_PATTERN = re.compile(r"[0-9a-f]{16}")
+RECENT_TRACES_LIMIT = 10
+
+blueprint = Blueprint("tracing", __name__)
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class Trace:
+    """Spans recorded by a service while handling one step of a pipeline run. The
+    trace id and the id of the calling span arrive in the X-Trace-Id and
+    X-Parent-Span-Id headers, so the spans of every service join into one trace.
+
+    Args:
+        service (str): name of the service recording the spans, e.g., pdga-scraper
+        trace_id (str, optional): id of the trace to continue
+        parent_span_id (str, optional): id of the calling span
+    """
+
+    def __init__(self, service: str, trace_id: str = None, parent_span_id: str = None):
+        self.service = service
+        self.trace_id = trace_id or secrets.token_hex(16)
+        self.parent_span_id = parent_span_id
+        self.spans = []
+        self.stack = []
+
+    def headers(self) -> dict:
+        """Returns the headers that continue this trace in another service.
+
+        Returns:
+            dict: trace headers, with the innermost open span as the parent
+        """
+        headers = {TRACE_ID_HEADER: self.trace_id}
+        parent_span_id = self.stack[-1] if self.stack else self.parent_span_id
+        if parent_span_id:
+            headers[PARENT_SPAN_ID_HEADER] = parent_span_id
+        return headers
+
+
+def trace_headers() -> dict:
+    """Returns the headers that continue the current trace, if there is one.
+
+    Returns:
+        dict: trace headers for a service-to-service request
+    """
+    trace = current_trace.get()
+    return trace.headers() if trace is not None else {}
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    """Records the time spent in a block as a span of the current trace. Spans use the
+    OTLP field names so they can be exported as they are.
+
+    Args:
+        name (str): name of the stage e.g., fetch_data
+        **attributes: attributes of the span
+
+    Yields:
+        dict: attributes of the span, which the block may add to
+    """
+    trace = current_trace.get()
+    if trace is None:
+        yield dict(attributes)
+        return
+
+    record = {
+        "traceId": trace.trace_id,
+        "spanId": secrets.token_hex(8),
+        "parentSpanId": trace.stack[-1] if trace.stack else trace.parent_span_id,
+        "name": name,
+        "service": trace.service,
+        "attributes": dict(attributes),
+        "status": {"code": "STATUS_CODE_OK"},
+        "startTimeUnixNano": time.time_ns(),
+    }
+    trace.stack.append(record["spanId"])
+    try:
+        yield record["attributes"]
+    except Exception as e:
+        record["status"] = {"code": "STATUS_CODE_ERROR", "message": str(e)}
+        raise
+    finally:
+        trace.stack.pop()
+        record["endTimeUnixNano"] = time.time_ns()
+        trace.spans.append(record)
+
+
+def write_trace(trace: Trace):
+    """Stores the spans of a trace, which expire along with the usage logs.
+
+    Args:
+        trace (Trace): the finished trace
+    """
+    if not trace.spans:
+        return
+    get_repository().insert_spans(trace.spans)
+
+
+def traced(name: str, service: str):
+    """Runs an endpoint as the root span of a trace, continuing the caller's trace when
+    the request carries trace headers, and stores the spans once it has finished.
+
+    Args:
+        name (str): name of the root span
+        service (str): name of the service the endpoint belongs to
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            trace_id = request.headers.get(TRACE_ID_HEADER, "")
+            parent_span_id = request.headers.get(PARENT_SPAN_ID_HEADER, "")
+            trace = Trace(
+                service,
+                trace_id if TRACE_ID_PATTERN.fullmatch(trace_id) else None,
+                parent_span_id if SPAN_ID_PATTERN.fullmatch(parent_span_id) else None,
+            )
+            token = current_trace.set(trace)
+            try:
+                with span(name, endpoint=request.path) as attributes:
+                    response = make_response(func(*args, **kwargs))
+                    attributes["status_code"] = response.status_code
+                response.headers[TRACE_ID_HEADER] = trace.trace_id
+                return response
+            finally:
+                current_trace.reset(token)
+                try:
+                    write_trace(trace)
+                except Exception as e:
+                    print(f"Error writing trace {trace.trace_id}: {e}")
+
+        return wrapper
+
+    return decorator
+
+
+def build_waterfall(spans: list) -> dict:
+    """Lays out the spans of one trace as a waterfall.
+
+    Args:
+        spans (list): spans of one trace
+
+    Returns:
+        dict: the trace with its spans in start order, each with its depth and its
+              offset and width as percentages of the whole trace
+    """
+    start = min(record["startTimeUnixNano"] for record in spans)
+    end = max(record["endTimeUnixNano"] for record in spans)
+    total = max(end - start, 1)
+    parents = {record["spanId"]: record["parentSpanId"] for record in spans}
+
+    rows = []
+    for record in sorted(spans, key=lambda record: record["startTimeUnixNano"]):
+        depth = 0
+        parent = record["parentSpanId"]
+        while parent in parents:
+            depth += 1
+            parent = parents[parent]
+        rows.append(
+            {
+                "name": record["name"],
+                "service": record["service"],
+                "attributes": record.get("attributes", {}),
+                "error": record["status"]["code"] == "STATUS_CODE_ERROR",
+                "depth": depth,
+                "duration": round(
+                    (record["endTimeUnixNano"] - record["startTimeUnixNano"]) / 1e6, 2
+                ),
+                "offset": round((record["startTimeUnixNano"] - start) / total * 100, 2),
+                "width": max(
+                    round(
+                        (record["endTimeUnixNano"] - record["startTimeUnixNano"])
+                        / total
+                        * 100,
+                        2,
+                    ),
+                    0.2,
+                ),
+            }
+        )
+    return {
+        "trace_id": spans[0]["traceId"],
+        "start": datetime.fromtimestamp(start / 1e9),
+        "duration": round(total / 1e6, 2),
+        "spans": rows,
+    }
+
+
+def to_otlp(spans: list) -> dict:
+    """Converts stored spans into an OTLP/JSON trace export.
+
+    Args:
+        spans (list): stored spans
+
+    Returns:
+        dict: OTLP/JSON ExportTraceServiceRequest
+    """
+    services = {}
+    for record in spans:
+        attributes = [
+            {"key": key, "value": {"stringValue": str(value)}}
+            for key, value in record.get("attributes", {}).items()
+        ]
+        services.setdefault(record["service"], []).append(
+            {
+                "traceId": record["traceId"],
+                "spanId": record["spanId"],
+                "parentSpanId": record["parentSpanId"] or "",
+                "name": record["name"],
+                "kind": 1,
+                "startTimeUnixNano": str(record["startTimeUnixNano"]),
+                "endTimeUnixNano": str(record["endTimeUnixNano"]),
+                "attributes": attributes,
+                "status": record["status"],
+            }
+        )
+    return {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": [
+                        {"key": "service.name", "value": {"stringValue": service}}
+                    ]
+                },
+                "scopeSpans": [
+                    {"scope": {"name": "pdga-flight-forecast"}, "spans": service_spans}
+                ],
+            }
+            for service, service_spans in services.items()
+        ]
+    }
+
+
+@blueprint.route("/admin/traces", methods=["GET"])
+def admin_traces():
+    auth = request.authorization
+
+    if not auth or not check_auth(auth.username, auth.password):
+        return authenticate()
+
+    repository = get_repository()
+    trace_id = request.args.get("trace_id")
+    if trace_id:
+        spans = repository.trace_spans([trace_id])
+        if request.args.get("format") == "otlp":
+            return jsonify(to_otlp(spans))
+        traces = [build_waterfall(spans)] if spans else []
+    else:
+        trace_ids = repository.recent_trace_ids(RECENT_TRACES_LIMIT)
+        spans_by_trace = {}
+        for record in repository.trace_spans(trace_ids):
+            spans_by_trace.setdefault(record["traceId"], []).append(record)
+        traces = [
+            build_waterfall(spans_by_trace[trace_id])
+            for trace_id in trace_ids
+            if trace_id in spans_by_trace
+        ]
+
+    return render_template("traces.html", traces=traces)
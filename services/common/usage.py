@@ -0,0 +1,407 @@
+import atexit
+import itertools
+import os
+import pymongo
+import queue
+import threading
+import time
+
+from bson import ObjectId
+from datetime import datetime, timedelta
+
+from services.common.config import config
+
+"""
+Usage logs of the services' endpoints and jobs. They are buffered and written in
+batches by a background writer, and folded into per-minute, per-hour and all-time
+rollups for the admin pages.
+"""
+USAGE_LOG_BATCH_SIZE = config.getint("usage_log", "batch_size", fallback=100)
+USAGE_LOG_FLUSH_INTERVAL = config.getfloat(
+    "usage_log", "flush_interval", fallback=5
+)  # seconds
+USAGE_LOG_QUEUE_SIZE = config.getint("usage_log", "queue_size", fallback=10000)
+USAGE_LOG_OVERFLOW_POLICY = config.get(
+    "usage_log", "overflow_policy", fallback="drop"
+)  # drop or sample
+USAGE_LOG_SAMPLE_RATE = config.getint("usage_log", "sample_rate", fallback=10)
+USAGE_LOG_RETENTION = timedelta(
+    days=config.getfloat("usage_log", "retention_days", fallback=30)
+)
+MINUTE_ROLLUP_RETENTION = timedelta(days=7)
+HOUR_ROLLUP_RETENTION = timedelta(days=365)
+ADMIN_LOG_PAGE_LIMIT = 1000
+
+usage_log_queue = queue.Queue(maxsize=USAGE_LOG_QUEUE_SIZE)
+usage_log_stop = threading.Event()
+usage_log_lock = threading.Lock()
+usage_log_writer = None
+usage_log_overflow_counter = itertools.count()
+usage_log_stats = {"written": 0, "failed": 0, "dropped": 0}
+usage_log_indexed = set()
+
+
+def write_usage_log(
+    repository,
+    collection: str,
+    endpoint: str,
+    method: str,
+    response_code: int,
+    response_message: str,
+    start_time: datetime.now,
+):
+    """Writes a usage log to the storage backend
+
+    Args:
+        repository: the repository to write the log to
+        collection (str): the colleciton within the database
+        endpoint (str): the endpoint called
+        method (str): the ReST method used to call the endpoint
+        response_code (int): the response code returned
+        response_message (str): the message returned
+        start_time (datetime): used to determine the response time of the endpoint
+    """
+    response_time = (datetime.now() - start_time).total_seconds() * 1000  # milliseconds
+    enqueue_usage_log(
+        repository,
+        collection,
+        {
+            "endpoint": endpoint,
+            "method": method,
+            "time": datetime.now(),
+            "response_code": response_code,
+            "response_message": response_message,
+            "response_time": response_time,
+        },
+    )
+
+
+def enqueue_usage_log(repository, collection: str, log: dict):
+    """Buffers a usage log for the background writer. When the buffer is full the log is
+    dropped, unless the overflow policy is "sample", in which case errors and one in
+    every USAGE_LOG_SAMPLE_RATE other logs replace the oldest buffered log.
+
+    Args:
+        repository: the repository to write the log to
+        collection (str): the collection within the database
+        log (dict): the usage log
+    """
+    start_usage_log_writer()
+    try:
+        usage_log_queue.put_nowait((repository, collection, log))
+        return
+    except queue.Full:
+        pass
+
+    keep = USAGE_LOG_OVERFLOW_POLICY == "sample" and (
+        log["response_code"] >= 500
+        or next(usage_log_overflow_counter) % USAGE_LOG_SAMPLE_RATE == 0
+    )
+    if keep:
+        try:
+            usage_log_queue.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            usage_log_queue.put_nowait((repository, collection, log))
+        except queue.Full:
+            pass
+    usage_log_stats["dropped"] += 1
+
+
+def write_usage_log_batch(batch: list):
+    """Writes buffered usage logs with one write per collection.
+
+    Args:
+        batch (list): (repository, collection, log) tuples
+    """
+    collections = {}
+    for repository, collection, log in batch:
+        collections.setdefault((repository, collection), []).append(log)
+    for (repository, collection), logs in collections.items():
+        try:
+            repository.insert_usage_logs(collection, logs)
+            usage_log_stats["written"] += len(logs)
+        except Exception as e:
+            usage_log_stats["failed"] += len(logs)
+            print(f"Error writing {len(logs)} usage logs to {collection}: {e}")
+
+
+def group_usage_logs(logs) -> dict:
+    """Pre-aggregates usage logs into per-minute, per-hour and all-time buckets per
+    endpoint, holding the count, error count and latency sum, min and max.
+
+    Args:
+        logs: usage logs as written by write_usage_log
+
+    Returns:
+        dict: the rollup of each (endpoint, granularity, bucket)
+    """
+    buckets = {}
+    for log in logs:
+        time_of_log = log["time"]
+        for granularity, bucket, retention in [
+            (
+                "minute",
+                time_of_log.replace(second=0, microsecond=0),
+                MINUTE_ROLLUP_RETENTION,
+            ),
+            (
+                "hour",
+                time_of_log.replace(minute=0, second=0, microsecond=0),
+                HOUR_ROLLUP_RETENTION,
+            ),
+            ("total", None, None),
+        ]:
+            rollup = buckets.setdefault(
+                (log["endpoint"], granularity, bucket),
+                {
+                    "count": 0,
+                    "error_count": 0,
+                    "latency_sum": 0.0,
+                    "latency_min": log["response_time"],
+                    "latency_max": log["response_time"],
+                    "last_run": time_of_log,
+                    "expire_at": bucket + retention if retention else None,
+                },
+            )
+            rollup["count"] += 1
+            rollup["error_count"] += 1 if log["response_code"] >= 500 else 0
+            rollup["latency_sum"] += log["response_time"]
+            rollup["latency_min"] = min(rollup["latency_min"], log["response_time"])
+            rollup["latency_max"] = max(rollup["latency_max"], log["response_time"])
+            rollup["last_run"] = max(rollup["last_run"], time_of_log)
+    return buckets
+
+
+def build_usage_rollups(logs) -> list:
+    """Builds the updates folding usage logs into the rollup collection.
+
+    Args:
+        logs: usage logs as written by write_usage_log
+
+    Returns:
+        list: UpdateOne operations folding the logs into the rollup collection
+    """
+    updates = []
+    for (endpoint, granularity, bucket), rollup in group_usage_logs(logs).items():
+        update = {
+            "$inc": {
+                "count": rollup["count"],
+                "error_count": rollup["error_count"],
+                "latency_sum": rollup["latency_sum"],
+            },
+            "$min": {"latency_min": rollup["latency_min"]},
+            "$max": {
+                "latency_max": rollup["latency_max"],
+                "last_run": rollup["last_run"],
+            },
+        }
+        if rollup["expire_at"] is not None:
+            update["$set"] = {"expire_at": rollup["expire_at"]}
+        updates.append(
+            pymongo.UpdateOne(
+                {"endpoint": endpoint, "granularity": granularity, "bucket": bucket},
+                update,
+                upsert=True,
+            )
+        )
+    return updates
+
+
+def ensure_usage_log_indexes(db, collection: str):
+    """Creates the TTL and lookup indexes of a usage log collection and its rollups once
+    per process. The first process to get here also folds the logs written before the
+    rollups existed into them.
+
+    Args:
+        db: the database holding the usage logs
+        collection (str): the usage log collection
+    """
+    if collection in usage_log_indexed:
+        return
+    rollups = db[f"{collection}_rollup"]
+    try:
+        db[collection].create_index(
+            "time", expireAfterSeconds=int(USAGE_LOG_RETENTION.total_seconds())
+        )
+        db[collection].create_index([("time", -1), ("_id", -1)])  # for paging
+        rollups.create_index([("granularity", 1), ("bucket", -1), ("endpoint", 1)])
+        rollups.create_index("expire_at", expireAfterSeconds=0)
+    except pymongo.errors.PyMongoError as e:
+        print(f"Error creating indexes for {collection}: {e}")
+
+    try:
+        rollups.insert_one({"_id": "backfilled", "time": datetime.now()})
+    except pymongo.errors.DuplicateKeyError:
+        pass
+    else:
+        projection = {"_id": 0, "endpoint": 1, "time": 1, "response_code": 1}
+        projection["response_time"] = 1
+        updates = build_usage_rollups(db[collection].find({}, projection))
+        if updates:
+            rollups.bulk_write(updates, ordered=False)
+    usage_log_indexed.add(collection)
+
+
+def get_usage_summary(db, collection: str) -> tuple:
+    """Reads the per-endpoint totals and the last day of hourly buckets from the rollups.
+
+    Args:
+        db: the database holding the usage logs
+        collection (str): the usage log collection
+
+    Returns:
+        tuple: (totals keyed by endpoint, hourly buckets newest first)
+    """
+    rollups = db[f"{collection}_rollup"]
+    since = datetime.now() - timedelta(hours=24)
+    return summarize_usage_rollups(
+        rollups.find({"granularity": "total"}),
+        rollups.find({"granularity": "hour", "bucket": {"$gte": since}}).sort(
+            [("bucket", -1), ("endpoint", 1)]
+        ),
+    )
+
+
+def summarize_usage_rollups(totals, hourly_rollups) -> tuple:
+    """Formats the all-time and hourly usage rollups for the admin page.
+
+    Args:
+        totals: the all-time rollup of each endpoint
+        hourly_rollups: hourly rollups, newest first
+
+    Returns:
+        tuple: (totals keyed by endpoint, hourly buckets newest first)
+    """
+    endpoint_data = {}
+    for rollup in totals:
+        endpoint_data[rollup["endpoint"]] = {
+            "count": rollup["count"],
+            "error_count": rollup["error_count"],
+            "last_run": rollup["last_run"],
+            "average_time": round(rollup["latency_sum"] / rollup["count"], 2),
+            "min_time": round(rollup["latency_min"], 2),
+            "max_time": round(rollup["latency_max"], 2),
+        }
+
+    hourly = [
+        {
+            "bucket": rollup["bucket"],
+            "endpoint": rollup["endpoint"],
+            "count": rollup["count"],
+            "error_count": rollup["error_count"],
+            "average_time": round(rollup["latency_sum"] / rollup["count"], 2),
+            "min_time": round(rollup["latency_min"], 2),
+            "max_time": round(rollup["latency_max"], 2),
+        }
+        for rollup in hourly_rollups
+    ]
+    return endpoint_data, hourly
+
+
+def parse_log_cursor(cursor: str) -> tuple:
+    """Splits a cursor of the raw usage logs into the time and the id of the last log
+    of the previous page. Cursors of just a time are accepted too.
+
+    Args:
+        cursor (str): the cursor, e.g., 2024-04-23T12:00:00,42
+
+    Returns:
+        tuple: (time, id or None)
+    """
+    before, _, before_id = cursor.partition(",")
+    return datetime.fromisoformat(before), before_id or None
+
+
+def get_usage_log_page(
+    db, collection: str, before: datetime, limit: int, before_id: str = None
+) -> tuple:
+    """Reads one page of raw usage logs, newest first, ordered by time and then id so
+    that logs written at the same time as the last one of a page are on the next page
+    rather than skipped.
+
+    Args:
+        db: the database holding the usage logs
+        collection (str): the usage log collection
+        before (datetime): time of the last log of the previous page
+        limit (int): maximum number of logs
+        before_id (str, optional): id of the last log of the previous page. Without
+            it only logs older than before are returned.
+
+    Returns:
+        tuple: (logs, cursor for the next page or None when this is the last one)
+    """
+    query = {"time": {"$lt": before}}
+    if before_id is not None and ObjectId.is_valid(before_id):
+        query = {"$or": [query, {"time": before, "_id": {"$lt": ObjectId(before_id)}}]}
+    entries = list(
+        db[collection].find(query).sort([("time", -1), ("_id", -1)]).limit(limit)
+    )
+    next_before = None
+    if len(entries) == limit:
+        next_before = f"{entries[-1]['time'].isoformat()},{entries[-1]['_id']}"
+    for entry in entries:
+        entry.pop("_id", None)
+    return entries, next_before
+
+
+def run_usage_log_writer():
+    """Flushes buffered usage logs whenever USAGE_LOG_BATCH_SIZE of them have queued up
+    or USAGE_LOG_FLUSH_INTERVAL seconds have passed, until the writer is stopped."""
+    while not usage_log_stop.is_set():
+        batch = []
+        deadline = time.monotonic() + USAGE_LOG_FLUSH_INTERVAL
+        while len(batch) < USAGE_LOG_BATCH_SIZE and not usage_log_stop.is_set():
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(usage_log_queue.get(timeout=min(timeout, 0.5)))
+            except queue.Empty:
+                pass
+        if batch:
+            write_usage_log_batch(batch)
+
+
+def start_usage_log_writer():
+    """Starts the background usage log writer if it is not already running."""
+    global usage_log_writer
+    if usage_log_writer is not None and usage_log_writer.is_alive():
+        return
+    with usage_log_lock:
+        if usage_log_writer is None or not usage_log_writer.is_alive():
+            usage_log_stop.clear()
+            usage_log_writer = threading.Thread(
+                target=run_usage_log_writer, name="usage-log-writer", daemon=True
+            )
+            usage_log_writer.start()
+
+
+def flush_usage_logs():
+    """Stops the background writer and writes every usage log still buffered. Runs at
+    shutdown; the writer restarts with the next usage log."""
+    with usage_log_lock:
+        usage_log_stop.set()
+        if usage_log_writer is not None and usage_log_writer.is_alive():
+            usage_log_writer.join(timeout=USAGE_LOG_FLUSH_INTERVAL + 1)
+        batch = []
+        while True:
+            try:
+                batch.append(usage_log_queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            write_usage_log_batch(batch)
+
+
+def reset_usage_log_writer_after_fork():
+    """Gives a forked child its own buffer; logs buffered by the parent stay with the parent."""
+    global usage_log_queue, usage_log_lock, usage_log_writer
+    usage_log_queue = queue.Queue(maxsize=USAGE_LOG_QUEUE_SIZE)
+    usage_log_lock = threading.Lock()
+    usage_log_writer = None
+
+
+os.register_at_fork(after_in_child=reset_usage_log_writer_after_fork)
+atexit.register(flush_usage_logs)
@@ -1,8 +1,50 @@
-import configparser
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import signal
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import pymongo
 
-from flask import Flask, render_template, request
+from flask import (
+    Blueprint,
+    Flask,
+    Response,
+    current_app,
+    jsonify,
+    render_template,
+    request,
+)
+
+from services.common import monitoring, storage
+from services.common.auth import authenticate, check_auth
+from services.common.config import config
+from services.common.monitoring import summarize_request_metrics
+from services.common.storage import (
+    STORAGE_BACKEND,
+    create_repository,
+    decode_document,
+    pool_metrics,
+    set_app_name,
+)
+from services.common.usage import (
+    ADMIN_LOG_PAGE_LIMIT,
+    parse_log_cursor,
+    write_usage_log,
+)
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
 
 
 """
@@ -10,76 +52,205 @@ Prediction service which pulls in a model from an S3 bucket, makes predictions o
 from the database created by the scraper service, and then uploads the predictions to 
 a new databse collection to be displayed on the frontend.
 """
-config = configparser.ConfigParser()
-config.read("config.ini")
-URI = config["mongodb"]["uri"]
-DB_NAME = config["mongodb"]["db_name"]
 PREDICTION_COLLECTION = config["mongodb"]["prediction_collection"]
 USAGE_COLLECTION = config["mongodb"]["frontend_usage"]
-ADMIN_USERNAME = config["admin"]["username"]
-ADMIN_PASSWORD = config["admin"]["password"]
+AGGREGATE_COLLECTION = config.get(
+    "mongodb", "aggregate_collection", fallback="prediction_aggregates"
+)
+CHART_COLLECTION = config.get("mongodb", "chart_collection", fallback="charts")
+APP_NAME = "pdga-frontend"
+REPLICA_POLL_INTERVAL = config.getfloat(
+    "frontend", "replica_poll_interval", fallback=30
+)  # seconds
+STATIC_EXPORT_PATH = config.get("static", "path", fallback="")  # empty disables it
+STATIC_RELEASES_KEPT = (
+    3  # including the current one, so older ones can be rolled back to
+)
+INDEX_CHUNK_SIZE = 64 * 1024  # bytes of HTML rendered and sent at a time
+SEARCH_RESULT_LIMIT = 50
+FUZZY_MATCH_THRESHOLD = 0.5  # share of query trigrams a fuzzy match must contain
+CHART_MIMETYPES = {"svg": "image/svg+xml", "png": "image/png"}
+PIPELINE_STAGES = [  # (stage, usage log collection, endpoints that run the stage)
+    ("scrape", config["mongodb"]["scraper_usage"], ["/scrape_and_store"]),
+    (
+        "predict",
+        config["mongodb"]["prediction_usage"],
+        ["/predict", "/jobs/discs_scraped"],
+    ),
+    (
+        "tweet",
+        config["mongodb"]["twitter_usage"],
+        ["/create_tweet", "/jobs/predictions_ready"],
+    ),
+    ("frontend", USAGE_COLLECTION, ["/"]),
+]
+PIPELINE_STATUSES = ["ok", "unknown", "unavailable", "failed"]  # from best to worst
+PIPELINE_DASHBOARD_TTL = config.getfloat(
+    "admin", "pipeline_cache_ttl", fallback=30
+)  # seconds
+CHART_MAX_AGE = 365 * 24 * 60 * 60  # seconds; a chart's key changes with its content
+DISPLAY_FIELDS = (
+    "manufacturer",
+    "name",
+    "url",
+    "approved_date",
+    "SPEED",
+    "GLIDE",
+    "TURN",
+    "FADE",
+    "max_weight",
+    "diameter",
+    "height",
+    "rim_depth",
+    "rim_thickness",
+    "inside_rim_diameter",
+    "rim_depth_diameter_ratio",
+    "rim_config",
+    "flexibility",
+    "chart",
+)
 
-app = Flask(__name__)
+blueprint = Blueprint("frontend", __name__)
 
+repository = None
+repository_lock = threading.Lock()
 
-def connect_to_mongodb() -> pymongo.MongoClient:
-    """Makes connection to MongoDB
 
-    Returns:
-        MongoClient: Instance of MongoDB
+prediction_snapshot = None
+replica_thread = None
+replica_lock = threading.Lock()
+
+page_cache = {"version": None, "page": None}
+page_cache_lock = threading.Lock()
+
+static_site = {"version": None, "release": None}
+static_site_lock = threading.Lock()
+
+pipeline_dashboard = {"built": 0.0, "dashboard": None}
+pipeline_dashboard_lock = threading.Lock()
+pipeline_build_lock = threading.Lock()
+pipeline_executor = None
+
+
+class MongoRepository(storage.MongoRepository):
+    """Reads the predictions, their statistics and the pipeline's usage logs from
+    MongoDB.
+
+    Args:
+        db (Database, optional): database to use. Defaults to the one of the shared
+            MongoClient.
     """
 
-    client = pymongo.MongoClient(URI)
+    def last_usage_log(self, collection: str, endpoints: list) -> dict:
+        """Returns the newest usage log of any of the endpoints, None if there is none."""
+        return self.db()[collection].find_one(
+            {"endpoint": {"$in": endpoints}}, {"_id": 0}, sort=[("time", -1)]
+        )
 
-    db = client[DB_NAME]
-    return db
+    def predictions_after(self, last_id) -> list:
+        """Returns the displayed fields of the predictions stored after the one with
+        this id, oldest first, or of every prediction if the id is None."""
+        query = {} if last_id is None else {"_id": {"$gt": last_id}}
+        projection = {field: 1 for field in DISPLAY_FIELDS}
+        return list(
+            self.db()[PREDICTION_COLLECTION].find(query, projection).sort("_id", 1)
+        )
 
+    def prediction_stats(self) -> list:
+        """Returns the per-manufacturer and per-month rollups of the predictions."""
+        return list(self.db()[AGGREGATE_COLLECTION].find({}, {"_id": 0, "updated": 0}))
 
-def check_auth(username, password):
-    """Check if a username and password are valid to view the admin page."""
-    return username == ADMIN_USERNAME and password == ADMIN_PASSWORD
+    def chart(self, key: str, image_format: str) -> bytes:
+        """Returns a flight chart as svg or png, None if it is not stored."""
+        chart = self.db()[CHART_COLLECTION].find_one({"_id": key}, {image_format: 1})
+        return None if chart is None else bytes(chart[image_format])
 
 
-def authenticate():
-    """Send a 401 response that enables basic auth."""
-    return (
-        "Unauthorized access. Please provide valid credentials.",
-        401,
-        {"WWW-Authenticate": 'Basic realm="Login Required"'},
-    )
+class SQLiteRepository(storage.SQLiteRepository):
+    """Reads the same data from the embedded SQLite database, for single-node
+    deployments without MongoDB.
 
+    Args:
+        path (str, optional): path of the database file. Defaults to
+            STORAGE_SQLITE_PATH.
+    """
 
-def write_usage_log(
-    db: pymongo.MongoClient,
-    collection: str,
-    endpoint: str,
-    method: str,
-    response_code: int,
-    response_message: str,
-    start_time: datetime.now,
-):
-    """Writes a log to MongoDB database
-
-    Args:
-        db (pymongo.MongoClient): the database to write the log to
-        collection (str): the colleciton within the database
-        endpoint (str): the endpoint called
-        method (str): the ReST method used to call the endpoint
-        response_code (int): the response code returned
-        response_message (str): the message returned
-        start_time (datetime): used to determine the response time of the endpoint
-    """
-    response_time = (datetime.now() - start_time).total_seconds() * 1000  # milliseconds
-    db[collection].insert_one(
-        {
-            "endpoint": endpoint,
-            "method": method,
-            "time": datetime.now(),
-            "response_code": response_code,
-            "response_message": response_message,
-            "response_time": response_time,
-        }
-    )
+    def last_usage_log(self, collection: str, endpoints: list) -> dict:
+        """Returns the newest usage log of any of the endpoints, None if there is none."""
+        row = (
+            self.connection()
+            .execute(
+                "SELECT document FROM usage_logs WHERE collection = ? AND "
+                f"json_extract(document, '$.endpoint') IN "
+                f"({', '.join('?' * len(endpoints))}) ORDER BY time DESC LIMIT 1",
+                (collection, *endpoints),
+            )
+            .fetchone()
+        )
+        return None if row is None else decode_document(row["document"])
+
+    def predictions_after(self, last_id) -> list:
+        """Returns the displayed fields of the predictions stored after the one with
+        this id, oldest first, or of every prediction if the id is None."""
+        rows = self.connection().execute(
+            "SELECT id, document FROM predictions WHERE id > ? ORDER BY id",
+            (last_id or 0,),
+        )
+        predictions = []
+        for row in rows:
+            prediction = decode_document(row["document"])
+            predictions.append(
+                {
+                    "_id": row["id"],
+                    **{
+                        field: prediction[field]
+                        for field in DISPLAY_FIELDS
+                        if field in prediction
+                    },
+                }
+            )
+        return predictions
+
+    def prediction_stats(self) -> list:
+        """Returns the per-manufacturer and per-month rollups of the predictions,
+        which the prediction service keeps up to date as it stores them."""
+        connection = self.connection()
+        stats = [
+            {
+                "type": "manufacturer",
+                **dict(row),
+                "manufacturer": row["manufacturer"] or None,
+            }
+            for row in connection.execute("SELECT * FROM manufacturer_rollups")
+        ]
+        stats += [
+            {"type": "month", **dict(row)}
+            for row in connection.execute("SELECT * FROM month_rollups")
+        ]
+        return stats
+
+    def chart(self, key: str, image_format: str) -> bytes:
+        """Returns a flight chart as svg or png, None if it is not stored."""
+        row = (
+            self.connection()
+            .execute("SELECT svg, png FROM charts WHERE key = ?", (key,))
+            .fetchone()
+        )
+        return None if row is None else bytes(row[image_format])
+
+
+def get_repository():
+    """Returns the repository of the configured storage backend, creating it on first
+    use.
+
+    Returns:
+        MongoRepository | SQLiteRepository: the repository
+    """
+    global repository
+    with repository_lock:
+        if repository is None:
+            repository = create_repository(MongoRepository, SQLiteRepository)
+        return repository
 
 
 def prepare_for_table(input_dict: dict) -> dict:
@@ -91,10 +262,16 @@ def prepare_for_table(input_dict: dict) -> dict:
     Returns:
         dict: data in the same structure as it is passed in as with the updated data type
     """
+    specs = input_dict.get("specs")
     for key, value in input_dict.items():
 
         if key in "approved_date":
-            date_object = datetime.strptime(value, "%b %d, %Y").date()
+            if isinstance(specs, dict) and specs.get("approved_date") is not None:
+                value = specs["approved_date"]  # typed by the scraper
+            if isinstance(value, datetime):
+                date_object = value.date()
+            else:
+                date_object = datetime.strptime(value, "%b %d, %Y").date()
             input_dict[key] = date_object
     return input_dict
 
@@ -111,66 +288,957 @@ def format_date(date_time) -> str:
     return date_time.strftime("%Y-%m-%d")
 
 
-@app.route("/")
+class DiscRow:
+    """Compact, read-only row of the prediction table. Only the displayed fields are kept."""
+
+    __slots__ = DISPLAY_FIELDS
+
+    def __init__(self, disc: dict):
+        for field in DISPLAY_FIELDS:
+            value = disc.get(field, "")
+            if field == "approved_date" and isinstance(value, datetime):
+                value = format_date(value)
+            object.__setattr__(self, field, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("DiscRow is read-only")
+
+
+def tokenize(text: str) -> list:
+    """Splits text into lowercase alphanumeric search tokens.
+
+    e.g., "Innova Champion Destroyer" -> ["innova", "champion", "destroyer"]
+
+    Args:
+        text (str): text to tokenize
+
+    Returns:
+        list: tokens in order of appearance
+    """
+    return re.findall(r"[a-z0-9]+", str(text).lower())
+
+
+def trigrams(token: str) -> set:
+    """Builds the trigrams of a token, padded so that short tokens still produce some.
+
+    Args:
+        token (str): search token
+
+    Returns:
+        set: trigrams of the token
+    """
+    padded = f"  {token} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+class SearchIndex:
+    """Append-only prefix and trigram index over disc manufacturer and name. Postings
+    are row positions in ascending order and are only ever appended to, so a snapshot
+    holding fewer rows simply ignores the positions past its end."""
+
+    __slots__ = ("prefixes", "trigrams")
+
+    def __init__(self):
+        self.prefixes = {}
+        self.trigrams = {}
+
+    def add(self, position: int, text: str):
+        """Indexes the text of the row at the given position.
+
+        Args:
+            position (int): position of the row in the snapshot
+            text (str): text to make searchable
+        """
+        prefixes = set()
+        grams = set()
+        for token in tokenize(text):
+            prefixes.update(token[:end] for end in range(1, len(token) + 1))
+            grams.update(trigrams(token))
+        for prefix in prefixes:
+            self.prefixes.setdefault(prefix, []).append(position)
+        for gram in grams:
+            self.trigrams.setdefault(gram, []).append(position)
+
+    def match_token(self, token: str, size: int) -> dict:
+        """Scores the rows matching a single query token. Prefix matches score 1, and
+        only when there are none are rows scored by the share of trigrams they have in
+        common with the token, which tolerates typos.
+
+        Args:
+            token (str): query token
+            size (int): number of rows visible to the caller
+
+        Returns:
+            dict: score keyed by row position
+        """
+        scores = {}
+        for position in self.prefixes.get(token, ()):
+            if position >= size:
+                break
+            scores[position] = 1.0
+        if scores:
+            return scores
+
+        grams = trigrams(token)
+        for gram in grams:
+            for position in self.trigrams.get(gram, ()):
+                if position >= size:
+                    break
+                scores[position] = scores.get(position, 0) + 1
+        threshold = FUZZY_MATCH_THRESHOLD * len(grams)
+        return {
+            position: 0.5 * count / len(grams)
+            for position, count in scores.items()
+            if count >= threshold
+        }
+
+    def search(self, query: str, size: int, limit: int) -> list:
+        """Finds the rows matching every token of the query.
+
+        Args:
+            query (str): search query
+            size (int): number of rows visible to the caller
+            limit (int): maximum number of results
+
+        Returns:
+            list: row positions, best match first
+        """
+        totals = None
+        for token in tokenize(query):
+            scores = self.match_token(token, size)
+            if totals is None:
+                totals = scores
+            else:
+                totals = {
+                    position: total + scores[position]
+                    for position, total in totals.items()
+                    if position in scores
+                }
+            if not totals:
+                return []
+        if totals is None:
+            return []
+        return sorted(totals, key=lambda position: -totals[position])[:limit]
+
+
+class PredictionSnapshot:
+    """Immutable view of the prediction collection. New data produces a new snapshot
+    which replaces the previous one in a single assignment, so readers never lock."""
+
+    __slots__ = ("rows", "last_id", "index")
+
+    def __init__(self, rows: tuple = (), last_id=None, index: SearchIndex = None):
+        self.rows = rows
+        self.last_id = last_id
+        self.index = index if index is not None else SearchIndex()
+
+    @property
+    def version(self) -> str:
+        """str: version stamp of the snapshot, changes whenever rows are added"""
+        return f"{self.last_id}-{len(self.rows)}"
+
+    def extend(self, discs: list) -> "PredictionSnapshot":
+        """Builds a new snapshot with the given prediction documents appended. The search
+        index is shared with this snapshot and updated in place, so only the newest
+        snapshot should be extended.
+
+        Args:
+            discs (list): prediction documents sorted by _id
+
+        Returns:
+            PredictionSnapshot: new snapshot, or this one if there is nothing to add
+        """
+        if not discs:
+            return self
+        new_rows = tuple(DiscRow(disc) for disc in discs)
+        for position, row in enumerate(new_rows, start=len(self.rows)):
+            self.index.add(position, f"{row.manufacturer} {row.name}")
+        return PredictionSnapshot(self.rows + new_rows, discs[-1]["_id"], self.index)
+
+    def search(self, query: str, limit: int) -> list:
+        """Finds the discs whose manufacturer or name match the query.
+
+        Args:
+            query (str): search query, matched by token prefix or fuzzily
+            limit (int): maximum number of results
+
+        Returns:
+            list: matching rows, best match first
+        """
+        return [
+            self.rows[position]
+            for position in self.index.search(query, len(self.rows), limit)
+        ]
+
+
+def sync_predictions(repository, snapshot: PredictionSnapshot) -> PredictionSnapshot:
+    """Pulls the predictions newer than the last one in the snapshot.
+
+    Args:
+        repository: the repository holding the predictions
+        snapshot (PredictionSnapshot): the current snapshot
+
+    Returns:
+        PredictionSnapshot: snapshot including any new predictions
+    """
+    return snapshot.extend(repository.predictions_after(snapshot.last_id))
+
+
+def refresh_prediction_snapshot(repository) -> PredictionSnapshot:
+    """Incrementally refreshes the in-memory replica and swaps in the new snapshot.
+
+    Args:
+        repository: the repository holding the predictions
+
+    Returns:
+        PredictionSnapshot: the current snapshot
+    """
+    global prediction_snapshot
+    with replica_lock:
+        snapshot = sync_predictions(
+            repository, prediction_snapshot or PredictionSnapshot()
+        )
+        prediction_snapshot = snapshot
+    return snapshot
+
+
+def run_replica_sync():
+    """Keeps the in-memory replica, and the static site when it is enabled, up to
+    date. Change streams are used as a wake-up signal when the deployment supports
+    them, otherwise the collection is polled."""
+    while True:
+        try:
+            repository = get_repository()
+            if STORAGE_BACKEND == "sqlite":
+                while True:
+                    sync_replica(repository)
+                    time.sleep(REPLICA_POLL_INTERVAL)
+            collection = repository.db()[PREDICTION_COLLECTION]
+            try:
+                with collection.watch(
+                    [{"$match": {"operationType": "insert"}}],
+                    max_await_time_ms=int(REPLICA_POLL_INTERVAL * 1000),
+                ) as stream:
+                    sync_replica(repository)
+                    while stream.alive:
+                        if stream.try_next() is not None:
+                            sync_replica(repository)
+            except pymongo.errors.OperationFailure:
+                # Standalone deployments do not support change streams
+                while True:
+                    sync_replica(repository)
+                    time.sleep(REPLICA_POLL_INTERVAL)
+        except Exception as e:
+            print(f"Error syncing the prediction replica: {e}")
+            time.sleep(REPLICA_POLL_INTERVAL)
+
+
+def sync_replica(repository) -> PredictionSnapshot:
+    """Refreshes the replica and exports the static site when it has changed.
+
+    Args:
+        repository: the repository holding the predictions
+
+    Returns:
+        PredictionSnapshot: the current snapshot
+    """
+    snapshot = refresh_prediction_snapshot(repository)
+    try:
+        export_static_site(snapshot)
+    except Exception as e:
+        print(f"Error exporting the static site: {e}")
+    return snapshot
+
+
+def start_replica_sync():
+    """Starts the background replica sync thread if it is not already running."""
+    global replica_thread
+    with replica_lock:
+        if replica_thread is None or not replica_thread.is_alive():
+            replica_thread = threading.Thread(
+                target=run_replica_sync, name="prediction-replica", daemon=True
+            )
+            replica_thread.start()
+
+
+def get_prediction_snapshot() -> PredictionSnapshot:
+    """Returns the current snapshot, loading it on first use.
+
+    Returns:
+        PredictionSnapshot: the current snapshot
+    """
+    snapshot = prediction_snapshot
+    if snapshot is None:
+        snapshot = refresh_prediction_snapshot(get_repository())
+        start_replica_sync()
+    return snapshot
+
+
+class IndexPage:
+    """The disc table of a snapshot, rendered in chunks of about INDEX_CHUNK_SIZE bytes
+    and compressed for every supported encoding as it goes. Requests stream the page
+    while it is being rendered: every request for the snapshot reads the same chunks,
+    and whichever one needs the next chunk renders it, so the page is rendered once
+    however many requests arrive meanwhile. Once finished it is served from memory.
+    When rendering fails, every request reading the page fails with it, so that no
+    one is sent a truncated page as if it were complete.
+
+    Args:
+        snapshot (PredictionSnapshot): the predictions to render
+        etag (str): entity tag of the page
+    """
+
+    def __init__(self, snapshot: PredictionSnapshot, etag: str):
+        self.version = snapshot.version
+        self.count = len(snapshot.rows)
+        self.etag = etag
+        self.pieces = current_app.jinja_env.get_template("index.html").generate(
+            discs=snapshot.rows
+        )
+        self.lock = threading.Lock()
+        self.done = False
+        self.error = None
+        self.chunks = {"identity": [], "gzip": []}
+        self.compressors = {"gzip": zlib.compressobj(9, zlib.DEFLATED, 31)}
+        if brotli is not None:
+            self.chunks["br"] = []
+            self.compressors["br"] = brotli.Compressor()
+
+    def render_chunk(self):
+        """Renders the next chunk of the page, or finishes the compressed streams
+        when everything has been rendered."""
+        buffer, size = [], 0
+        for piece in self.pieces:
+            buffer.append(piece.encode("utf-8"))
+            size += len(buffer[-1])
+            if size >= INDEX_CHUNK_SIZE:
+                break
+        if not buffer:
+            self.chunks["gzip"].append(self.compressors["gzip"].flush())
+            if "br" in self.compressors:
+                self.chunks["br"].append(self.compressors["br"].finish())
+            self.done = True
+            return
+        chunk = b"".join(buffer)
+        self.chunks["identity"].append(chunk)
+        # Flushed so that every chunk can be sent as soon as it is rendered
+        compressor = self.compressors["gzip"]
+        self.chunks["gzip"].append(
+            compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        )
+        if "br" in self.compressors:
+            compressor = self.compressors["br"]
+            self.chunks["br"].append(compressor.process(chunk) + compressor.flush())
+
+    def chunk(self, encoding: str, position: int) -> bytes:
+        """Returns a chunk of the page in an encoding, rendering it if needed.
+
+        Returns:
+            bytes: the chunk, None when the page has no more chunks
+        """
+        chunks = self.chunks[encoding]
+        if position >= len(chunks) and not self.done:
+            with self.lock:
+                while position >= len(chunks) and not self.done:
+                    if self.error is not None:  # the template's generator is spent
+                        raise RuntimeError("The index page failed to render")
+                    try:
+                        self.render_chunk()
+                    except Exception as e:
+                        self.error = e
+                        with page_cache_lock:  # the next request starts over
+                            if page_cache["page"] is self:
+                                page_cache.update({"version": None, "page": None})
+                        raise
+        return chunks[position] if position < len(chunks) else None
+
+    def stream(self, encoding: str):
+        """Yields the chunks of the page in an encoding as they are rendered."""
+        position = 0
+        while True:
+            chunk = self.chunk(encoding, position)
+            if chunk is None:
+                return
+            yield chunk
+            position += 1
+
+
+def index_page_etag(snapshot: PredictionSnapshot) -> str:
+    """Tags the page of a snapshot before it is rendered. The page only changes with
+    the snapshot's version and the template, so a hash of the two identifies it."""
+    env = current_app.jinja_env
+    source, _, _ = env.loader.get_source(env, "index.html")
+    return hashlib.sha1(f"{snapshot.version}:{source}".encode("utf-8")).hexdigest()
+
+
+def get_index_page() -> IndexPage:
+    """Returns the index page, starting to render it again only when the replica has
+    received new predictions.
+
+    Returns:
+        IndexPage: the page, which may still be rendering
+    """
+    snapshot = get_prediction_snapshot()
+    page = page_cache["page"]
+    if (
+        page is not None
+        and page.error is None
+        and page_cache["version"] == snapshot.version
+    ):
+        return page
+    with page_cache_lock:
+        page = page_cache["page"]
+        if (
+            page is None
+            or page.error is not None
+            or page_cache["version"] != snapshot.version
+        ):
+            page_cache["page"] = IndexPage(snapshot, index_page_etag(snapshot))
+            page_cache["version"] = snapshot.version
+        return page_cache["page"]
+
+
+def build_page_response(page: IndexPage) -> Response:
+    """Builds the response for the index page, honoring Accept-Encoding and
+    If-None-Match. A page that is still rendering is streamed as it is rendered.
+
+    Args:
+        page (IndexPage): the page
+
+    Returns:
+        Response: 304 when the client already has the page, otherwise the encoded page
+    """
+    encoding = "identity"
+    for candidate in ("br", "gzip"):
+        if candidate in page.chunks and request.accept_encodings[candidate]:
+            encoding = candidate
+            break
+
+    # Each encoding is its own representation, so it gets its own entity tag
+    etag = page.etag if encoding == "identity" else f"{page.etag}-{encoding}"
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    elif page.done:
+        chunks = page.chunks[encoding]
+        response = Response(chunks, mimetype="text/html")
+        response.content_length = sum(len(chunk) for chunk in chunks)
+    else:
+        # The stream does not need the request, so it is not kept around for it
+        response = Response(page.stream(encoding), mimetype="text/html")
+    if encoding != "identity" and response.status_code == 200:
+        response.headers["Content-Encoding"] = encoding
+
+    response.set_etag(etag)
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+def content_hash(content: bytes) -> str:
+    return hashlib.sha1(content).hexdigest()[:12]
+
+
+def disc_slug(row: DiscRow) -> str:
+    """Names a disc's page after the last part of its PDGA URL.
+
+    e.g., https://www.pdga.com/.../discs/destroyer -> destroyer
+    """
+    name = (
+        str(row.url).rstrip("/").rsplit("/", 1)[-1] or f"{row.manufacturer} {row.name}"
+    )
+    return re.sub(r"[^a-z0-9]+", "-", name.lower()).strip("-") or "disc"
+
+
+def build_static_site(snapshot: PredictionSnapshot, charts: dict = None) -> dict:
+    """Renders the disc table, a JSON file of the predictions and a page per disc,
+    and adds the flight charts of the discs. Everything but index.html is named after
+    a hash of its content, so it can be cached forever. The JSON file and the pages
+    are also written pre-compressed.
+
+    Args:
+        snapshot (PredictionSnapshot): the predictions to render
+        charts (dict, optional): SVG flight chart of each chart key
+
+    Returns:
+        dict: content of each file keyed by its path in the site
+    """
+    files = {f"charts/{key}.svg": chart for key, chart in (charts or {}).items()}
+
+    def add(name: str, extension: str, content: bytes) -> str:
+        path = f"{name}.{content_hash(content)}.{extension}"
+        files[path] = content
+        files[f"{path}.gz"] = gzip.compress(content, compresslevel=9)
+        if brotli is not None:
+            files[f"{path}.br"] = brotli.compress(content)
+        return path
+
+    data = json.dumps(
+        [
+            {field: getattr(row, field) for field in DISPLAY_FIELDS}
+            for row in snapshot.rows
+        ],
+        default=str,
+    ).encode("utf-8")
+    data_url = add("predictions", "json", data)
+
+    disc_pages = []
+    with app.app_context():
+        for row in snapshot.rows:
+            page = render_template(
+                "disc.html", disc=row, chart_url="../charts/"
+            ).encode("utf-8")
+            disc_pages.append(add(f"discs/{disc_slug(row)}", "html", page))
+        html = render_template(
+            "index.html",
+            discs=snapshot.rows,
+            data_url=data_url,
+            disc_pages=disc_pages,
+            chart_url="charts/",
+        ).encode("utf-8")
+    files["index.html"] = html
+    files["index.html.gz"] = gzip.compress(html, compresslevel=9)
+    if brotli is not None:
+        files["index.html.br"] = brotli.compress(html)
+    return files
+
+
+def publish_static_site(files: dict, path: str) -> str:
+    """Writes the files of a site into a new release under path/releases and then
+    points the path/current symlink at it. The symlink is swapped with a rename, so
+    a web server serving path/current sees either the old site or the new one, never
+    a mix. Only the newest STATIC_RELEASES_KEPT releases are kept.
+
+    Args:
+        files (dict): content of each file keyed by its path in the site
+        path (str): directory holding the releases and the current symlink
+
+    Returns:
+        str: directory of the release
+    """
+    releases = os.path.join(path, "releases")
+    name = content_hash(files["index.html"])  # index.html names every other file
+    release = os.path.join(releases, name)
+    if not os.path.isdir(release):
+        staging = os.path.join(releases, f".{name}-{os.getpid()}")
+        for file_path, content in files.items():
+            target = os.path.join(staging, file_path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, "wb") as file:
+                file.write(content)
+        os.replace(staging, release)
+
+    current = os.path.join(path, "current")
+    link = os.path.join(path, f".current-{os.getpid()}")
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.join("releases", name), link)
+    os.replace(link, current)
+
+    os.utime(release)  # the current release is always the newest
+    kept = sorted(
+        (
+            entry
+            for entry in os.scandir(releases)
+            if entry.is_dir() and not entry.name.startswith(".")
+        ),
+        key=lambda entry: entry.stat().st_mtime,
+        reverse=True,
+    )
+    for entry in kept[STATIC_RELEASES_KEPT:]:
+        shutil.rmtree(entry.path, ignore_errors=True)
+    return release
+
+
+def export_static_site(snapshot: PredictionSnapshot) -> str:
+    """Exports the predictions to STATIC_EXPORT_PATH as a static site, unless it is
+    not set or the snapshot has already been exported.
+
+    Args:
+        snapshot (PredictionSnapshot): the predictions to export
+
+    Returns:
+        str: directory of the release, None when nothing was exported
+    """
+    if not STATIC_EXPORT_PATH:
+        return None
+    with static_site_lock:
+        if static_site["version"] == snapshot.version:
+            return None
+        repository = get_repository()
+        charts = {}
+        for key in {row.chart for row in snapshot.rows if row.chart}:
+            chart = repository.chart(key, "svg")
+            if chart is not None:
+                charts[key] = chart
+        release = publish_static_site(
+            build_static_site(snapshot, charts), STATIC_EXPORT_PATH
+        )
+        static_site["version"] = snapshot.version
+        static_site["release"] = release
+    print(f"Exported {len(snapshot.rows)} discs to {release}")
+    return release
+
+
+@blueprint.route("/")
 def index():
     start_time = datetime.now()
-    db = connect_to_mongodb()
-    discs_cursor = db[PREDICTION_COLLECTION].find()
+    page = get_index_page()
+    response = build_page_response(page)
+
+    # Logged once the body has been sent, so that a page streamed while it is
+    # rendered is timed with its rendering
+    repository = get_repository()
+    message = f"Number of discs: {page.count}"
+    status = response.status_code
+    response.call_on_close(
+        lambda: write_usage_log(
+            repository, USAGE_COLLECTION, "/", "GET", status, message, start_time
+        )
+    )
+    return response
+
+
+@blueprint.route("/charts/<key>.<image_format>", methods=["GET"])
+def flight_chart(key, image_format):
+    """Serves a flight chart from the chart cache. The key changes with the chart, so
+    browsers may keep it forever."""
+    chart = None
+    if image_format in CHART_MIMETYPES:
+        chart = get_repository().chart(key, image_format)
+    if chart is None:
+        return jsonify({"error": "Flight chart not found"}), 404
+    response = Response(chart, mimetype=CHART_MIMETYPES[image_format])
+    response.headers["Cache-Control"] = f"public, max-age={CHART_MAX_AGE}, immutable"
+    return response
+
+
+@blueprint.route("/api/search", methods=["GET"])
+def search():
+    start_time = datetime.now()
+    query = request.args.get("q", "")
+    limit = min(max(request.args.get("limit", 10, type=int), 1), SEARCH_RESULT_LIMIT)
+
+    rows = get_prediction_snapshot().search(query, limit)
+    results = [
+        {
+            field: getattr(row, field)
+            for field in (
+                "manufacturer",
+                "name",
+                "url",
+                "SPEED",
+                "GLIDE",
+                "TURN",
+                "FADE",
+            )
+        }
+        for row in rows
+    ]
+
+    message = f"{len(results)} results for '{query}'"
+    write_usage_log(
+        get_repository(),
+        USAGE_COLLECTION,
+        "/api/search",
+        "GET",
+        200,
+        message,
+        start_time,
+    )
+    return jsonify({"query": query, "results": results})
+
+
+def format_rollup(rollup: dict) -> dict:
+    """Turns a stored rollup into its public form, deriving averages from the sums.
+
+    Args:
+        rollup (dict): rollup document from the aggregate collection
+
+    Returns:
+        dict: rollup with averages in place of sums
+    """
+    if rollup["type"] == "manufacturer":
+        return {
+            "manufacturer": rollup["manufacturer"],
+            "count": rollup["count"],
+            **{
+                f"average_{flight_number}": round(
+                    rollup[f"{flight_number}_sum"] / rollup["count"], 2
+                )
+                for flight_number in ["speed", "glide", "turn", "fade"]
+            },
+        }
+    return {
+        "month": rollup["month"],
+        "disc_class": rollup["disc_class"],
+        "count": rollup["count"],
+    }
+
+
+@blueprint.route("/api/stats", methods=["GET"])
+def stats():
+    start_time = datetime.now()
+    repository = get_repository()
+
+    stats = {"manufacturers": [], "months": []}
+    for rollup in repository.prediction_stats():
+        key = "manufacturers" if rollup["type"] == "manufacturer" else "months"
+        stats[key].append(format_rollup(rollup))
+    stats["manufacturers"].sort(key=lambda item: -item["count"])
+    stats["months"].sort(key=lambda item: (item["month"], item["disc_class"]))
+
+    message = f"{len(stats['manufacturers'])} manufacturers, {len(stats['months'])} month groups"
+    write_usage_log(
+        repository, USAGE_COLLECTION, "/api/stats", "GET", 200, message, start_time
+    )
+    return jsonify(stats)
+
+
+def get_pipeline_executor() -> ThreadPoolExecutor:
+    """Returns the threads the pipeline dashboard queries the stages with, creating
+    them on first use."""
+    global pipeline_executor
+    with pipeline_dashboard_lock:
+        if pipeline_executor is None:
+            pipeline_executor = ThreadPoolExecutor(
+                max_workers=len(PIPELINE_STAGES), thread_name_prefix="pipeline"
+            )
+        return pipeline_executor
+
+
+def load_pipeline_stage(repository, collection: str, endpoints: list) -> dict:
+    """Reads the usage rollups of a stage's service and the log of its last run.
+
+    Args:
+        repository (MongoRepository | SQLiteRepository): where the usage logs are
+        collection (str): usage log collection of the service
+        endpoints (list): endpoints that run the stage
+
+    Returns:
+        dict: totals keyed by endpoint, hourly buckets and the last run's log
+    """
+    totals, hourly = repository.usage_summary(collection)
+    return {
+        "totals": totals,
+        "hourly": hourly,
+        "last_log": repository.last_usage_log(collection, endpoints),
+    }
+
+
+def merge_pipeline_stage(stage: str, endpoints: list, usage: dict) -> dict:
+    """Merges the usage of the endpoints that run a stage into one row of the
+    pipeline dashboard.
+
+    Args:
+        stage (str): name of the stage
+        endpoints (list): endpoints that run the stage
+        usage (dict): the stage's usage, as load_pipeline_stage reads it
+
+    Returns:
+        dict: status and totals of the stage, with its hourly buckets keyed by hour
+    """
+    totals = [
+        usage["totals"][endpoint]
+        for endpoint in endpoints
+        if endpoint in usage["totals"]
+    ]
+    count = sum(total["count"] for total in totals)
+    hourly = {}
+    for bucket in usage["hourly"]:
+        if bucket["endpoint"] not in endpoints:
+            continue
+        hour = hourly.setdefault(
+            bucket["bucket"], {"count": 0, "error_count": 0, "latency_sum": 0.0}
+        )
+        hour["count"] += bucket["count"]
+        hour["error_count"] += bucket["error_count"]
+        hour["latency_sum"] += bucket["average_time"] * bucket["count"]
+    for hour in hourly.values():
+        hour["average_time"] = round(hour.pop("latency_sum") / hour["count"], 2)
+
+    last_log = usage["last_log"]
+    if last_log is not None:
+        status = "failed" if last_log["response_code"] >= 500 else "ok"
+        last_run = last_log["time"]
+    else:  # never run, or its logs have expired
+        status = "unknown"
+        last_run = max((total["last_run"] for total in totals), default=None)
+    return {
+        "stage": stage,
+        "status": status,
+        "last_run": last_run,
+        "last_response_code": last_log["response_code"] if last_log else None,
+        "last_message": last_log["response_message"] if last_log else None,
+        "count": count,
+        "error_count": sum(total["error_count"] for total in totals),
+        "average_time": (
+            round(
+                sum(total["average_time"] * total["count"] for total in totals) / count,
+                2,
+            )
+            if count
+            else None
+        ),
+        "errors_last_day": sum(hour["error_count"] for hour in hourly.values()),
+        "hourly": hourly,
+    }
+
 
-    discs = [
+def build_pipeline_dashboard(repository) -> dict:
+    """Queries the usage of every pipeline stage at the same time and merges it into
+    one view of the pipeline. A stage whose usage cannot be read is shown as
+    unavailable instead of failing the dashboard.
+
+    Args:
+        repository (MongoRepository | SQLiteRepository): where the usage logs are
+
+    Returns:
+        dict: overall status, a row per stage and the last day of hourly latency and
+            errors per stage, newest first
+    """
+    executor = get_pipeline_executor()
+    futures = [
         (
-            {**disc, "approved_date": format_date(disc["approved_date"])}
-            if "approved_date" in disc and isinstance(disc["approved_date"], datetime)
-            else disc
+            stage,
+            endpoints,
+            executor.submit(load_pipeline_stage, repository, collection, endpoints),
         )
-        for disc in discs_cursor
+        for stage, collection, endpoints in PIPELINE_STAGES
     ]
+    stages = []
+    hours = {}
+    for stage, endpoints, future in futures:
+        try:
+            row = merge_pipeline_stage(stage, endpoints, future.result())
+        except Exception as e:
+            print(f"Error reading the usage of the {stage} stage: {e}")
+            row = {
+                "stage": stage,
+                "status": "unavailable",
+                "error": str(e),
+                "hourly": {},
+            }
+        for bucket, hour in row.pop("hourly").items():
+            hours.setdefault(bucket, {})[stage] = hour
+        stages.append(row)
+
+    return {
+        "built": datetime.now(),
+        "status": max((row["status"] for row in stages), key=PIPELINE_STATUSES.index),
+        "errors_last_day": sum(row.get("errors_last_day", 0) for row in stages),
+        "stages": stages,
+        "hourly": [
+            {"bucket": bucket, "stages": hours[bucket]}
+            for bucket in sorted(hours, reverse=True)
+        ],
+    }
 
-    message = f"Number of discs: {len(discs)}"
-    write_usage_log(db, USAGE_COLLECTION, "/", "GET", 200, message, start_time)
-    return render_template("index.html", discs=discs)
 
+def get_pipeline_dashboard() -> dict:
+    """Returns the pipeline dashboard, built at most once every
+    PIPELINE_DASHBOARD_TTL seconds. Requests that arrive while it is being built wait
+    for it instead of querying the stages again."""
+    with pipeline_dashboard_lock:
+        built, dashboard = pipeline_dashboard["built"], pipeline_dashboard["dashboard"]
+    if dashboard is not None and time.monotonic() - built < PIPELINE_DASHBOARD_TTL:
+        return dashboard
+    with pipeline_build_lock:
+        if pipeline_dashboard["dashboard"] is dashboard:  # not rebuilt meanwhile
+            dashboard = build_pipeline_dashboard(get_repository())
+            with pipeline_dashboard_lock:
+                pipeline_dashboard["built"] = time.monotonic()
+                pipeline_dashboard["dashboard"] = dashboard
+        return pipeline_dashboard["dashboard"]
+
+
+@blueprint.route("/admin/pipeline", methods=["GET"])
+def admin_pipeline():
+    """Shows the health of the whole pipeline on one page: the last run of each
+    stage, its errors and its latency over the last day. With format=json the same
+    data is returned as JSON."""
+    auth = request.authorization
+
+    if not auth or not check_auth(auth.username, auth.password):
+        return authenticate()
+
+    dashboard = get_pipeline_dashboard()
+    if request.args.get("format") == "json":
+        return jsonify(dashboard)
+    return render_template(
+        "pipeline.html",
+        dashboard=dashboard,
+        stages=[stage for stage, _, _ in PIPELINE_STAGES],
+        ttl=PIPELINE_DASHBOARD_TTL,
+    )
 
-@app.route("/admin", methods=["GET"])
+
+@blueprint.route("/admin", methods=["GET"])
 def admin():
     auth = request.authorization
 
     if not auth or not check_auth(auth.username, auth.password):
         return authenticate()
 
-    db = connect_to_mongodb()
-    collection = db[USAGE_COLLECTION]
+    try:
+        before, before_id = parse_log_cursor(request.args["before"])
+    except (KeyError, ValueError):
+        before, before_id = datetime.now(), None
+    limit = min(max(request.args.get("limit", 100, type=int), 1), ADMIN_LOG_PAGE_LIMIT)
 
-    pipeline = [
-        {
-            "$group": {
-                "_id": "$endpoint",
-                "count": {"$sum": 1},
-                "last_run": {"$max": "$time"},
-                "average_time": {
-                    "$avg": "$response_time"
-                },  # Calculate average response time
-            }
-        },
-    ]
+    repository = get_repository()
+    endpoint_data, hourly = repository.usage_summary(USAGE_COLLECTION)
+    entries, next_before = repository.usage_log_page(
+        USAGE_COLLECTION, before, limit, before_id
+    )
 
-    aggregation_result = list(collection.aggregate(pipeline))
+    return render_template(
+        "admin.html",
+        endpoint_data=endpoint_data,
+        hourly=hourly,
+        log=entries,
+        next_before=next_before,
+        limit=limit,
+        pool=pool_metrics.snapshot(),
+        process_metrics=summarize_request_metrics(),
+    )
 
-    endpoint_data = {
-        item["_id"]: {
-            "count": item["count"],
-            "last_run": item["last_run"],
-            "average_time": (
-                round(item["average_time"], 2) if item["average_time"] else 0
-            ),  # Round to 2 decimal places
-        }
-        for item in aggregation_result
-    }
 
-    all_entries = list(collection.find({}, {"_id": 0}).sort("time", -1))
+def create_app() -> Flask:
+    """Creates the Flask app of the service. Heavy dependencies and clients are
+    created on first use, so this is quick.
 
-    return render_template("admin.html", endpoint_data=endpoint_data, log=all_entries)
+    Returns:
+        Flask: the app
+    """
+    set_app_name(APP_NAME)
+    app = Flask(__name__)
+    app.register_blueprint(blueprint)
+    app.register_blueprint(monitoring.blueprint)
+    return app
+
+
+app = create_app()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves the PDGA Flight Forecast site")
+    parser.add_argument(
+        "--export-static",
+        action="store_true",
+        help="export the static site to the [static] path and exit",
+    )
+    args = parser.parse_args()
+
+    if args.export_static:
+        if not STATIC_EXPORT_PATH:
+            sys.exit("Set path in the [static] section of config.ini first")
+        export_static_site(refresh_prediction_snapshot(get_repository()))
+        print(f"Static site published to {os.path.join(STATIC_EXPORT_PATH, 'current')}")
+        sys.exit(0)
+
+    # Exit normally on SIGTERM so that buffered usage logs are flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if STATIC_EXPORT_PATH:  # export new predictions without waiting for a visitor
+        start_replica_sync()
     app.run()
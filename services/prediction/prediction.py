@@ -1,16 +1,69 @@
-import boto3
-import configparser
-import joblib
-import numpy as np
-import pandas as pd
+from __future__ import annotations
+
+import argparse
+import contextlib
+import gc
+import hashlib
+import json
+import math
 import pymongo
 import os
 import re
-import requests
-
+import secrets
+import socket
+import signal
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+import zlib
+
+from bson import ObjectId
 from datetime import datetime
-from flask import Flask, jsonify, render_template, request
-from functools import wraps
+from flask import Blueprint, Flask, jsonify, render_template, request
+
+from services.common import monitoring, storage, tracing
+from services.common.auth import authenticate, check_auth, verify_api_key
+from services.common.config import config
+from services.common.jobs import (
+    EVENT_DISCS_SCRAPED,
+    EVENT_PREDICTIONS_READY,
+    get_job_queue,
+    publish_event,
+    start_job_worker,
+)
+from services.common.lazy import LazyModule
+from services.common.locks import check_lock, run_exclusively
+from services.common.monitoring import (
+    start_tracing_memory,
+    stop_tracing_memory,
+    summarize_request_metrics,
+)
+from services.common.storage import (
+    connect_to_mongodb,
+    create_repository,
+    decode_document,
+    encode_document,
+    pool_metrics,
+    set_app_name,
+)
+from services.common.tracing import span, traced
+from services.common.usage import (
+    ADMIN_LOG_PAGE_LIMIT,
+    flush_usage_logs,
+    parse_log_cursor,
+    write_usage_log,
+)
+
+boto3 = LazyModule("boto3")
+joblib = LazyModule("joblib")
+np = LazyModule("numpy")
+pd = LazyModule("pandas")
+pa = LazyModule("pyarrow")
+pq = LazyModule("pyarrow.parquet")
 
 
 """
@@ -18,10 +71,6 @@ Prediction service which pulls in a model from an S3 bucket, makes predictions o
 from the database created by the scraper service, and then uploads the predictions to 
 a new databse collection to be displayed on the frontend.
 """
-config = configparser.ConfigParser()
-config.read("config.ini")
-URI = config["mongodb"]["uri"]
-DB_NAME = config["mongodb"]["db_name"]
 SCRAPER_COLLECTION = config["mongodb"]["scraper_collection"]
 PREDICTION_COLLECTION = config["mongodb"]["prediction_collection"]
 ACCESS_KEY = config["tebi"]["access_key"]
@@ -29,89 +78,556 @@ SECRET_KEY = config["tebi"]["secret_key"]
 ENDPOINT_URL = config["tebi"]["endpoint_url"]
 BUCKET_NAME = config["tebi"]["bucket_name"]
 USAGE_COLLECTION = config["mongodb"]["prediction_usage"]
-ADMIN_USERNAME = config["admin"]["username"]
-ADMIN_PASSWORD = config["admin"]["password"]
-LOCAL_MODEL_NAME = "model.pkl"
+AGGREGATE_COLLECTION = config.get(
+    "mongodb", "aggregate_collection", fallback="prediction_aggregates"
+)
+APP_NAME = "pdga-prediction"
+CHART_COLLECTION = config.get("mongodb", "chart_collection", fallback="charts")
+MODEL_COLLECTION = config.get("mongodb", "model_collection", fallback="models")
+SHADOW_COLLECTION = config.get(
+    "mongodb", "shadow_collection", fallback="shadow_predictions"
+)
+MODEL_RUN_COLLECTION = config.get(
+    "mongodb", "model_run_collection", fallback="model_runs"
+)
+MODEL_DIR = "models"  # a file per version of a model, named by model_path
+MODEL_CACHE_SIZE = 2  # model files kept, e.g. the active model and the candidate
+SHADOW_MODE = config.getboolean(
+    "prediction", "shadow", fallback=False
+)  # predict with the promoted model and score the newest one next to it
+MODEL_FEATURES = {  # disc field: feature name the model was trained with
+    "diameter": "DIAMETER (cm)",
+    "height": "HEIGHT (cm)",
+    "rim_depth": "RIM DEPTH (cm)",
+    "inside_rim_diameter": "INSIDE RIM DIAMETER (cm)",
+    "rim_depth_diameter_ratio": "RIM DEPTH / DIAMETER RATION (%)",
+    "rim_config": "RIM CONFIGURATION",
+}
+DISC_SPECS = {  # scraped field: typed field in the specs the scraper stores with it
+    "max_weight": "max_weight_gr",
+    "diameter": "diameter_cm",
+    "height": "height_cm",
+    "rim_depth": "rim_depth_cm",
+    "rim_thickness": "rim_thickness_cm",
+    "inside_rim_diameter": "inside_rim_diameter_cm",
+    "rim_depth_diameter_ratio": "rim_depth_diameter_ratio_pct",
+    "rim_config": "rim_config",
+    "flexibility": "flexibility_kg",
+}
+WARM_UP_DISC = [21.1, 1.4, 1.1, 16.7, 5.2, 36.5]  # measurements of a typical disc
+SERVER_WORKERS = int(
+    os.environ.get(
+        "PREDICTION_WORKERS", config.get("prediction", "workers", fallback=0)
+    )
+)  # 0 runs the development server. PREDICTION_WORKERS overrides config.ini
+SERVER_THREADS_PER_WORKER = config.getint(
+    "prediction", "threads_per_worker", fallback=0
+)  # 0 splits the CPUs between the workers
+SNAPSHOT_PATH = config.get(
+    "snapshots", "path", fallback=""
+)  # directory of the Parquet snapshots. Empty turns them off
+SNAPSHOT_MANIFEST = "manifest.json"
+FLIGHT_NUMBERS = ["SPEED", "GLIDE", "TURN", "FADE"]
+SIMILARITY_INDEX_PATH = os.path.join(MODEL_DIR, "similarity_index.pkl")
+SIMILARITY_FEATURES = [
+    "diameter",
+    "height",
+    "rim_depth",
+    "inside_rim_diameter",
+    "rim_depth_diameter_ratio",
+    "rim_config",
+    "SPEED",
+    "GLIDE",
+    "TURN",
+    "FADE",
+]
+SIMILARITY_REBUILD_FRACTION = (
+    0.1  # share of unindexed discs that triggers a tree rebuild
+)
+MAX_SIMILAR_DISCS = 50
+DISC_CLASSES = [  # (minimum speed, class)
+    (9, "Distance Driver"),
+    (6, "Fairway Driver"),
+    (4, "Midrange"),
+    (0, "Putter"),
+]
+FLIGHT_CHART_VERSION = (
+    1  # part of every chart key, so changing the drawing redraws them
+)
+FLIGHT_PATH_POINTS = 100
+FLIGHT_BASE_DISTANCE = 180  # feet, plus the feet per speed and glide below
+FLIGHT_SPEED_DISTANCE = 18
+FLIGHT_GLIDE_DISTANCE = 12
+FLIGHT_TURN_DRIFT = 0.07  # lateral feet per foot downfield per point of turn or fade
+FLIGHT_FADE_DRIFT = 0.18
+FLIGHT_CHART_SIZE = (160, 320)  # width, height in pixels
+FLIGHT_CHART_MARGIN = 10  # pixels
+FLIGHT_CHART_DISTANCE = 500  # feet from the tee to the top of the chart
+FLIGHT_CHART_GRID = 100  # feet between the distance lines
+FLIGHT_CHART_COLORS = {  # hand: (SVG color, RGB)
+    "RHBH": ("#d9534f", (217, 83, 79)),
+    "LHBH": ("#0275d8", (2, 117, 216)),
+}
+FLIGHT_CHART_GRID_COLOR = ("#dddddd", (221, 221, 221))
+
+blueprint = Blueprint("prediction", __name__)
+
+repository = None
+repository_lock = threading.Lock()
+
+
+similarity_index = None
+similarity_index_lock = threading.Lock()
+serving_model = None  # loaded once by the pre-fork server and shared by its workers
+serving_model_version = None  # (name, ETag) of serving_model
+prediction_indexed = set()
+snapshot_lock = threading.Lock()
+
+
+class MongoRepository(storage.MongoRepository):
+    """Reads the scraped discs and stores the predictions, flight charts and models of
+    the service in MongoDB.
+
+    Args:
+        db (Database, optional): database to use. Defaults to the one of the shared
+            MongoClient.
+    """
 
-app = Flask(__name__)
+    def unpredicted_discs(self) -> list:
+        """Returns the scraped discs that have not been predicted on yet."""
+        db = self.db()
+        scraper_data = list(db[SCRAPER_COLLECTION].find())
+        prediction_urls = {
+            item["url"] for item in db[PREDICTION_COLLECTION].find({}, {"url": 1})
+        }
+        return [item for item in scraper_data if item["url"] not in prediction_urls]
+
+    def all_discs(self) -> list:
+        """Returns every scraped disc."""
+        return list(self.db()[SCRAPER_COLLECTION].find({}, {"_id": 0}))
+
+    def insert_predictions(self, predictions: list) -> list:
+        """Stores new predictions, skipping discs that already have one.
+
+        Returns:
+            list: the predictions that were inserted
+        """
+        return upload_predictions_to_mongodb(predictions, PREDICTION_COLLECTION)
+
+    def all_predictions(self, fields: list = None) -> list:
+        """Returns every prediction, with only the given fields if there are any."""
+        projection = {"_id": 0}
+        if fields is not None:
+            projection.update({field: 1 for field in fields})
+        return list(self.db()[PREDICTION_COLLECTION].find({}, projection))
+
+    def predictions_since(self, mark: str = None) -> tuple:
+        """Returns the predictions stored after a high-water mark, oldest first, and
+        the mark of the last one. A mark of None reads every prediction.
+
+        Returns:
+            tuple: the predictions and the new mark, the given one if there are none
+        """
+        query = {} if mark is None else {"_id": {"$gt": ObjectId(mark)}}
+        predictions = list(self.db()[PREDICTION_COLLECTION].find(query).sort("_id", 1))
+        if not predictions:
+            return [], mark
+        return predictions, str(predictions[-1]["_id"])
+
+    def discs_with_urls(self, urls: list) -> list:
+        """Returns the scraped discs with these URLs."""
+        return list(
+            self.db()[SCRAPER_COLLECTION].find({"url": {"$in": urls}}, {"_id": 0})
+        )
 
+    def update_prediction_stats(self, predictions: list):
+        """Folds new predictions into the aggregate rollups."""
+        update_aggregate_rollups(self.db(), predictions)
 
-def connect_to_mongodb() -> pymongo.MongoClient:
-    """Makes connection to MongoDB
+    def rebuild_prediction_stats(self) -> int:
+        """Rebuilds the aggregate rollups from every prediction.
 
-    Returns:
-        MongoClient: Instance of MongoDB
+        Returns:
+            int: number of rollups
+        """
+        return rebuild_aggregate_rollups(self.db())
+
+    def chart_keys(self, keys: list) -> set:
+        """Returns which of these flight charts are already stored."""
+        return {
+            chart["_id"]
+            for chart in self.db()[CHART_COLLECTION].find(
+                {"_id": {"$in": keys}}, {"_id": 1}
+            )
+        }
+
+    def insert_charts(self, charts: dict):
+        """Stores flight charts by key, leaving charts that are already stored as
+        they are."""
+        self.db()[CHART_COLLECTION].bulk_write(
+            [
+                pymongo.UpdateOne({"_id": key}, {"$setOnInsert": chart}, upsert=True)
+                for key, chart in charts.items()
+            ],
+            ordered=False,
+        )
+
+    def active_model(self) -> dict:
+        """Returns the key of the last promoted model and when it was promoted, None
+        if no model has been promoted."""
+        models = list(
+            self.db()[MODEL_COLLECTION].find().sort("promoted_at", -1).limit(1)
+        )
+        if not models:
+            return None
+        return {"key": models[0]["_id"], "promoted_at": models[0]["promoted_at"]}
+
+    def promote_model(self, key: str):
+        """Makes a model the active one. Promoting an earlier model rolls back to it."""
+        self.db()[MODEL_COLLECTION].update_one(
+            {"_id": key}, {"$set": {"promoted_at": datetime.now()}}, upsert=True
+        )
+
+    def insert_shadow_predictions(self, predictions: list):
+        """Stores a candidate model's predictions, skipping discs it has already
+        predicted."""
+        collection = self.db()[SHADOW_COLLECTION]
+        if SHADOW_COLLECTION not in prediction_indexed:
+            collection.create_index([("model", 1), ("url", 1)], unique=True)
+            prediction_indexed.add(SHADOW_COLLECTION)
+        try:
+            collection.insert_many(predictions, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+
+    def insert_model_run(self, run: dict):
+        """Stores the comparison of the active and the candidate model on a batch."""
+        self.db()[MODEL_RUN_COLLECTION].insert_one(run)
+
+    def model_runs(self) -> list:
+        """Returns every comparison of the models, oldest first."""
+        return list(
+            self.db()[MODEL_RUN_COLLECTION].find({}, {"_id": 0}).sort("time", 1)
+        )
+
+
+class SQLiteRepository(storage.SQLiteRepository):
+    """Stores the same data in the embedded SQLite database, for single-node
+    deployments without MongoDB.
+
+    Args:
+        path (str, optional): path of the database file. Defaults to
+            STORAGE_SQLITE_PATH.
     """
 
-    client = pymongo.MongoClient(URI)
+    def unpredicted_discs(self) -> list:
+        """Returns the scraped discs that have not been predicted on yet."""
+        rows = self.connection().execute(
+            "SELECT document FROM discs WHERE NOT EXISTS "
+            "(SELECT 1 FROM predictions WHERE predictions.url = discs.url) "
+            "ORDER BY created_at"
+        )
+        return [decode_document(row["document"]) for row in rows]
+
+    def all_discs(self) -> list:
+        """Returns every scraped disc."""
+        rows = self.connection().execute("SELECT document FROM discs")
+        return [decode_document(row["document"]) for row in rows]
+
+    def insert_predictions(self, predictions: list) -> list:
+        """Stores new predictions, skipping discs that already have one.
+
+        Returns:
+            list: the predictions that were inserted
+        """
+        inserted = []
+        with self.transaction() as connection:
+            for prediction in predictions:
+                approved_date = prediction.get("approved_date")
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO predictions (url, manufacturer, "
+                    "approved_month, speed, glide, turn, fade, tweeted, document) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        prediction["url"],
+                        prediction.get("manufacturer"),
+                        (
+                            approved_date.strftime("%Y-%m")
+                            if isinstance(approved_date, datetime)
+                            else None
+                        ),
+                        *[int(prediction[field]) for field in FLIGHT_NUMBERS],
+                        int(bool(prediction.get("tweeted"))),
+                        encode_document(prediction),
+                    ),
+                )
+                if cursor.rowcount == 1:
+                    inserted.append(prediction)
+            self.fold_prediction_stats(connection, group_aggregates(inserted))
+        if len(inserted) < len(predictions):
+            print(
+                f"Skipped {len(predictions) - len(inserted)} predictions that were "
+                "already uploaded"
+            )
+        return inserted
 
-    db = client[DB_NAME]
-    return db
+    def all_predictions(self, fields: list = None) -> list:
+        """Returns every prediction, with only the given fields if there are any."""
+        rows = self.connection().execute(
+            "SELECT document, tweeted FROM predictions ORDER BY id"
+        )
+        predictions = []
+        for row in rows:
+            prediction = decode_document(row["document"])
+            prediction["tweeted"] = bool(row["tweeted"])
+            if fields is not None:
+                prediction = {
+                    field: prediction[field] for field in fields if field in prediction
+                }
+            predictions.append(prediction)
+        return predictions
+
+    def predictions_since(self, mark: int = None) -> tuple:
+        """Returns the predictions stored after a high-water mark, oldest first, and
+        the mark of the last one. A mark of None reads every prediction.
+
+        Returns:
+            tuple: the predictions and the new mark, the given one if there are none
+        """
+        rows = (
+            self.connection()
+            .execute(
+                "SELECT id, document, tweeted FROM predictions WHERE id > ? ORDER BY id",
+                (mark or 0,),
+            )
+            .fetchall()
+        )
+        if not rows:
+            return [], mark
+        predictions = []
+        for row in rows:
+            prediction = decode_document(row["document"])
+            prediction["tweeted"] = bool(row["tweeted"])
+            predictions.append(prediction)
+        return predictions, rows[-1]["id"]
+
+    def discs_with_urls(self, urls: list) -> list:
+        """Returns the scraped discs with these URLs."""
+        rows = self.connection().execute(
+            "SELECT document FROM discs WHERE url IN (SELECT value FROM json_each(?))",
+            (json.dumps(urls),),
+        )
+        return [decode_document(row["document"]) for row in rows]
+
+    def update_prediction_stats(self, predictions: list):
+        """Does nothing: insert_predictions folds new predictions into the rollups
+        in the transaction that stores them."""
+
+    @staticmethod
+    def fold_prediction_stats(connection: sqlite3.Connection, groups: dict):
+        """Adds the totals of group_aggregates to the rollup tables."""
+        connection.executemany(
+            "INSERT INTO manufacturer_rollups (manufacturer, count, speed_sum, "
+            "glide_sum, turn_sum, fade_sum) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (manufacturer) DO UPDATE SET "
+            "count = count + excluded.count, "
+            "speed_sum = speed_sum + excluded.speed_sum, "
+            "glide_sum = glide_sum + excluded.glide_sum, "
+            "turn_sum = turn_sum + excluded.turn_sum, "
+            "fade_sum = fade_sum + excluded.fade_sum",
+            [
+                (
+                    key[1] or "",  # NULL would never conflict
+                    totals["count"],
+                    totals["speed_sum"],
+                    totals["glide_sum"],
+                    totals["turn_sum"],
+                    totals["fade_sum"],
+                )
+                for key, totals in groups.items()
+                if key[0] == "manufacturer"
+            ],
+        )
+        connection.executemany(
+            "INSERT INTO month_rollups (month, disc_class, count) VALUES (?, ?, ?) "
+            "ON CONFLICT (month, disc_class) DO UPDATE SET "
+            "count = count + excluded.count",
+            [
+                (key[1], key[2], totals["count"])
+                for key, totals in groups.items()
+                if key[0] == "month"
+            ],
+        )
 
+    def rebuild_prediction_stats(self) -> int:
+        """Rebuilds the rollup tables from the whole predictions table, e.g. for a
+        database whose predictions were stored before the rollups existed.
+
+        Returns:
+            int: number of rollups
+        """
+        with self.transaction() as connection:
+            rows = connection.execute(
+                "SELECT manufacturer, approved_month, speed, glide, turn, fade "
+                "FROM predictions"
+            )
+            groups = group_aggregates(
+                {
+                    "manufacturer": row["manufacturer"],
+                    "approved_month": row["approved_month"],
+                    "SPEED": row["speed"],
+                    "GLIDE": row["glide"],
+                    "TURN": row["turn"],
+                    "FADE": row["fade"],
+                }
+                for row in rows
+            )
+            connection.execute("DELETE FROM manufacturer_rollups")
+            connection.execute("DELETE FROM month_rollups")
+            self.fold_prediction_stats(connection, groups)
+        return len(groups)
+
+    def chart_keys(self, keys: list) -> set:
+        """Returns which of these flight charts are already stored."""
+        rows = self.connection().execute(
+            f"SELECT key FROM charts WHERE key IN ({', '.join('?' * len(keys))})", keys
+        )
+        return {row["key"] for row in rows}
+
+    def insert_charts(self, charts: dict):
+        """Stores flight charts by key, leaving charts that are already stored as
+        they are."""
+        with self.transaction() as connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO charts (key, flight_numbers, svg, png) "
+                "VALUES (?, ?, ?, ?)",
+                [
+                    (
+                        key,
+                        json.dumps(chart["flight_numbers"]),
+                        chart["svg"],
+                        chart["png"],
+                    )
+                    for key, chart in charts.items()
+                ],
+            )
+
+    def active_model(self) -> dict:
+        """Returns the key of the last promoted model and when it was promoted, None
+        if no model has been promoted."""
+        row = (
+            self.connection()
+            .execute("SELECT * FROM models ORDER BY promoted_at DESC LIMIT 1")
+            .fetchone()
+        )
+        if row is None:
+            return None
+        return {
+            "key": row["key"],
+            "promoted_at": datetime.fromtimestamp(row["promoted_at"]),
+        }
+
+    def promote_model(self, key: str):
+        """Makes a model the active one. Promoting an earlier model rolls back to it."""
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO models (key, promoted_at) VALUES (?, ?)",
+                (key, time.time()),
+            )
 
-def verify_api_key(func):
-    """Used to verify access across APIs"""
+    def insert_shadow_predictions(self, predictions: list):
+        """Stores a candidate model's predictions, skipping discs it has already
+        predicted."""
+        with self.transaction() as connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO shadow_predictions (model, url, document) "
+                "VALUES (?, ?, ?)",
+                [
+                    (
+                        prediction["model"],
+                        prediction["url"],
+                        encode_document(prediction),
+                    )
+                    for prediction in predictions
+                ],
+            )
 
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        provided_api_key = request.headers.get("X-API-KEY")
-        if not provided_api_key:
-            return jsonify({"message": "API key is missing"}), 401
+    def insert_model_run(self, run: dict):
+        """Stores the comparison of the active and the candidate model on a batch."""
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT INTO model_runs (candidate, time, document) VALUES (?, ?, ?)",
+                (
+                    run["candidate"]["model"],
+                    run["time"].timestamp(),
+                    encode_document(run),
+                ),
+            )
 
-        config_api_key = config["auth"]["api_key"]
-        if provided_api_key != config_api_key:
-            return jsonify({"message": "Invalid API key"}), 401
+    def model_runs(self) -> list:
+        """Returns every comparison of the models, oldest first."""
+        rows = self.connection().execute(
+            "SELECT document FROM model_runs ORDER BY time"
+        )
+        return [decode_document(row["document"]) for row in rows]
 
-        return func(*args, **kwargs)
 
-    return wrapper
+def get_repository():
+    """Returns the repository of the configured storage backend, creating it on first
+    use.
 
+    Returns:
+        MongoRepository | SQLiteRepository: the repository
+    """
+    global repository
+    with repository_lock:
+        if repository is None:
+            repository = create_repository(MongoRepository, SQLiteRepository)
+        return repository
 
-def check_auth(username, password):
-    """Check if a username and password are valid to view the admin page."""
-    return username == ADMIN_USERNAME and password == ADMIN_PASSWORD
 
+def connect_to_s3():
+    """Creates a client of the S3 bucket the models are uploaded to.
 
-def authenticate():
-    """Send a 401 response that enables basic auth."""
-    return (
-        "Unauthorized access. Please provide valid credentials.",
-        401,
-        {"WWW-Authenticate": 'Basic realm="Login Required"'},
+    Returns:
+        S3.Client: the client
+    """
+    return boto3.client(
+        service_name="s3",
+        aws_access_key_id=ACCESS_KEY,
+        aws_secret_access_key=SECRET_KEY,
+        endpoint_url=ENDPOINT_URL,
     )
 
 
-def write_usage_log(
-    db: pymongo.MongoClient,
-    collection: str,
-    endpoint: str,
-    method: str,
-    response_code: int,
-    response_message: str,
-    start_time: datetime.now,
-):
-    """Writes a log to MongoDB database
-
-    Args:
-        db (pymongo.MongoClient): the database to write the log to
-        collection (str): the colleciton within the database
-        endpoint (str): the endpoint called
-        method (str): the ReST method used to call the endpoint
-        response_code (int): the response code returned
-        response_message (str): the message returned
-        start_time (datetime): used to determine the response time of the endpoint
-    """
-    response_time = (datetime.now() - start_time).total_seconds() * 1000  # milliseconds
-    db[collection].insert_one(
-        {
-            "endpoint": endpoint,
-            "method": method,
-            "time": datetime.now(),
-            "response_code": response_code,
-            "response_message": response_message,
-            "response_time": response_time,
-        }
+def list_model_versions_in_s3(bucket_name: str) -> dict:
+    """Lists the models in the S3 bucket with their ETags, which change whenever a
+    model is uploaded again under the same name
+
+    Args:
+        bucket_name (str): name of the bucket
+
+    Returns:
+        dict: ETag of each model by name, newest first
+    """
+    response = connect_to_s3().list_objects_v2(Bucket=bucket_name)
+    models = sorted(
+        response.get("Contents", []), key=lambda x: x["LastModified"], reverse=True
     )
+    return {model["Key"]: model.get("ETag") for model in models}
+
+
+def list_models_in_s3(bucket_name: str) -> list:
+    """Lists the models in the S3 bucket
+
+    Args:
+        bucket_name (str): name of the bucket
+
+    Returns:
+        list: names of the models, newest first
+    """
+    return list(list_model_versions_in_s3(bucket_name))
 
 
 def download_newest_model_from_s3(bucket_name: str) -> str:
@@ -123,16 +639,9 @@ def download_newest_model_from_s3(bucket_name: str) -> str:
     Returns:
         str: name of the newest model
     """
-    s3 = boto3.client(
-        service_name="s3",
-        aws_access_key_id=ACCESS_KEY,
-        aws_secret_access_key=SECRET_KEY,
-        endpoint_url=ENDPOINT_URL,
-    )
-    response = s3.list_objects_v2(Bucket=bucket_name)
-    newest_model = max(response["Contents"], key=lambda x: x["LastModified"])
-    s3.download_file(bucket_name, newest_model["Key"], LOCAL_MODEL_NAME)
-    return newest_model["Key"]
+    newest_model = next(iter(list_model_versions_in_s3(bucket_name).items()))
+    fetch_model(newest_model, bucket_name)
+    return newest_model[0]
 
 
 def fetch_data() -> list:
@@ -142,40 +651,131 @@ def fetch_data() -> list:
     Returns:
         list: list containing only data for the discs that need to be predicted on
     """
-    db = connect_to_mongodb()
-    scraper_collection = db[SCRAPER_COLLECTION]
-    prediction_collection = db[PREDICTION_COLLECTION]
+    return get_repository().unpredicted_discs()
 
-    scraper_data = list(scraper_collection.find())
-    prediction_urls = {
-        item["url"] for item in prediction_collection.find({}, {"url": 1})
-    }
 
-    filtered_data = []
-    for item in scraper_data:
-        if item["url"] not in prediction_urls:
-            filtered_data.append(item)
+def get_active_model_key() -> str:
+    """Returns the name of the model that predictions are made with in shadow mode:
+    the last one promoted. The first time shadow mode runs no model has been
+    promoted, so the newest model in the bucket is.
+
+    Returns:
+        str: name of the active model
+    """
+    repository = get_repository()
+    active = repository.active_model()
+    if active is not None:
+        return active["key"]
+    key = list_models_in_s3(BUCKET_NAME)[0]
+    repository.promote_model(key)
+    print(f"Promoted {key}, the newest model, as no model had been promoted")
+    return key
 
-    return filtered_data
 
+def get_model_version() -> tuple:
+    """Looks up the model to predict with: the promoted model in shadow mode,
+    otherwise the most recent one. It is looked up at the start of every run, so a
+    model uploaded or promoted since the last run is used.
+
+    Returns:
+        tuple: (name, ETag) of the model
+    """
+    versions = list_model_versions_in_s3(BUCKET_NAME)
+    key = get_active_model_key() if SHADOW_MODE else next(iter(versions))
+    return key, versions.get(key)
+
+
+def model_path(version: tuple) -> str:
+    """Names the local file of a version of a model. Each version gets its own file,
+    so a worker downloading a model never overwrites one another worker is loading.
+
+    Args:
+        version (tuple): (name, ETag) of the model
+
+    Returns:
+        str: path of the model file
+    """
+    digest = hashlib.sha1(repr(tuple(version)).encode()).hexdigest()[:16]
+    return os.path.join(MODEL_DIR, f"model-{digest}.pkl")
+
+
+def fetch_model(version: tuple, bucket_name: str = None) -> str:
+    """Pulls in a version of a model from the S3 bucket unless it has been downloaded
+    already. The file is downloaded under a temporary name and then renamed, so it
+    is never read half written. Only the MODEL_CACHE_SIZE most recently used model
+    files are kept.
+
+    Args:
+        version (tuple): (name, ETag) of the model, as get_model_version returns it
+        bucket_name (str, optional): name of the bucket. Defaults to BUCKET_NAME.
+
+    Returns:
+        str: path of the model file
+    """
+    path = model_path(version)
+    if os.path.exists(path):
+        os.utime(path)
+    else:
+        os.makedirs(MODEL_DIR, exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        connect_to_s3().download_file(bucket_name or BUCKET_NAME, version[0], temporary)
+        os.replace(temporary, path)
+
+    files = sorted(
+        (
+            entry
+            for entry in os.scandir(MODEL_DIR)
+            if entry.name.startswith("model-") and entry.name.endswith(".pkl")
+        ),
+        key=lambda entry: entry.stat().st_mtime,
+        reverse=True,
+    )
+    for entry in files[MODEL_CACHE_SIZE:]:
+        if entry.path != path:
+            with contextlib.suppress(FileNotFoundError):  # pruned by another worker
+                os.remove(entry.path)
+    return path
 
-def fetch_model() -> None:
-    """Pulls in the most recent model from the S3 bucket if the model does not already exist"""
-    if not os.path.exists(LOCAL_MODEL_NAME):
-        download_newest_model_from_s3(BUCKET_NAME)
 
+def load_model(path: str):
+    """Loads in the model object downloaded from the S3 bucket
 
-def load_model():
-    """Loads in the model object from the S3 bucket
+    Args:
+        path (str): path of the model file, as fetch_model returns it
 
     Returns:
         model: scikit-learn model object
     """
-    with open(LOCAL_MODEL_NAME, "rb") as file:
+    with open(path, "rb") as file:
         model = joblib.load(file)
     return model
 
 
+def load_shared_model(path: str):
+    """Loads the model with its numpy arrays memory-mapped from the model file, so
+    that processes forked afterwards share their pages instead of copying them. Only
+    models saved uncompressed by joblib.dump can be memory-mapped; others are loaded
+    into memory as usual.
+
+    Args:
+        path (str): path of the model file, as fetch_model returns it
+
+    Returns:
+        model: scikit-learn model object
+    """
+    return joblib.load(path, mmap_mode="r")
+
+
+def warm_model(model):
+    """Runs one prediction so that state the model sets up lazily, such as BLAS
+    thread pools and input validation, is set up before workers are forked.
+
+    Args:
+        model (sklearn): scikit-learn model object
+    """
+    model.predict(pd.DataFrame([WARM_UP_DISC], columns=list(MODEL_FEATURES.values())))
+
+
 def extract_numbers(value: str) -> str:
     """Removes units from data pieces in order to make them numeric.
 
@@ -195,6 +795,44 @@ def extract_numbers(value: str) -> str:
         return None
 
 
+def disc_measurement(disc: dict, field: str) -> float:
+    """Reads a measurement of a disc from its typed specs. Discs scraped before the
+    specs were stored fall back to the scraped text.
+
+    Args:
+        disc (dict): scraped disc
+        field (str): scraped field of the measurement e.g., diameter
+
+    Returns:
+        float: the measurement, or NaN if it is missing or not a number
+    """
+    specs = disc.get("specs")
+    if isinstance(specs, dict) and specs.get(DISC_SPECS[field]) is not None:
+        return specs[DISC_SPECS[field]]
+    value = disc.get(field)
+    if isinstance(value, str):
+        value = extract_numbers(value)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def feature_matrix(discs: list) -> np.ndarray:
+    """Reads the model features of discs into an array, one row per disc.
+
+    Args:
+        discs (list): scraped discs
+
+    Returns:
+        ndarray: float array of the MODEL_FEATURES of every disc
+    """
+    return np.array(
+        [[disc_measurement(disc, field) for field in MODEL_FEATURES] for disc in discs],
+        dtype=float,
+    ).reshape(len(discs), len(MODEL_FEATURES))
+
+
 def make_predictions(model, data: pd.DataFrame) -> pd.DataFrame:
     """Performs predictions on unseen data
 
@@ -205,29 +843,9 @@ def make_predictions(model, data: pd.DataFrame) -> pd.DataFrame:
     Returns:
         DataFrame: DataFrame including feature values, other disc information such as url, and the predicted speed, glide, turn, and fade
     """
-    model = load_model()  # Assuming this function loads the model, remove if not needed
     df = pd.DataFrame(data)
-    X = df[
-        [
-            "diameter",
-            "height",
-            "rim_depth",
-            "inside_rim_diameter",
-            "rim_depth_diameter_ratio",
-            "rim_config",
-        ]
-    ]
-    X.columns = [
-        "DIAMETER (cm)",
-        "HEIGHT (cm)",
-        "RIM DEPTH (cm)",
-        "INSIDE RIM DIAMETER (cm)",
-        "RIM DEPTH / DIAMETER RATION (%)",
-        "RIM CONFIGURATION",
-    ]
-
-    for column in X.columns:
-        X[column] = X[column].apply(extract_numbers)
+    discs = data if isinstance(data, list) else df.to_dict(orient="records")
+    X = pd.DataFrame(feature_matrix(discs), columns=list(MODEL_FEATURES.values()))
 
     predictions = model.predict(X)
 
@@ -243,16 +861,168 @@ def make_predictions(model, data: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
-def upload_predictions_to_mongodb(predictions: dict, collection_name: str) -> None:
-    """Uploads the new predictions to MongoDB collection
+def upload_predictions_to_mongodb(predictions: list, collection_name: str) -> list:
+    """Uploads the new predictions to MongoDB collection. A unique index on url makes
+    this idempotent: predictions for discs that already have one are skipped.
 
     Args:
-        predictions (dict): dictionary of the data to be inserted into MongoDB
+        predictions (list): the predictions to be inserted into MongoDB
         collection_name (str): name of the collection where the predictions should be inserted
+
+    Returns:
+        list: the predictions that were inserted
     """
     db = connect_to_mongodb()
     collection = db[collection_name]
-    collection.insert_many(predictions)
+    if collection_name not in prediction_indexed:
+        try:
+            collection.create_index("url", unique=True)
+        except pymongo.errors.OperationFailure as e:  # existing duplicates
+            print(f"Error creating the unique url index on {collection_name}: {e}")
+        prediction_indexed.add(collection_name)
+    try:
+        collection.insert_many(predictions, ordered=False)
+    except pymongo.errors.BulkWriteError as e:
+        errors = e.details["writeErrors"]
+        if any(error["code"] != 11000 for error in errors):
+            raise
+        duplicates = {error["index"] for error in errors}
+        print(f"Skipped {len(duplicates)} predictions that were already uploaded")
+        return [
+            prediction
+            for index, prediction in enumerate(predictions)
+            if index not in duplicates
+        ]
+    return predictions
+
+
+def disc_class(speed) -> str:
+    """Classifies a disc by its speed.
+
+    Args:
+        speed (int): predicted speed of the disc
+
+    Returns:
+        str: class of the disc e.g., Midrange
+    """
+    for minimum_speed, name in DISC_CLASSES:
+        if speed >= minimum_speed:
+            return name
+    return DISC_CLASSES[-1][1]
+
+
+def group_aggregates(predictions) -> dict:
+    """Groups predictions into the increments of the per-manufacturer and per-month
+    rollups so that each group is written once no matter how many discs it holds.
+
+    Args:
+        predictions (iterable): prediction documents after clean_data. Instead of an
+            approved_date, a prediction may hold its approved_month as "YYYY-MM".
+
+    Returns:
+        dict: totals keyed by ("manufacturer", manufacturer) or
+              ("month", month, disc class)
+    """
+    groups = {}
+    for prediction in predictions:
+        manufacturer_key = ("manufacturer", prediction.get("manufacturer"))
+        totals = groups.setdefault(
+            manufacturer_key,
+            {"count": 0, "speed_sum": 0, "glide_sum": 0, "turn_sum": 0, "fade_sum": 0},
+        )
+        totals["count"] += 1
+        for flight_number in ["SPEED", "GLIDE", "TURN", "FADE"]:
+            totals[f"{flight_number.lower()}_sum"] += int(prediction[flight_number])
+
+        approved_date = prediction.get("approved_date")
+        month = prediction.get("approved_month")
+        if isinstance(approved_date, datetime):
+            month = approved_date.strftime("%Y-%m")
+        if month is not None:
+            month_key = ("month", month, disc_class(prediction["SPEED"]))
+            groups.setdefault(month_key, {"count": 0})["count"] += 1
+    return groups
+
+
+def build_aggregate_updates(predictions) -> list:
+    """Turns the groups of group_aggregates into writes to the rollup collection.
+
+    Args:
+        predictions (iterable): prediction documents after clean_data
+
+    Returns:
+        list: UpdateOne operations incrementing the rollups
+    """
+    updates = []
+    for key, totals in group_aggregates(predictions).items():
+        if key[0] == "manufacturer":
+            group = {"type": "manufacturer", "manufacturer": key[1]}
+        else:
+            group = {"type": "month", "month": key[1], "disc_class": key[2]}
+        updates.append(
+            pymongo.UpdateOne(
+                group,
+                {"$inc": totals, "$set": {"updated": datetime.now()}},
+                upsert=True,
+            )
+        )
+    return updates
+
+
+def update_aggregate_rollups(db, predictions: list) -> None:
+    """Folds newly uploaded predictions into the aggregate rollups. The rollups count
+    every prediction once per manufacturer, so when they do not add up to the
+    predictions stored before these ones, e.g. because folding in an earlier batch
+    failed, they are rebuilt from the whole prediction collection instead. The
+    predictions are counted from the collection's metadata rather than by a scan.
+
+    Args:
+        db (pymongo.database.Database): database holding the predictions
+        predictions (list): newly uploaded prediction documents after clean_data
+    """
+    collection = db[AGGREGATE_COLLECTION]
+    folded = sum(
+        rollup["count"]
+        for rollup in collection.find({"type": "manufacturer"}, {"count": 1})
+    )
+    stored = db[PREDICTION_COLLECTION].estimated_document_count()
+    if folded != stored - len(predictions):
+        rebuild_aggregate_rollups(db)
+        return
+    updates = build_aggregate_updates(predictions)
+    if updates:
+        collection.bulk_write(updates, ordered=False)
+
+
+def rebuild_aggregate_rollups(db) -> int:
+    """Rebuilds the aggregate rollups from the whole prediction collection. They are
+    built in a scratch collection that replaces the rollups in one rename, so that
+    /api/stats never reads them half built.
+
+    Args:
+        db (pymongo.database.Database): database holding the predictions
+
+    Returns:
+        int: number of rollups
+    """
+    projection = {
+        "_id": 0,
+        "manufacturer": 1,
+        "approved_date": 1,
+        "SPEED": 1,
+        "GLIDE": 1,
+        "TURN": 1,
+        "FADE": 1,
+    }
+    updates = build_aggregate_updates(db[PREDICTION_COLLECTION].find({}, projection))
+    if not updates:
+        db[AGGREGATE_COLLECTION].delete_many({})
+        return 0
+    scratch = db[f"{AGGREGATE_COLLECTION}_rebuild"]
+    scratch.drop()
+    scratch.bulk_write(updates, ordered=False)
+    scratch.rename(AGGREGATE_COLLECTION, dropTarget=True)
+    return len(updates)
 
 
 def clean_data(input_dict: dict) -> dict:
@@ -265,6 +1035,13 @@ def clean_data(input_dict: dict) -> dict:
     Returns:
         dict: data in the same structure as it is passed in as with the updated data types
     """
+    specs = input_dict.get("specs")
+    if isinstance(specs, dict):  # typed by the scraper, so nothing to parse
+        for field, typed_field in DISC_SPECS.items():
+            if field in input_dict and specs.get(typed_field) is not None:
+                input_dict[field] = specs[typed_field]
+        if specs.get("approved_date") is not None:
+            input_dict["approved_date"] = specs["approved_date"]
     for key, value in input_dict.items():
         if key in [
             "max_weight",
@@ -279,7 +1056,7 @@ def clean_data(input_dict: dict) -> dict:
             try:
                 value = value.rstrip("grkcm%")
                 input_dict[key] = float(value)
-            except ValueError:
+            except (AttributeError, ValueError):  # already a number, or not one
                 pass
         if key in ["TURN"]:
             try:
@@ -287,7 +1064,7 @@ def clean_data(input_dict: dict) -> dict:
                     input_dict[key] = 0 - int(value)
             except ValueError:
                 pass
-        if key == "approved_date":
+        if key == "approved_date" and isinstance(value, str):
             try:
                 input_dict[key] = datetime.strptime(value, "%b %d, %Y")
             except ValueError:
@@ -295,96 +1072,1351 @@ def clean_data(input_dict: dict) -> dict:
     return input_dict
 
 
-@app.route("/predict", methods=["POST"])
-@verify_api_key
-def predict():
-    start_time = datetime.now()
+def disc_features(disc: dict) -> list:
+    """Builds the similarity feature vector of a disc from its measurements and flight numbers.
+
+    Args:
+        disc (dict): disc measurements and flight numbers, with or without units
+
+    Returns:
+        list: feature values in SIMILARITY_FEATURES order, or None if any are missing
+    """
+    features = []
+    for feature in SIMILARITY_FEATURES:
+        value = disc.get(feature)
+        if isinstance(value, str):
+            value = extract_numbers(value)
+        try:
+            features.append(float(value))
+        except (TypeError, ValueError):
+            return None
+    return features
+
+
+class SimilarityIndex:
+    """Nearest-neighbour index over standardized disc feature vectors.
+
+    Discs are kept in a KD-tree for O(log n) queries. Discs added since the tree was
+    last built are compared by brute force until they make up more than
+    SIMILARITY_REBUILD_FRACTION of the catalogue, at which point the tree is rebuilt.
+
+    An index that is being queried is never added to: update_similarity_index adds to
+    a copy and swaps it in.
+    """
+
+    def __init__(self):
+        self.discs = []
+        self.positions = {}
+        self.features = np.empty((0, len(SIMILARITY_FEATURES)))
+        self.mean = np.zeros(len(SIMILARITY_FEATURES))
+        self.scale = np.ones(len(SIMILARITY_FEATURES))
+        self.tree = None
+        self.indexed = 0
+
+    def __len__(self):
+        return len(self.discs)
+
+    def copy(self) -> "SimilarityIndex":
+        """Copies the index so that discs can be added to it while this one is queried.
+        The tree and the feature array are shared, as they are replaced, never changed.
+
+        Returns:
+            SimilarityIndex: the copy
+        """
+        index = SimilarityIndex()
+        index.discs = list(self.discs)
+        index.positions = dict(self.positions)
+        index.features = self.features
+        index.mean, index.scale = self.mean, self.scale
+        index.tree, index.indexed = self.tree, self.indexed
+        return index
+
+    def add(self, discs: list) -> int:
+        """Adds discs that are not in the index yet, rebuilding the tree when needed.
+
+        Args:
+            discs (list): disc documents including measurements and flight numbers
+
+        Returns:
+            int: number of discs added
+        """
+        rows = []
+        for disc in discs:
+            features = disc_features(disc)
+            if features is None or disc.get("url") in self.positions:
+                continue
+            self.positions[disc.get("url")] = len(self.discs)
+            self.discs.append(
+                {
+                    "url": disc.get("url"),
+                    "manufacturer": disc.get("manufacturer"),
+                    "name": disc.get("name"),
+                }
+            )
+            rows.append(features)
+
+        if rows:
+            self.features = np.vstack([self.features, np.array(rows, dtype=float)])
+            pending = len(self.discs) - self.indexed
+            if (
+                self.tree is None
+                or pending > SIMILARITY_REBUILD_FRACTION * self.indexed
+            ):
+                self.rebuild()
+        return len(rows)
+
+    def rebuild(self):
+        """Recomputes the standardization and rebuilds the KD-tree over every disc."""
+        self.mean = self.features.mean(axis=0)
+        scale = self.features.std(axis=0)
+        self.scale = np.where(scale > 0, scale, 1.0)
+        from sklearn.neighbors import KDTree
+
+        self.tree = KDTree(self.standardize(self.features))
+        self.indexed = len(self.discs)
+
+    def standardize(self, features: np.ndarray) -> np.ndarray:
+        """Standardizes feature vectors with the statistics of the last rebuild.
+
+        Args:
+            features (np.ndarray): feature vectors, one per row
+
+        Returns:
+            np.ndarray: standardized feature vectors
+        """
+        return (features - self.mean) / self.scale
+
+    def query(self, features: np.ndarray, k: int) -> tuple:
+        """Finds the k nearest discs for a batch of feature vectors.
+
+        Args:
+            features (np.ndarray): feature vectors, one per row
+            k (int): number of neighbours per vector
+
+        Returns:
+            tuple: (distances, positions) arrays of shape (len(features), k)
+        """
+        X = self.standardize(np.atleast_2d(np.asarray(features, dtype=float)))
+        k = min(k, len(self.discs))
+        distances, positions = self.tree.query(X, k=min(k, self.indexed))
+
+        if self.indexed < len(self.discs):
+            pending = self.standardize(self.features[self.indexed :])
+            pending_distances = np.linalg.norm(
+                X[:, np.newaxis, :] - pending[np.newaxis, :, :], axis=2
+            )
+            pending_positions = np.broadcast_to(
+                np.arange(self.indexed, len(self.discs)), pending_distances.shape
+            )
+            distances = np.hstack([distances, pending_distances])
+            positions = np.hstack([positions, pending_positions])
+            order = np.argsort(distances, axis=1)[:, :k]
+            distances = np.take_along_axis(distances, order, axis=1)
+            positions = np.take_along_axis(positions, order, axis=1)
+
+        return distances, positions
+
+    def save(self, path: str):
+        """Persists the discs and their features as plain lists and arrays, so that the
+        file loads whichever name this module was imported under. The file is replaced
+        in one rename, so other workers never read it half written.
+
+        Args:
+            path (str): file to write the index to
+        """
+        partial = f"{path}.{os.getpid()}.tmp"
+        joblib.dump({"discs": self.discs, "features": self.features}, partial)
+        os.replace(partial, path)
+
+    @staticmethod
+    def load(path: str) -> "SimilarityIndex":
+        """Loads a persisted index and rebuilds its tree.
+
+        Args:
+            path (str): file the index was written to
+
+        Returns:
+            SimilarityIndex: the persisted index
+        """
+        saved = joblib.load(path)
+        index = SimilarityIndex()
+        index.discs = list(saved["discs"])
+        index.positions = {disc["url"]: i for i, disc in enumerate(index.discs)}
+        index.features = np.asarray(saved["features"], dtype=float).reshape(
+            -1, len(SIMILARITY_FEATURES)
+        )
+        if index.discs:
+            index.rebuild()
+        return index
+
+
+def get_similarity_index() -> SimilarityIndex:
+    """Returns the similarity index, loading it from disk or building it from the
+    prediction collection the first time it is needed.
+
+    Returns:
+        SimilarityIndex: the similarity index
+    """
+    global similarity_index
+    if similarity_index is None:
+        with similarity_index_lock:
+            if similarity_index is None:
+                similarity_index = load_similarity_index()
+    return similarity_index
+
+
+def load_similarity_index() -> SimilarityIndex:
+    """Loads the similarity index from disk, or builds it from the prediction
+    collection if it has not been saved or cannot be read.
+
+    Returns:
+        SimilarityIndex: the similarity index
+    """
+    if os.path.exists(SIMILARITY_INDEX_PATH):
+        try:
+            return SimilarityIndex.load(SIMILARITY_INDEX_PATH)
+        except Exception as e:
+            print(f"Rebuilding the similarity index, as it could not be loaded: {e}")
+    fields = ["url", "manufacturer", "name", *SIMILARITY_FEATURES]
+    index = SimilarityIndex()
+    index.add(get_repository().all_predictions(fields))
+    os.makedirs(MODEL_DIR, exist_ok=True)
+    index.save(SIMILARITY_INDEX_PATH)
+    return index
+
+
+def update_similarity_index(predictions: list) -> int:
+    """Adds new predictions to a copy of the similarity index, persists it next to the
+    model and swaps it in, so that queries running meanwhile use the old index whole.
+
+    Args:
+        predictions (list): newly uploaded prediction documents
+
+    Returns:
+        int: number of discs added to the index
+    """
+    global similarity_index
+    get_similarity_index()  # loads the index on first use
+    with similarity_index_lock:
+        index = similarity_index.copy()
+        added = index.add(predictions)
+        if added:
+            os.makedirs(MODEL_DIR, exist_ok=True)
+            index.save(SIMILARITY_INDEX_PATH)
+            similarity_index = index
+    return added
+
+
+def flight_paths(flight_numbers: np.ndarray, hand: str = "RHBH") -> np.ndarray:
+    """Simulates the flights of many discs at once from their flight numbers. Speed
+    and glide set how far a disc flies, turn drifts a right-hand backhand throw right
+    through the middle of its flight and fade hooks it left at the end. A left-hand
+    backhand throw is the mirror image.
+
+    Args:
+        flight_numbers (np.ndarray): speed, glide, turn and fade of each disc
+        hand (str, optional): RHBH or LHBH. Defaults to "RHBH".
+
+    Returns:
+        np.ndarray: lateral and downfield feet of FLIGHT_PATH_POINTS points along each
+            flight, shape (discs, FLIGHT_PATH_POINTS, 2). Right is positive
+    """
+    if hand not in FLIGHT_CHART_COLORS:
+        raise ValueError(f"Unknown throwing hand: {hand}")
+    speed, glide, turn, fade = (
+        np.asarray(flight_numbers, dtype=float).reshape(-1, 4).T[:, :, None]
+    )
+    progress = np.linspace(0, 1, FLIGHT_PATH_POINTS)
+    distance = (
+        FLIGHT_BASE_DISTANCE
+        + FLIGHT_SPEED_DISTANCE * speed
+        + FLIGHT_GLIDE_DISTANCE * glide
+    )
+    drift = (
+        -turn * FLIGHT_TURN_DRIFT * np.sin(np.pi * progress)
+        - fade * FLIGHT_FADE_DRIFT * progress**3
+    )
+    lateral = np.cumsum(drift, axis=1) * distance / (FLIGHT_PATH_POINTS - 1)
+    if hand == "LHBH":
+        lateral = -lateral
+    return np.stack([lateral, progress * distance], axis=-1)
+
+
+def chart_pixels(paths: np.ndarray) -> np.ndarray:
+    """Converts positions in feet to pixels of a flight chart, with the tee at the
+    bottom centre. Positions off the chart are moved to its edge.
+
+    Args:
+        paths (np.ndarray): lateral and downfield feet, in the last dimension
+
+    Returns:
+        np.ndarray: x and y pixels, in the same shape
+    """
+    width, height = FLIGHT_CHART_SIZE
+    scale = (height - 2 * FLIGHT_CHART_MARGIN) / FLIGHT_CHART_DISTANCE
+    pixels = np.empty_like(paths, dtype=float)
+    pixels[..., 0] = width / 2 + paths[..., 0] * scale
+    pixels[..., 1] = height - FLIGHT_CHART_MARGIN - paths[..., 1] * scale
+    return np.clip(pixels, 0, [width - 1, height - 1])
+
+
+def chart_grid_rows() -> np.ndarray:
+    """Returns the y pixels of the distance lines of a flight chart."""
+    distances = np.arange(
+        FLIGHT_CHART_GRID, FLIGHT_CHART_DISTANCE + 1, FLIGHT_CHART_GRID, dtype=float
+    )
+    return chart_pixels(np.stack([np.zeros_like(distances), distances], axis=-1))[:, 1]
+
+
+def render_flight_chart_svg(flight_numbers: list, paths: dict) -> bytes:
+    """Draws a flight chart as SVG: a line for each throwing hand over a distance line
+    every FLIGHT_CHART_GRID feet, with the flight numbers in the corner.
+
+    Args:
+        flight_numbers (list): speed, glide, turn and fade of the disc
+        paths (dict): pixels of the flight of each hand
+
+    Returns:
+        bytes: the SVG document
+    """
+    width, height = FLIGHT_CHART_SIZE
+    elements = [f'<rect width="{width}" height="{height}" fill="#ffffff"/>']
+    for y in chart_grid_rows():
+        elements.append(
+            f'<line x1="0" y1="{y:.1f}" x2="{width}" y2="{y:.1f}" '
+            f'stroke="{FLIGHT_CHART_GRID_COLOR[0]}"/>'
+        )
+    for hand, pixels in paths.items():
+        points = " ".join(f"{x:.1f},{y:.1f}" for x, y in pixels)
+        elements.append(
+            f'<polyline points="{points}" fill="none" '
+            f'stroke="{FLIGHT_CHART_COLORS[hand][0]}" stroke-width="2">'
+            f"<title>{hand}</title></polyline>"
+        )
+    elements.append(
+        f'<text x="4" y="{FLIGHT_CHART_MARGIN + 12}" font-family="sans-serif" '
+        f'font-size="12">{" | ".join(str(number) for number in flight_numbers)}</text>'
+    )
+    for index, hand in enumerate(paths):
+        elements.append(
+            f'<text x="{4 + index * width // 2}" y="{height - 2}" '
+            f'font-family="sans-serif" font-size="10" '
+            f'fill="{FLIGHT_CHART_COLORS[hand][0]}">{hand}</text>'
+        )
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+        f'viewBox="0 0 {width} {height}">{"".join(elements)}</svg>'
+    ).encode("utf-8")
+
+
+def encode_png(image: np.ndarray) -> bytes:
+    """Encodes an RGB image as a PNG file.
+
+    Args:
+        image (np.ndarray): 8-bit pixels, shape (height, width, 3)
+
+    Returns:
+        bytes: the PNG file
+    """
+    height, width, _ = image.shape
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return (
+            struct.pack(">I", len(data))
+            + kind
+            + data
+            + struct.pack(">I", zlib.crc32(kind + data))
+        )
+
+    # Each row starts with its filter type, 0 for none
+    rows = np.hstack([np.zeros((height, 1), np.uint8), image.reshape(height, -1)])
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(rows.tobytes(), 9))
+        + chunk(b"IEND", b"")
+    )
+
+
+def render_flight_chart_png(paths: dict) -> bytes:
+    """Draws the lines of a flight chart as a PNG image, for places that do not show
+    SVG, such as tweets.
+
+    Args:
+        paths (dict): pixels of the flight of each hand
+
+    Returns:
+        bytes: the PNG file
+    """
+    width, height = FLIGHT_CHART_SIZE
+    image = np.full((height, width, 3), 255, dtype=np.uint8)
+    image[np.round(chart_grid_rows()).astype(int)] = FLIGHT_CHART_GRID_COLOR[1]
+    for hand, pixels in paths.items():
+        # Points along the line, less than a pixel apart
+        length = np.concatenate([[0], np.cumsum(np.hypot(*np.diff(pixels, axis=0).T))])
+        steps = np.linspace(0, length[-1], int(length[-1] * 2) + 2)
+        x = np.round(np.interp(steps, length, pixels[:, 0])).astype(int)
+        y = np.round(np.interp(steps, length, pixels[:, 1])).astype(int)
+        for dx, dy in [(0, 0), (1, 0), (0, 1), (1, 1)]:  # 2 pixels wide
+            image[np.minimum(y + dy, height - 1), np.minimum(x + dx, width - 1)] = (
+                FLIGHT_CHART_COLORS[hand][1]
+            )
+    return encode_png(image)
+
+
+def flight_chart_key(flight_numbers: list) -> str:
+    """Names a flight chart after a hash of the flight numbers it shows and of
+    FLIGHT_CHART_VERSION."""
+    numbers = ":".join(str(number) for number in flight_numbers)
+    return hashlib.sha1(f"{FLIGHT_CHART_VERSION}:{numbers}".encode()).hexdigest()[:16]
+
+
+def render_flight_charts(predictions: list) -> int:
+    """Draws the flight charts of the predictions that are not in the chart cache yet
+    and points each prediction at its chart. Charts are keyed by their flight numbers,
+    so discs that share them share a chart, and the paths of every new chart are
+    simulated at once.
+
+    Args:
+        predictions (list): the predictions, which get the key of their chart as chart
+
+    Returns:
+        int: number of charts drawn
+    """
+    if not predictions:
+        return 0
+    flight_numbers = {}  # chart key: flight numbers
+    keys = []
+    for entry in predictions:
+        numbers = [int(entry[field]) for field in FLIGHT_NUMBERS]
+        keys.append(flight_chart_key(numbers))
+        flight_numbers[keys[-1]] = numbers
+
+    repository = get_repository()
+    stored = repository.chart_keys(list(flight_numbers))
+    missing = [key for key in flight_numbers if key not in stored]
+    if missing:
+        numbers = np.array([flight_numbers[key] for key in missing])
+        paths = {
+            hand: chart_pixels(flight_paths(numbers, hand))
+            for hand in FLIGHT_CHART_COLORS
+        }
+        charts = {}
+        for index, key in enumerate(missing):
+            disc_paths = {hand: pixels[index] for hand, pixels in paths.items()}
+            charts[key] = {
+                "flight_numbers": flight_numbers[key],
+                "svg": render_flight_chart_svg(flight_numbers[key], disc_paths),
+                "png": render_flight_chart_png(disc_paths),
+            }
+        repository.insert_charts(charts)
+
+    for entry, key in zip(predictions, keys):
+        entry["chart"] = key
+    return len(missing)
+
+
+def disc_approved_date(disc: dict) -> datetime:
+    """Reads the approval date of a disc from its typed specs, or else from the
+    approved_date field as scraped or as cleaned by clean_data.
+
+    Returns:
+        datetime: the approval date, or None if it is missing or not a date
+    """
+    specs = disc.get("specs")
+    if isinstance(specs, dict) and isinstance(specs.get("approved_date"), datetime):
+        return specs["approved_date"]
+    value = disc.get("approved_date")
+    if isinstance(value, datetime):
+        return value
     try:
-        db = connect_to_mongodb()
-        data = fetch_data()
-        if len(data) == 0:
-            return jsonify({"message": "No new discs to predict for."})
+        return datetime.strptime(value, "%b %d, %Y")
+    except (TypeError, ValueError):
+        return None
 
-        fetch_model()
-        model = load_model()
 
-        data = make_predictions(model, data)  # type(make_prediction(x, y)) == DataFrame
+def snapshot_schema(dataset: str):
+    """Returns the Arrow schema of a snapshot dataset: the disc's identity, approval
+    date and typed measurements, plus the flight numbers for predictions.
 
-        # Applying prepare_for_table to the data
-        prepared_data = [clean_data(item) for item in data.to_dict(orient="records")]
+    Args:
+        dataset (str): discs or predictions
+
+    Returns:
+        Schema: pyarrow schema of the dataset's files
+    """
+    fields = [
+        ("url", pa.string()),
+        ("manufacturer", pa.string()),
+        ("name", pa.string()),
+        ("approved_date", pa.timestamp("ms")),
+    ]
+    fields += [(typed_field, pa.float64()) for typed_field in DISC_SPECS.values()]
+    if dataset == "predictions":
+        fields += [(flight_number, pa.int64()) for flight_number in FLIGHT_NUMBERS]
+    return pa.schema(fields)
+
+
+def build_record_batch(dataset: str, records: list):
+    """Converts discs or predictions into an Arrow record batch of the dataset's schema.
+
+    Args:
+        dataset (str): discs or predictions
+        records (list): disc or prediction documents
+
+    Returns:
+        RecordBatch: one row per record
+    """
+    columns = {
+        "url": [record.get("url") for record in records],
+        "manufacturer": [record.get("manufacturer") for record in records],
+        "name": [record.get("name") for record in records],
+        "approved_date": [disc_approved_date(record) for record in records],
+    }
+    for field, typed_field in DISC_SPECS.items():
+        columns[typed_field] = [disc_measurement(record, field) for record in records]
+    if dataset == "predictions":
+        for flight_number in FLIGHT_NUMBERS:
+            columns[flight_number] = [int(record[flight_number]) for record in records]
+    return pa.RecordBatch.from_pydict(columns, schema=snapshot_schema(dataset))
+
+
+def read_snapshot_manifest() -> dict:
+    """Reads the manifest listing every file of the snapshots in the order they were
+    written. Each file has a sequence number, so a reader can pick up where it left off.
+
+    Returns:
+        dict: the last sequence number and the files
+    """
+    try:
+        with open(os.path.join(SNAPSHOT_PATH, SNAPSHOT_MANIFEST)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {"sequence": 0, "files": []}
+
+
+def write_snapshot_manifest(manifest: dict) -> None:
+    """Replaces the manifest in one step, so readers see either the old or the new one."""
+    path = os.path.join(SNAPSHOT_PATH, SNAPSHOT_MANIFEST)
+    with open(path + ".tmp", "w") as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def export_snapshot(discs: list, predictions: list, exported=None) -> int:
+    """Appends new discs and predictions to the Parquet snapshots under SNAPSHOT_PATH,
+    one file per dataset and approval month, e.g.
+    predictions/approved_month=2024-04/part-<run>.parquet. Files only count once they
+    are in the manifest, so a run that fails halfway leaves nothing half-read.
+
+    Args:
+        discs (list): scraped discs that were predicted on in this run
+        predictions (list): predictions uploaded in this run
+        exported (optional): high-water mark of the last prediction exported, stored
+            in the manifest along with the files
+
+    Returns:
+        int: number of files written
+    """
+    if not SNAPSHOT_PATH:
+        return 0
+    run = f"{datetime.now().strftime('%Y%m%dT%H%M%S')}-{secrets.token_hex(4)}"
+    written = 0
+    with snapshot_lock:
+        manifest = read_snapshot_manifest()
+        for dataset, records in [("discs", discs), ("predictions", predictions)]:
+            months = {}
+            for record in records:
+                approved_date = disc_approved_date(record)
+                month = approved_date.strftime("%Y-%m") if approved_date else "unknown"
+                months.setdefault(month, []).append(record)
+            for month, month_records in sorted(months.items()):
+                relative_path = os.path.join(
+                    dataset, f"approved_month={month}", f"part-{run}.parquet"
+                )
+                path = os.path.join(SNAPSHOT_PATH, relative_path)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                batch = build_record_batch(dataset, month_records)
+                pq.write_table(pa.Table.from_batches([batch]), path + ".tmp")
+                os.replace(path + ".tmp", path)
+                manifest["sequence"] += 1
+                manifest["files"].append(
+                    {
+                        "sequence": manifest["sequence"],
+                        "dataset": dataset,
+                        "approved_month": month,
+                        "path": relative_path,
+                        "rows": batch.num_rows,
+                        "written": datetime.now().isoformat(),
+                    }
+                )
+                written += 1
+        if exported is not None and exported != manifest.get("exported"):
+            manifest["exported"] = exported
+            write_snapshot_manifest(manifest)
+        elif written:
+            write_snapshot_manifest(manifest)
+    return written
+
+
+def catch_up_snapshot(repository, discs: list = None) -> int:
+    """Exports the predictions stored after the high-water mark in the manifest, and
+    their discs, then moves the mark past them. A run therefore reads only what was
+    stored since the last export, and whatever a failed export missed is exported by
+    the next one. The discs of the current run are given as they are; only the discs
+    of the other predictions are read from storage.
+
+    Args:
+        repository: the storage backend
+        discs (list, optional): scraped discs that were predicted on in this run
+
+    Returns:
+        int: number of files written
+    """
+    if not SNAPSHOT_PATH:
+        return 0
+    manifest = read_snapshot_manifest()
+    predictions, mark = repository.predictions_since(manifest.get("exported"))
+    if "exported" not in manifest and manifest["files"]:
+        # Written before the mark was kept, so what it holds is skipped this once
+        table, _ = load_snapshot("predictions", ["url"])
+        exported = set(table.column("url").to_pylist())
+        predictions = [item for item in predictions if item["url"] not in exported]
+    found = {disc["url"]: disc for disc in discs or []}
+    missing = [item["url"] for item in predictions if item["url"] not in found]
+    if missing:
+        found.update(
+            (disc["url"], disc) for disc in repository.discs_with_urls(missing)
+        )
+    discs = [found[item["url"]] for item in predictions if item["url"] in found]
+    return export_snapshot(discs, predictions, mark)
+
+
+def load_snapshot(dataset: str, columns: list = None, since: int = 0) -> tuple:
+    """Reads a snapshot dataset with its files memory-mapped, so the columns are not
+    copied into memory.
+
+    Args:
+        dataset (str): discs or predictions
+        columns (list, optional): columns to read. Defaults to all of them.
+        since (int, optional): only read the files written after this sequence
+            number. Defaults to 0, reading every file.
+
+    Returns:
+        tuple: the rows as a pyarrow Table, and the sequence number to pass as since
+            to read only what is written next
+    """
+    manifest = read_snapshot_manifest()
+    files = [
+        entry
+        for entry in manifest["files"]
+        if entry["dataset"] == dataset and entry["sequence"] > since
+    ]
+    schema = snapshot_schema(dataset)
+    if columns is not None:
+        schema = pa.schema([schema.field(column) for column in columns])
+    tables = [
+        pq.read_table(
+            os.path.join(SNAPSHOT_PATH, entry["path"]),
+            columns=columns,
+            memory_map=True,
+        )
+        for entry in files
+    ]
+    table = pa.concat_tables(tables) if tables else schema.empty_table()
+    return table, max([since] + [entry["sequence"] for entry in files])
+
+
+def load_feature_matrix(dataset: str = "predictions", since: int = 0) -> tuple:
+    """Reads the model features of a snapshot dataset into a matrix, e.g. to retrain
+    or backtest the model.
+
+    Args:
+        dataset (str, optional): discs or predictions. Defaults to predictions.
+        since (int, optional): only read the files written after this sequence
+            number. Defaults to 0, reading every file.
+
+    Returns:
+        tuple: float array with the MODEL_FEATURES of one disc per row, the URLs of
+            the discs and the sequence number to pass as since next time
+    """
+    columns = [DISC_SPECS[field] for field in MODEL_FEATURES]
+    table, sequence = load_snapshot(dataset, ["url"] + columns, since)
+    X = np.empty((table.num_rows, len(columns)))
+    for position, column in enumerate(columns):
+        X[:, position] = table.column(column).to_numpy()
+    return X, table.column("url").to_pylist(), sequence
+
+
+@contextlib.contextmanager
+def measure(stats: dict, stage: str, memory: bool = False):
+    """Records how long a block takes as <stage>_seconds in stats. With memory, it
+    also records the peak memory the block allocates as <stage>_memory_bytes, which
+    slows the block down while it is traced.
+
+    Args:
+        stats (dict): measurements of a model
+        stage (str): name of the block e.g., load
+        memory (bool, optional): whether to trace memory. Defaults to False.
+    """
+    if memory:
+        start_tracing_memory()
+        tracemalloc.reset_peak()  # a memory profile may have been tracing already
+        baseline = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats[f"{stage}_seconds"] = time.perf_counter() - start
+        if memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            stop_tracing_memory()
+            stats[f"{stage}_memory_bytes"] = max(peak - baseline, 0)
+
+
+def model_agreement(predictions: list, flight_numbers: np.ndarray) -> dict:
+    """Compares the flight numbers two models predicted for the same discs.
+
+    Args:
+        predictions (list): the active model's predictions
+        flight_numbers (np.ndarray): the other model's flight numbers of the same
+            discs, in FLIGHT_NUMBERS order
+
+    Returns:
+        dict: share of discs on which the models agree on every flight number and
+            on each one, and the mean absolute difference of each
+    """
+    active = np.array(
+        [[prediction[field] for field in FLIGHT_NUMBERS] for prediction in predictions],
+        dtype=float,
+    ).reshape(-1, len(FLIGHT_NUMBERS))
+    same = active == flight_numbers
+    difference = np.abs(active - flight_numbers).mean(axis=0)
+    return {
+        "all_flight_numbers": float(same.all(axis=1).mean()),
+        "flight_numbers": dict(zip(FLIGHT_NUMBERS, same.mean(axis=0).tolist())),
+        "mean_absolute_difference": dict(zip(FLIGHT_NUMBERS, difference.tolist())),
+    }
+
+
+def score_candidate(discs: list, predictions: list, active: dict) -> str:
+    """Predicts a batch with the candidate model, the newest model in the bucket
+    unless it is the active one, next to the active model. The candidate's
+    predictions are stored in SHADOW_COLLECTION, and how both models did in
+    MODEL_RUN_COLLECTION. Nothing else reads them, so the candidate never changes
+    what is published.
+
+    Args:
+        discs (list): the scraped discs of the batch
+        predictions (list): the active model's predictions of the discs
+        active (dict): name and measurements of the active model
+
+    Returns:
+        str: name of the candidate, None if there is none
+    """
+    version = next(iter(list_model_versions_in_s3(BUCKET_NAME).items()))
+    key = version[0]
+    if key == active["model"]:
+        return None
+    candidate = {"model": key}
+    with span("download_candidate"):
+        path = fetch_model(version)
+    with span("load_candidate"), measure(candidate, "load", memory=True):
+        model = load_model(path)
+    with span("candidate_inference", discs=len(discs)), measure(
+        candidate, "inference", memory=True
+    ):
+        flight_numbers = make_predictions(model, discs)[FLIGHT_NUMBERS].to_numpy()
+
+    now = datetime.now()
+    repository = get_repository()
+    repository.insert_shadow_predictions(
+        [
+            {
+                "model": key,
+                "url": prediction["url"],
+                "manufacturer": prediction.get("manufacturer"),
+                "name": prediction.get("name"),
+                **dict(zip(FLIGHT_NUMBERS, numbers.tolist())),
+                "time": now,
+            }
+            for prediction, numbers in zip(predictions, flight_numbers)
+        ]
+    )
+    repository.insert_model_run(
+        {
+            "time": now,
+            "discs": len(discs),
+            "active": active,
+            "candidate": candidate,
+            "agreement": model_agreement(predictions, flight_numbers),
+        }
+    )
+    return key
+
+
+def summarize_model_runs(runs: list) -> list:
+    """Sums up how each candidate did next to the active models. Latencies are per
+    disc and agreement is weighted by the discs in each batch.
+
+    Args:
+        runs (list): comparisons of the models on each batch, oldest first
+
+    Returns:
+        list: summary of each candidate, the most recently scored first
+    """
+    candidates = {}
+    for run in runs:
+        candidates.setdefault(run["candidate"]["model"], []).append(run)
+
+    def summarize_model(stats: list, discs: int) -> dict:
+        loads = [run["load_seconds"] for run in stats if "load_seconds" in run]
+        memory = [
+            run.get("load_memory_bytes", 0) + run.get("inference_memory_bytes", 0)
+            for run in stats
+            if "inference_memory_bytes" in run
+        ]
+        return {
+            "load_seconds": sum(loads) / len(loads) if loads else None,
+            "inference_seconds_per_disc": (
+                sum(run["inference_seconds"] for run in stats) / discs
+            ),
+            "peak_memory_bytes": max(memory) if memory else None,
+        }
+
+    summaries = []
+    for key, model_runs in candidates.items():
+        discs = sum(run["discs"] for run in model_runs)
+        agreement = {
+            "all_flight_numbers": 0.0,
+            "flight_numbers": dict.fromkeys(FLIGHT_NUMBERS, 0.0),
+            "mean_absolute_difference": dict.fromkeys(FLIGHT_NUMBERS, 0.0),
+        }
+        for run in model_runs:
+            weight = run["discs"] / (discs or 1)
+            agreement["all_flight_numbers"] += (
+                run["agreement"]["all_flight_numbers"] * weight
+            )
+            for name in ["flight_numbers", "mean_absolute_difference"]:
+                for field in FLIGHT_NUMBERS:
+                    agreement[name][field] += run["agreement"][name][field] * weight
+        summaries.append(
+            {
+                "model": key,
+                "batches": len(model_runs),
+                "discs": discs,
+                "last_run": model_runs[-1]["time"],
+                "active_models": sorted(
+                    {run["active"]["model"] for run in model_runs} - {None}
+                ),
+                "active": summarize_model(
+                    [run["active"] for run in model_runs], discs or 1
+                ),
+                "candidate": summarize_model(
+                    [run["candidate"] for run in model_runs], discs or 1
+                ),
+                "agreement": agreement,
+            }
+        )
+    summaries.sort(key=lambda summary: summary["last_run"], reverse=True)
+    return summaries
 
-        upload_predictions_to_mongodb(prepared_data, PREDICTION_COLLECTION)
 
-        if os.path.exists(LOCAL_MODEL_NAME):
-            os.remove(LOCAL_MODEL_NAME)
-            print(f"File '{LOCAL_MODEL_NAME}' removed successfully.")
+def predict_discs(data: list) -> list:
+    """Predicts the flight numbers of discs with the newest model, or in shadow mode
+    with the promoted model while the newest one is scored next to it.
+
+    Args:
+        data (list): scraped discs
+
+    Returns:
+        list: the discs with their predicted flight numbers, ready to be uploaded
+    """
+    global serving_model, serving_model_version
+    discs = data
+    with span("check_model"):
+        version = get_model_version()
+    stats = {"model": version[0]}
+    model = serving_model if serving_model_version == version else None
+    if model is None:
+        with span("download_model"):
+            path = fetch_model(version)
+        with span("load_model"), measure(stats, "load"):
+            model = load_model(path)
+        if serving_model is not None:
+            # Uploaded or promoted since the pre-fork server loaded its model. Each
+            # worker keeps the model it loaded until the next one.
+            serving_model, serving_model_version = model, version
+
+    with span("inference", discs=len(data)), measure(stats, "inference"):
+        data = make_predictions(model, data)  # type(make_prediction(x, y)) == DataFrame
+
+    # Applying prepare_for_table to the data
+    with span("clean_data"):
+        prepared_data = [clean_data(item) for item in data.to_dict(orient="records")]
 
-        url = config["urls"]["twitter"]
-        headers = {"X-API-KEY": config["auth"]["api_key"]}
+    # The candidate must never fail the run that publishes the active model's predictions
+    if SHADOW_MODE:
         try:
-            response = requests.post(url, headers=headers)
-            print(f"Twitter service ran: {response}")
-            if response.status_code == 401:
-                print("Unauthorized: Invalid API key")
-            elif response.status_code != 200:
-                print(f"Error: {response.json()}")
+            with span("score_candidate") as attributes:
+                attributes["candidate"] = score_candidate(discs, prepared_data, stats)
         except Exception as e:
-            print(
-                f"The Twitter service was triggered but there was an error in running it: {e}"
+            print(f"Error scoring the candidate model: {e}")
+
+    return prepared_data
+
+
+def run_prediction_pipeline() -> str:
+    """Predicts the flight numbers of every disc that has not been predicted on yet,
+    uploads the predictions and publishes a predictions_ready event for the Twitter
+    service. Running it again when there is nothing new to predict does nothing, so
+    jobs can safely be delivered more than once.
+
+    Returns:
+        str: status message
+    """
+    with span("fetch_data") as attributes:
+        data = fetch_data()
+        attributes["discs"] = len(data)
+    if len(data) == 0:
+        return "No new discs to predict for."
+
+    prepared_data = predict_discs(data)
+
+    # Drawn before the upload, so the predictions are stored with their chart keys
+    try:
+        with span("render_flight_charts") as attributes:
+            attributes["charts"] = render_flight_charts(prepared_data)
+    except Exception as e:
+        print(f"Error rendering the flight charts: {e}")
+
+    repository = get_repository()
+    check_lock()
+    with span("upload_predictions", discs=len(prepared_data)) as attributes:
+        prepared_data = repository.insert_predictions(prepared_data)
+        attributes["inserted"] = len(prepared_data)
+
+    try:
+        with span("update_aggregate_rollups"):
+            repository.update_prediction_stats(prepared_data)
+    except Exception as e:
+        print(f"Error updating the aggregate rollups: {e}")
+
+    try:
+        with span("update_similarity_index"):
+            update_similarity_index(prepared_data)
+    except Exception as e:
+        print(f"Error updating the similarity index: {e}")
+
+    # Whatever this export misses is exported by the next run
+    try:
+        with span("export_snapshot") as attributes:
+            uploaded = {item["url"] for item in prepared_data}
+            attributes["files"] = catch_up_snapshot(
+                repository, [disc for disc in data if disc["url"] in uploaded]
+            )
+    except Exception as e:
+        print(f"Error exporting the snapshot: {e}")
+
+    # The predictions are stored, so a failure here must not fail the job and have it
+    # predict again; the Twitter service can still be run by hand
+    try:
+        with span("publish_predictions_ready") as attributes:
+            attributes["queued"] = publish_event(
+                EVENT_PREDICTIONS_READY,
+                {"urls": [item["url"] for item in prepared_data]},
             )
+    except Exception as e:
+        print(f"Error queueing the Twitter job: {e}")
+
+    return f"{len(prepared_data)} predictions uploaded successfully to {PREDICTION_COLLECTION}"
 
-        message = f"{len(prepared_data)} predictions uploaded successfully to {PREDICTION_COLLECTION}"
+
+def handle_discs_scraped(payload: dict) -> str:
+    """Runs the prediction pipeline for a discs_scraped job. The pipeline predicts on
+    every new disc, so the discs of jobs that are still queued are covered too."""
+    message = run_exclusively("predict", run_prediction_pipeline)
+    if message is None:
+        return "A prediction run is already running. It will run once more when it finishes."
+    return message
+
+
+@blueprint.route("/predict", methods=["POST"])
+@verify_api_key
+@traced("predict", APP_NAME)
+def predict():
+    start_time = datetime.now()
+    repository = get_repository()
+    try:
+        with span("run_exclusively") as attributes:
+            message = run_exclusively("predict", run_prediction_pipeline)
+            attributes["coalesced"] = message is None
+        if message is None:
+            message = "A prediction run is already running. It will run once more when it finishes."
+            write_usage_log(
+                repository,
+                USAGE_COLLECTION,
+                "/predict",
+                "POST",
+                202,
+                message,
+                start_time,
+            )
+            return jsonify({"message": message}), 202
         write_usage_log(
-            db, USAGE_COLLECTION, "/predict", "POST", 200, message, start_time
+            repository, USAGE_COLLECTION, "/predict", "POST", 200, message, start_time
         )
         return jsonify({"message": message})
     except Exception as e:
         write_usage_log(
-            db, USAGE_COLLECTION, "/predict", "POST", 500, str(e), start_time
+            repository, USAGE_COLLECTION, "/predict", "POST", 500, str(e), start_time
+        )
+        return jsonify({"error": str(e)}), 500
+
+
+@blueprint.route("/promote_model", methods=["POST"])
+@verify_api_key
+def promote_model():
+    """Makes a model the one predictions are made with in shadow mode, from the next
+    prediction run on. The body names the "model", by default the candidate scored
+    most recently. Promoting an earlier model rolls back to it.
+    """
+    start_time = datetime.now()
+    repository = get_repository()
+    try:
+        key = (request.get_json(silent=True) or {}).get("model")
+        if key is None:
+            runs = repository.model_runs()
+            if not runs:
+                return jsonify({"error": "No candidate model has been scored."}), 400
+            key = runs[-1]["candidate"]["model"]
+        if key not in list_models_in_s3(BUCKET_NAME):
+            return jsonify({"error": f"Unknown model: {key}"}), 400
+
+        repository.promote_model(key)
+        message = f"Promoted {key}"
+        write_usage_log(
+            repository,
+            USAGE_COLLECTION,
+            "/promote_model",
+            "POST",
+            200,
+            message,
+            start_time,
+        )
+        return jsonify({"message": message, "model": key})
+    except Exception as e:
+        write_usage_log(
+            repository,
+            USAGE_COLLECTION,
+            "/promote_model",
+            "POST",
+            500,
+            str(e),
+            start_time,
+        )
+        return jsonify({"error": str(e)}), 500
+
+
+@blueprint.route("/similar", methods=["POST"])
+@verify_api_key
+def similar():
+    """Finds the existing discs that fly most like the given ones. The body holds a list
+    of disc "urls" already in the catalogue and/or a list of "discs" with measurements
+    and flight numbers, plus the number of neighbours "k".
+
+    Returns:
+        JSON: 200 with the neighbours of every queried disc, in the order given
+              400 when a queried disc is unknown or incomplete
+              500 when error
+    """
+    start_time = datetime.now()
+    repository = get_repository()
+    try:
+        body = request.get_json(silent=True) or {}
+        k = body.get("k", 5)
+        if isinstance(k, bool) or not isinstance(k, int):
+            return jsonify({"error": "k must be a whole number."}), 400
+        k = min(max(k, 1), MAX_SIMILAR_DISCS)
+        index = get_similarity_index()
+        if len(index) == 0:
+            return jsonify({"error": "The similarity index is empty."}), 400
+
+        queries, exclude, rows = [], [], []
+        for url in body.get("urls", []):
+            if url not in index.positions:
+                return jsonify({"error": f"Unknown disc: {url}"}), 400
+            queries.append(url)
+            exclude.append(index.positions[url])
+            rows.append(index.features[index.positions[url]])
+        for disc in body.get("discs", []):
+            features = disc_features(disc)
+            if features is None:
+                return (
+                    jsonify({"error": f"Discs need all of {SIMILARITY_FEATURES}"}),
+                    400,
+                )
+            queries.append(disc.get("name", disc.get("url")))
+            exclude.append(None)
+            rows.append(features)
+        if not rows:
+            return jsonify({"error": "No discs to compare."}), 400
+
+        # One extra neighbour so that a catalogue disc can be dropped from its own results
+        distances, positions = index.query(np.array(rows), k + 1)
+
+        results = []
+        for query, skip, query_distances, query_positions in zip(
+            queries, exclude, distances, positions
+        ):
+            neighbours = [
+                {**index.discs[position], "distance": round(float(distance), 4)}
+                for distance, position in zip(query_distances, query_positions)
+                if position != skip
+            ]
+            results.append({"query": query, "similar": neighbours[:k]})
+
+        message = f"Similar discs found for {len(results)} discs"
+        write_usage_log(
+            repository, USAGE_COLLECTION, "/similar", "POST", 200, message, start_time
+        )
+        return jsonify({"results": results})
+    except Exception as e:
+        write_usage_log(
+            repository, USAGE_COLLECTION, "/similar", "POST", 500, str(e), start_time
         )
         return jsonify({"error": str(e)}), 500
 
 
-@app.route("/admin", methods=["GET"])
+@blueprint.route("/admin/models", methods=["GET"])
+def admin_models():
+    """Shows the active model and how each candidate did next to it in shadow mode:
+    load time, inference latency, peak memory and agreement."""
+    auth = request.authorization
+
+    if not auth or not check_auth(auth.username, auth.password):
+        return authenticate()
+
+    repository = get_repository()
+    return jsonify(
+        {
+            "shadow_mode": SHADOW_MODE,
+            "active": repository.active_model(),
+            "candidates": summarize_model_runs(repository.model_runs()),
+        }
+    )
+
+
+@blueprint.route("/admin", methods=["GET"])
 def admin():
     auth = request.authorization
 
     if not auth or not check_auth(auth.username, auth.password):
         return authenticate()
 
-    db = connect_to_mongodb()
-    collection = db[USAGE_COLLECTION]
+    try:
+        before, before_id = parse_log_cursor(request.args["before"])
+    except (KeyError, ValueError):
+        before, before_id = datetime.now(), None
+    limit = min(max(request.args.get("limit", 100, type=int), 1), ADMIN_LOG_PAGE_LIMIT)
+
+    repository = get_repository()
+    endpoint_data, hourly = repository.usage_summary(USAGE_COLLECTION)
+    entries, next_before = repository.usage_log_page(
+        USAGE_COLLECTION, before, limit, before_id
+    )
+    try:
+        jobs = get_job_queue().counts()
+    except Exception as e:
+        print(f"Error counting jobs: {e}")
+        jobs = {}
+
+    return render_template(
+        "admin.html",
+        endpoint_data=endpoint_data,
+        hourly=hourly,
+        log=entries,
+        next_before=next_before,
+        limit=limit,
+        pool=pool_metrics.snapshot(),
+        process_metrics=summarize_request_metrics(),
+        jobs=jobs,
+    )
 
-    pipeline = [
-        {
-            "$group": {
-                "_id": "$endpoint",
-                "count": {"$sum": 1},
-                "last_run": {"$max": "$time"},
-                "average_time": {
-                    "$avg": "$response_time"
-                },  # Calculate average response time
-            }
-        },
-    ]
 
-    aggregation_result = list(collection.aggregate(pipeline))
+def run_server_worker(listener: socket.socket, host: str, index: int, threads: int):
+    """Serves requests in a forked worker of the pre-fork server.
+
+    Args:
+        listener (socket.socket): the listening socket inherited from the master
+        host (str): host the socket is bound to
+        index (int): number of the worker. The first one also runs the job worker.
+        threads (int): size of the BLAS and OpenMP thread pools
+    """
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    signal.signal(signal.SIGINT, lambda signum, frame: sys.exit(0))
+    from threadpoolctl import threadpool_limits
+    from werkzeug.serving import make_server
+
+    threadpool_limits(limits=threads)
+    if index == 0:
+        start_job_worker(
+            EVENT_DISCS_SCRAPED, handle_discs_scraped, APP_NAME, USAGE_COLLECTION
+        )
+    server = make_server(
+        host, listener.getsockname()[1], app, threaded=True, fd=listener.fileno()
+    )
+    server.serve_forever()
 
-    endpoint_data = {
-        item["_id"]: {
-            "count": item["count"],
-            "last_run": item["last_run"],
-            "average_time": (
-                round(item["average_time"], 2) if item["average_time"] else 0
-            ),  # Round to 2 decimal places
-        }
-        for item in aggregation_result
-    }
 
-    all_entries = list(collection.find({}, {"_id": 0}).sort("time", -1))
+def serve(host: str, port: int, workers: int, threads: int = 0):
+    """Runs the pre-fork server. The master binds the port, downloads, loads and warms
+    the model once, freezes the garbage collector so that objects created so far are
+    never touched again, then forks the workers, which share the model's memory
+    copy-on-write. Every run still checks for a newer model, which the worker running
+    it then loads for itself. Workers that die are replaced and SIGTERM is passed on
+    to all of them.
+
+    Args:
+        host (str): host to listen on
+        port (int): port to listen on
+        workers (int): number of worker processes
+        threads (int, optional): BLAS and OpenMP threads per worker. Defaults to
+            splitting the CPUs between the workers.
+    """
+    global serving_model, serving_model_version
+    # Bound first, so that a port in use fails fast and connections made while the
+    # model loads wait in the backlog instead of being refused
+    listener = socket.create_server((host, port), backlog=128)
+    version = get_model_version()
+    serving_model = load_shared_model(fetch_model(version))
+    serving_model_version = version
+    warm_model(serving_model)
+    threads = threads or max(1, (os.cpu_count() or 1) // workers)
+
+    gc.collect()
+    gc.freeze()
+
+    children = {}  # pid: worker number
+    stopping = threading.Event()
+
+    def spawn(index: int):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_server_worker(listener, host, index, threads)
+            except SystemExit as e:
+                code = e.code or 0
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                flush_usage_logs()  # atexit handlers do not run after os._exit
+                os._exit(code)
+        children[pid] = index
+
+    def stop(signum, frame):
+        stopping.set()
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
 
-    return render_template("admin.html", endpoint_data=endpoint_data, log=all_entries)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(workers):
+        spawn(index)
+    print(f"Serving on {host}:{port} with {workers} workers of {threads} threads")
+
+    while children:
+        pid, status = os.wait()
+        index = children.pop(pid, None)
+        if index is not None and not stopping.is_set():
+            print(f"Worker {index} exited with status {status}, restarting it")
+            spawn(index)
+    listener.close()
+
+
+def create_app() -> Flask:
+    """Creates the Flask app of the service. Heavy dependencies and clients are
+    created on first use, so this is quick.
+
+    Returns:
+        Flask: the app
+    """
+    set_app_name(APP_NAME)
+    app = Flask(__name__)
+    app.register_blueprint(blueprint)
+    app.register_blueprint(monitoring.blueprint)
+    app.register_blueprint(tracing.blueprint)
+    return app
+
+
+app = create_app()
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8002)
+    parser = argparse.ArgumentParser(description="Runs the prediction service")
+    parser.add_argument("--port", type=int, default=8002)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=SERVER_WORKERS,
+        help="worker processes to pre-fork. 0 runs the development server",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=SERVER_THREADS_PER_WORKER,
+        help="BLAS and OpenMP threads per worker",
+    )
+    parser.add_argument(
+        "--snapshot-all",
+        action="store_true",
+        help="export every disc and prediction to an empty snapshot and exit",
+    )
+    parser.add_argument(
+        "--snapshot-missing",
+        action="store_true",
+        help="export the predicted discs and predictions missing from the snapshot",
+    )
+    parser.add_argument(
+        "--rebuild-rollups",
+        action="store_true",
+        help="rebuild the aggregate rollups from the stored predictions and exit",
+    )
+    args = parser.parse_args()
+
+    if args.rebuild_rollups:
+        print(f"{get_repository().rebuild_prediction_stats()} rollups rebuilt")
+        sys.exit(0)
+
+    if args.snapshot_all:
+        if not SNAPSHOT_PATH:
+            sys.exit("Set path in the [snapshots] section of config.ini first")
+        if read_snapshot_manifest()["files"]:
+            sys.exit(f"The snapshot in {SNAPSHOT_PATH} is not empty")
+        repository = get_repository()
+        predictions, mark = repository.predictions_since(None)
+        written = export_snapshot(repository.all_discs(), predictions, mark)
+        print(f"{written} snapshot files written to {SNAPSHOT_PATH}")
+        sys.exit(0)
+
+    if args.snapshot_missing:
+        if not SNAPSHOT_PATH:
+            sys.exit("Set path in the [snapshots] section of config.ini first")
+        written = catch_up_snapshot(get_repository())
+        print(f"{written} snapshot files written to {SNAPSHOT_PATH}")
+        sys.exit(0)
+
+    if args.workers > 0:
+        serve("0.0.0.0", args.port, args.workers, args.threads)
+    else:
+        # Exit normally on SIGTERM so that buffered usage logs are flushed
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        start_job_worker(
+            EVENT_DISCS_SCRAPED, handle_discs_scraped, APP_NAME, USAGE_COLLECTION
+        )
+        app.run(host="0.0.0.0", port=args.port)
@@ -1,109 +1,214 @@
-import configparser
+import argparse
+import math
 import pymongo
-import requests
+import signal
+import sys
+import threading
+import time
 
-from bs4 import BeautifulSoup
 from datetime import datetime
-from flask import Flask, jsonify, render_template, request
-from functools import wraps
+from flask import Blueprint, Flask, jsonify, render_template, request
 from urllib.parse import urlparse
 
+from services.common import monitoring, storage, tracing
+from services.common.auth import authenticate, check_auth, verify_api_key
+from services.common.config import config
+from services.common.jobs import EVENT_DISCS_SCRAPED, get_job_queue, publish_event
+from services.common.lazy import LazyModule
+from services.common.locks import check_lock, run_exclusively
+from services.common.monitoring import summarize_request_metrics
+from services.common.storage import (
+    DB_NAME,
+    STORAGE_BACKEND,
+    create_repository,
+    decode_document,
+    encode_document,
+    pool_metrics,
+    set_app_name,
+)
+from services.common.tracing import span, traced
+from services.common.usage import (
+    ADMIN_LOG_PAGE_LIMIT,
+    parse_log_cursor,
+    write_usage_log,
+)
+
+bs4 = LazyModule("bs4")
+requests = LazyModule("requests")
+
+
 """
 Scraper service which gets the new discs from the PDGA approved discs list.
 
 PDGA website: https://www.pdga.com/technical-standards/equipment-certification/discs
 """
 
-config = configparser.ConfigParser()
-config.read("config.ini")
-URI = config["mongodb"]["uri"]
-DB_NAME = config["mongodb"]["db_name"]
 COLLECTION = config["mongodb"]["scraper_collection"]
 USAGE_COLLECTION = config["mongodb"]["scraper_usage"]
-ADMIN_USERNAME = config["admin"]["username"]
-ADMIN_PASSWORD = config["admin"]["password"]
+APP_NAME = "pdga-scraper"
+PDGA_URL = config.get("urls", "pdga", fallback="https://www.pdga.com")
+SPECS_VERSION = 1  # bumped when the typed specs of a disc change
+DISC_SPECS = (
+    {  # scraped field: (typed field in specs, unit, lowest valid, highest valid)
+        "max_weight": ("max_weight_gr", "gr", 0, 500),
+        "diameter": ("diameter_cm", "cm", 0, 50),
+        "height": ("height_cm", "cm", 0, 50),
+        "rim_depth": ("rim_depth_cm", "cm", 0, 50),
+        "rim_thickness": ("rim_thickness_cm", "cm", 0, 50),
+        "inside_rim_diameter": ("inside_rim_diameter_cm", "cm", 0, 50),
+        "rim_depth_diameter_ratio": ("rim_depth_diameter_ratio_pct", "%", 0, 100),
+        "rim_config": ("rim_config", "", 0, 100),
+        "flexibility": ("flexibility_kg", "kg", 0, 100),
+    }
+)
+APPROVED_DATE_FORMAT = "%b %d, %Y"
+PUBLISH_ATTEMPTS = 3
+PUBLISH_RETRY_DELAY = 1  # seconds, doubled after each failed attempt
 
-app = Flask(__name__)
+blueprint = Blueprint("scraper", __name__)
 
-last_scraped = None
+repository = None
+repository_lock = threading.Lock()
 
 
-def connect_to_mongodb() -> pymongo.MongoClient:
-    """Makes connection to MongoDB
+last_scraped = None
+unpublished_urls = []  # stored discs whose discs_scraped event could not be published
 
-    Returns:
-        MongoClient: Instance of MongoDB
-    """
 
-    client = pymongo.MongoClient(URI)
+class MongoRepository(storage.MongoRepository):
+    """Stores the scraped discs of the service in MongoDB.
 
-    db = client[DB_NAME]
-    return db
+    Args:
+        db (Database, optional): database to use. Defaults to the one of the shared
+            MongoClient.
+    """
 
+    def __init__(self, db=None):
+        super().__init__(db)
+        self.discs_indexed = False
 
-def verify_api_key(func):
-    """Used to verify access across APIs"""
+    def disc_urls(self) -> set:
+        """Returns the URLs of every stored disc."""
+        return {disc["url"] for disc in self.db()[COLLECTION].find({}, {"url": 1})}
 
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        provided_api_key = request.headers.get("X-API-KEY")
-        if not provided_api_key:
-            return jsonify({"message": "API key is missing"}), 401
+    def insert_discs(self, discs: list) -> list:
+        """Stores new discs. A unique index on url makes this idempotent: discs that
+        are already stored are skipped.
 
-        config_api_key = config["auth"]["api_key"]
-        if provided_api_key != config_api_key:
-            return jsonify({"message": "Invalid API key"}), 401
+        Returns:
+            list: the discs that were inserted
+        """
+        collection = self.db()[COLLECTION]
+        if not self.discs_indexed:
+            try:
+                collection.create_index("url", unique=True)
+            except pymongo.errors.OperationFailure as e:  # existing duplicates
+                print(f"Error creating the unique url index on {COLLECTION}: {e}")
+            self.discs_indexed = True
+        try:
+            collection.insert_many(discs, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            errors = e.details["writeErrors"]
+            if any(error["code"] != 11000 for error in errors):
+                raise
+            duplicates = {error["index"] for error in errors}
+            return [disc for index, disc in enumerate(discs) if index not in duplicates]
+        return discs
+
+    def discs_missing_specs(self, version: int) -> list:
+        """Returns the scraped fields of the discs whose specs are not of this version."""
+        projection = {"_id": 0, "url": 1, "approved_date": 1}
+        projection.update({field: 1 for field in DISC_SPECS})
+        return list(
+            self.db()[COLLECTION].find({"specs.version": {"$ne": version}}, projection)
+        )
 
-        return func(*args, **kwargs)
+    def set_disc_specs(self, specs: dict):
+        """Replaces the specs of discs, keyed by URL."""
+        self.db()[COLLECTION].bulk_write(
+            [
+                pymongo.UpdateOne({"url": url}, {"$set": {"specs": disc_specs}})
+                for url, disc_specs in specs.items()
+            ],
+            ordered=False,
+        )
 
-    return wrapper
 
+class SQLiteRepository(storage.SQLiteRepository):
+    """Stores the same data in the embedded SQLite database, for single-node
+    deployments without MongoDB.
 
-def check_auth(username, password):
-    """Check if a username and password are valid to view the admin page."""
-    return username == ADMIN_USERNAME and password == ADMIN_PASSWORD
+    Args:
+        path (str, optional): path of the database file. Defaults to
+            STORAGE_SQLITE_PATH.
+    """
 
+    def disc_urls(self) -> set:
+        """Returns the URLs of every stored disc."""
+        return {
+            row["url"] for row in self.connection().execute("SELECT url FROM discs")
+        }
 
-def authenticate():
-    """Send a 401 response that enables basic auth."""
-    return (
-        "Unauthorized access. Please provide valid credentials.",
-        401,
-        {"WWW-Authenticate": 'Basic realm="Login Required"'},
-    )
+    def insert_discs(self, discs: list) -> list:
+        """Stores new discs, skipping those that are already stored.
+
+        Returns:
+            list: the discs that were inserted
+        """
+        inserted = []
+        now = time.time()
+        with self.transaction() as connection:
+            for disc in discs:
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO discs (url, specs_version, created_at, "
+                    "document) VALUES (?, ?, ?, ?)",
+                    (
+                        disc["url"],
+                        (disc.get("specs") or {}).get("version"),
+                        now,
+                        encode_document(disc),
+                    ),
+                )
+                if cursor.rowcount == 1:
+                    inserted.append(disc)
+        return inserted
+
+    def discs_missing_specs(self, version: int) -> list:
+        """Returns the discs whose specs are not of this version."""
+        rows = self.connection().execute(
+            "SELECT document FROM discs WHERE specs_version IS NOT ?", (version,)
+        )
+        return [decode_document(row["document"]) for row in rows]
+
+    def set_disc_specs(self, specs: dict):
+        """Replaces the specs of discs, keyed by URL."""
+        with self.transaction() as connection:
+            for url, disc_specs in specs.items():
+                row = connection.execute(
+                    "SELECT document FROM discs WHERE url = ?", (url,)
+                ).fetchone()
+                if row is None:
+                    continue
+                disc = decode_document(row["document"])
+                disc["specs"] = disc_specs
+                connection.execute(
+                    "UPDATE discs SET specs_version = ?, document = ? WHERE url = ?",
+                    (disc_specs.get("version"), encode_document(disc), url),
+                )
 
 
-def write_usage_log(
-    db: pymongo.MongoClient,
-    collection: str,
-    endpoint: str,
-    method: str,
-    response_code: int,
-    response_message: str,
-    start_time: datetime.now,
-):
-    """Writes a log to MongoDB database
+def get_repository():
+    """Returns the repository of the configured storage backend, creating it on first
+    use.
 
-    Args:
-        db (pymongo.MongoClient): the database to write the log to
-        collection (str): the colleciton within the database
-        endpoint (str): the endpoint called
-        method (str): the ReST method used to call the endpoint
-        response_code (int): the response code returned
-        response_message (str): the message returned
-        start_time (datetime): used to determine the response time of the endpoint
+    Returns:
+        MongoRepository | SQLiteRepository: the repository
     """
-    response_time = (datetime.now() - start_time).total_seconds() * 1000  # milliseconds
-    db[collection].insert_one(
-        {
-            "endpoint": endpoint,
-            "method": method,
-            "time": datetime.now(),
-            "response_code": response_code,
-            "response_message": response_message,
-            "response_time": response_time,
-        }
-    )
+    global repository
+    with repository_lock:
+        if repository is None:
+            repository = create_repository(MongoRepository, SQLiteRepository)
+        return repository
 
 
 def capitalize_words_after_last_slash(url: str) -> str:
@@ -124,16 +229,188 @@ def capitalize_words_after_last_slash(url: str) -> str:
     return capitalized_words
 
 
-@app.route("/last_scraped", methods=["GET"])
+def parse_measurement(text: str, unit: str, lowest: float, highest: float) -> float:
+    """Converts a measurement as shown on the PDGA website to a number.
+
+    e.g., 21.1cm -> 21.1
+
+    Args:
+        text (str): measurement with its unit e.g., 21.1cm
+        unit (str): unit the measurement is expected in e.g., cm
+        lowest (float): lowest valid value
+        highest (float): highest valid value
+
+    Returns:
+        float: the measurement, or None if it is not a valid number in that unit
+    """
+    value = text.strip()
+    if unit and value.endswith(unit):
+        value = value[: -len(unit)]
+    try:
+        number = float(value)
+    except ValueError:
+        return None
+    if not math.isfinite(number) or not lowest <= number <= highest:
+        return None
+    return number
+
+
+def build_disc_specs(disc: dict) -> dict:
+    """Normalizes the scraped text of a disc into typed values, so that other services
+    can read its measurements as numbers. Values that are missing or do not validate
+    are None.
+
+    Args:
+        disc (dict): disc information as scraped, measurements with their units
+
+    Returns:
+        dict: the version of the specs, the approval date as a datetime and every
+            measurement in DISC_SPECS as a float in its unit
+    """
+    specs = {"version": SPECS_VERSION}
+    try:
+        specs["approved_date"] = datetime.strptime(
+            disc.get("approved_date") or "", APPROVED_DATE_FORMAT
+        )
+    except ValueError:
+        specs["approved_date"] = None
+    for field, (typed_field, unit, lowest, highest) in DISC_SPECS.items():
+        text = disc.get(field)
+        specs[typed_field] = (
+            parse_measurement(text, unit, lowest, highest)
+            if isinstance(text, str)
+            else None
+        )
+    invalid = [field for field, value in specs.items() if value is None]
+    if invalid:
+        print(f"Invalid specs for {disc.get('url')}: {', '.join(invalid)}")
+    return specs
+
+
+def backfill_disc_specs(repository) -> int:
+    """Adds the current typed specs to the discs that were stored without them.
+
+    Args:
+        repository: the repository holding the scraped discs
+
+    Returns:
+        int: how many discs were updated
+    """
+    specs = {
+        disc["url"]: build_disc_specs(disc)
+        for disc in repository.discs_missing_specs(SPECS_VERSION)
+    }
+    if specs:
+        repository.set_disc_specs(specs)
+    return len(specs)
+
+
+def parse_disc_page(content: bytes, url: str) -> dict:
+    """Extracts the disc information from a disc's page on the PDGA website.
+
+    Args:
+        content (bytes): HTML of the disc's page
+        url (str): URL of the disc's page
+
+    Returns:
+        dict: disc information as stored in the database, the text as shown on the
+            page along with its typed specs
+    """
+    soup = bs4.BeautifulSoup(content, "html.parser")
+    # Extract relevant information
+    manufacturer = (
+        soup.find("div", class_="views-field-field-equipment-manuf-ref")
+        .find("span")
+        .text.strip()
+    )
+    approved_date = soup.find("span", class_="date-display-single").text.strip()
+    max_weight = (
+        soup.find("div", class_="views-field-field-disc-max-weight")
+        .find("span", class_="field-content")
+        .text.strip()
+    )
+    diameter = (
+        soup.find("div", class_="views-field-field-disc-outside-diameter")
+        .find("span", class_="field-content")
+        .text.strip()
+    )
+    height = (
+        soup.find("div", class_="views-field-field-disc-height")
+        .find("span", class_="field-content")
+        .text.strip()
+    )
+    rim_depth = (
+        soup.find("div", class_="views-field-field-disc-rim-depth")
+        .find("span", class_="field-content")
+        .text.strip()
+    )
+    rim_thickness = (
+        soup.find("div", class_="views-field-field-disc-rim-thickness")
+        .find("span", class_="field-content")
+        .text.strip()
+    )
+    inside_rim_diameter = (
+        soup.find(
+            "div",
+            class_="views-field-field-disc-inside-rim-diameter",
+        )
+        .find("span", class_="field-content")
+        .text.strip()
+    )
+    rim_depth_diameter_ratio = (
+        soup.find(
+            "div",
+            class_="views-field-field-disc-depth-diameter-ratio",
+        )
+        .find("span", class_="field-content")
+        .text.strip()
+    )
+    rim_config = (
+        soup.find("div", class_="views-field-field-disc-rim-config")
+        .find("span", class_="field-content")
+        .text.strip()
+    )
+    flexibility = (
+        soup.find("div", class_="views-field-field-disc-flexibility")
+        .find("span", class_="field-content")
+        .text.strip()
+    )
+
+    disc = {
+        "url": url,
+        "manufacturer": manufacturer,
+        "name": capitalize_words_after_last_slash(url),
+        "approved_date": approved_date,
+        "max_weight": max_weight,
+        "diameter": diameter,
+        "height": height,
+        "rim_depth": rim_depth,
+        "rim_thickness": rim_thickness,
+        "inside_rim_diameter": inside_rim_diameter,
+        "rim_depth_diameter_ratio": rim_depth_diameter_ratio,
+        "rim_config": rim_config,
+        "flexibility": flexibility,
+    }
+    disc["specs"] = build_disc_specs(disc)
+    return disc
+
+
+@blueprint.route("/last_scraped", methods=["GET"])
 @verify_api_key
 def get_last_scraped():
     start_time = datetime.now()
     global last_scraped
-    db = connect_to_mongodb()
+    repository = get_repository()
     if last_scraped:
         message = last_scraped.strftime("%Y-%m-%d %H:%M:%S")
         write_usage_log(
-            db, USAGE_COLLECTION, "/last_scraped", "GET", 200, message, start_time
+            repository,
+            USAGE_COLLECTION,
+            "/last_scraped",
+            "GET",
+            200,
+            message,
+            start_time,
         )
 
         return (
@@ -143,7 +420,13 @@ def get_last_scraped():
     else:
         message = "Scrape and store endpoint has not been called yet."
         write_usage_log(
-            db, USAGE_COLLECTION, "/last_scraped", "GET", 200, message, start_time
+            repository,
+            USAGE_COLLECTION,
+            "/last_scraped",
+            "GET",
+            200,
+            message,
+            start_time,
         )
         return (
             jsonify({"message": message}),
@@ -151,32 +434,24 @@ def get_last_scraped():
         )
 
 
-@app.route("/scrape_and_store", methods=["POST"])
-@verify_api_key
-def scrape_and_store():
-    """Scrapes the PDGA website and adds the new discs to the database
+def scrape_discs(known_urls: set = frozenset()) -> list:
+    """Scrapes the PDGA's approved disc list and then the page of every disc on it that
+    is not known yet.
+
+    Args:
+        known_urls (set, optional): URLs of the discs that have already been scraped
 
     Returns:
-        JSON: 200 when successful
-              500 when error
+        list: the new discs, in the order they are listed
     """
-    start_time = datetime.now()
-    global last_scraped
-    last_scraped = datetime.now()
-    try:
-        print("Connecting to MongoDB...")
-        db = connect_to_mongodb()
-        print("Connected to MongoDB")
-    except Exception as e:
-        print(f"Error trying to connect to MongoDB: {e}")
-        return jsonify({"error": str(e)}), 500
-    try:
-        print("Parsing HTML...")
-        base_url = "https://www.pdga.com"
-        url = base_url + "/technical-standards/equipment-certification/discs"
+    print("Parsing HTML...")
+    base_url = PDGA_URL
+    url = base_url + "/technical-standards/equipment-certification/discs"
 
+    with span("fetch_listing", url=url):
         response = requests.get(url)
-        soup = BeautifulSoup(response.content, "html.parser")
+    with span("parse_listing") as attributes:
+        soup = bs4.BeautifulSoup(response.content, "html.parser")
 
         links = soup.find_all(
             "a",
@@ -185,134 +460,134 @@ def scrape_and_store():
         )
 
         urls = [base_url + link.get("href") for link in links]
-        print("Parsed HTML")
-
-        new_entries = 0
-        for url in urls:
-            if (
-                "?" not in url and "=" not in url
-            ):  # There are some URLs that are not to discs. This generally takes care of them
+        attributes["links"] = len(urls)
+    print("Parsed HTML")
+
+    discs = []
+    for url in urls:
+        if (
+            "?" not in url and "=" not in url
+        ):  # There are some URLs that are not to discs. This generally takes care of them
+            if url in known_urls:
+                continue
+            with span("fetch_disc", url=url) as attributes:
                 response = requests.get(url)
-                if response.status_code == 200:
-                    soup = BeautifulSoup(response.content, "html.parser")
-                    try:
-                        # Extract relevant information
-                        manufacturer = (
-                            soup.find(
-                                "div", class_="views-field-field-equipment-manuf-ref"
-                            )
-                            .find("span")
-                            .text.strip()
-                        )
-                        approved_date = soup.find(
-                            "span", class_="date-display-single"
-                        ).text.strip()
-                        max_weight = (
-                            soup.find("div", class_="views-field-field-disc-max-weight")
-                            .find("span", class_="field-content")
-                            .text.strip()
-                        )
-                        diameter = (
-                            soup.find(
-                                "div", class_="views-field-field-disc-outside-diameter"
-                            )
-                            .find("span", class_="field-content")
-                            .text.strip()
-                        )
-                        height = (
-                            soup.find("div", class_="views-field-field-disc-height")
-                            .find("span", class_="field-content")
-                            .text.strip()
-                        )
-                        rim_depth = (
-                            soup.find("div", class_="views-field-field-disc-rim-depth")
-                            .find("span", class_="field-content")
-                            .text.strip()
-                        )
-                        rim_thickness = (
-                            soup.find(
-                                "div", class_="views-field-field-disc-rim-thickness"
-                            )
-                            .find("span", class_="field-content")
-                            .text.strip()
-                        )
-                        inside_rim_diameter = (
-                            soup.find(
-                                "div",
-                                class_="views-field-field-disc-inside-rim-diameter",
-                            )
-                            .find("span", class_="field-content")
-                            .text.strip()
-                        )
-                        rim_depth_diameter_ratio = (
-                            soup.find(
-                                "div",
-                                class_="views-field-field-disc-depth-diameter-ratio",
-                            )
-                            .find("span", class_="field-content")
-                            .text.strip()
-                        )
-                        rim_config = (
-                            soup.find("div", class_="views-field-field-disc-rim-config")
-                            .find("span", class_="field-content")
-                            .text.strip()
-                        )
-                        flexibility = (
-                            soup.find(
-                                "div", class_="views-field-field-disc-flexibility"
-                            )
-                            .find("span", class_="field-content")
-                            .text.strip()
-                        )
-
-                        existing_doc = db[COLLECTION].find_one({"url": url})
-
-                        if (
-                            existing_doc is None
-                        ):  # Ensures there is no duplicates being added
-                            db[COLLECTION].insert_one(
-                                {
-                                    "url": url,
-                                    "manufacturer": manufacturer,
-                                    "name": capitalize_words_after_last_slash(url),
-                                    "approved_date": approved_date,
-                                    "max_weight": max_weight,
-                                    "diameter": diameter,
-                                    "height": height,
-                                    "rim_depth": rim_depth,
-                                    "rim_thickness": rim_thickness,
-                                    "inside_rim_diameter": inside_rim_diameter,
-                                    "rim_depth_diameter_ratio": rim_depth_diameter_ratio,
-                                    "rim_config": rim_config,
-                                    "flexibility": flexibility,
-                                }
-                            )
-                            print(f"Successfully inserted {url}")
-                            new_entries += 1
-                    except Exception as e:
-                        print(f"Error occured for url {url}: {e}")
-
-        global preds_run
-        preds_run = False
-        if new_entries > 0:
-            preds_run = True
-            url = config["urls"]["prediction"]
-            headers = {"X-API-KEY": config["auth"]["api_key"]}
-            try:
-                response = requests.post(url, headers=headers)
-                print(f"Prediction service ran: {response}")
-                if response.status_code == 401:
-                    print("Unauthorized: Invalid API key")
-                elif response.status_code != 200:
-                    print(f"Error: {response.json()}")
-            except Exception as e:
-                print(
-                    f"The prediction service was triggered but there was an error in running it: {e}"
-                )
+                attributes["status_code"] = response.status_code
+            if response.status_code == 200:
+                try:
+                    with span("parse_disc", url=url):
+                        discs.append(parse_disc_page(response.content, url))
+                except Exception as e:
+                    print(f"Error occured for url {url}: {e}")
+    return discs
+
+
+def publish_discs_scraped(urls: list) -> bool:
+    """Publishes a discs_scraped event, trying PUBLISH_ATTEMPTS times.
+
+    Args:
+        urls (list): URLs of the stored discs
+
+    Returns:
+        bool: whether a job was queued, False if the same discs were already queued
+    """
+    for attempt in range(1, PUBLISH_ATTEMPTS + 1):
+        try:
+            return publish_event(EVENT_DISCS_SCRAPED, {"urls": urls})
+        except Exception as e:
+            if attempt == PUBLISH_ATTEMPTS:
+                raise
+            print(f"Error queueing the prediction job, attempt {attempt}: {e}")
+            time.sleep(PUBLISH_RETRY_DELAY * 2 ** (attempt - 1))
+
+
+def store_new_discs() -> str:
+    """Scrapes the discs that are not in the database yet, adds them to it and queues
+    a prediction job for them. The discs of an earlier run whose job could not be
+    queued are queued along with them, since they are not new to later scrapes.
 
-        message = f"Data scraped and stored successfully. {new_entries} discs added to {DB_NAME}/{COLLECTION}. {'Prediction service triggered.' if preds_run else ''}"
+    Returns:
+        str: status message
+    """
+    global preds_run
+    repository = get_repository()
+    discs = scrape_discs(repository.disc_urls())
+
+    new_urls = []
+    if discs:
+        check_lock()
+        with span("store_discs", discs=len(discs)) as attributes:
+            # Discs stored by a concurrent run in the meantime are skipped
+            new_urls = [disc["url"] for disc in repository.insert_discs(discs)]
+            attributes["inserted"] = len(new_urls)
+        print(f"Successfully inserted {len(new_urls)} discs")
+
+    preds_run = False
+    urls = unpublished_urls + new_urls
+    if urls:
+        try:
+            with span("publish_discs_scraped", discs=len(urls)) as attributes:
+                preds_run = publish_discs_scraped(urls)
+                attributes["queued"] = preds_run
+        except Exception as e:
+            unpublished_urls[:] = urls
+            raise RuntimeError(
+                f"{len(new_urls)} discs were stored but the prediction job for "
+                f"{len(urls)} discs could not be queued: {e}"
+            ) from e
+        unpublished_urls.clear()
+
+    return f"Data scraped and stored successfully. {len(new_urls)} discs added to {DB_NAME}/{COLLECTION}. {'Prediction job queued.' if preds_run else ''}"
+
+
+@blueprint.route("/scrape_and_store", methods=["POST"])
+@verify_api_key
+@traced("scrape_and_store", APP_NAME)
+def scrape_and_store():
+    """Scrapes the PDGA website and adds the new discs to the database. When a scrape
+    is already running, it is run once more after it finishes instead.
+
+    Returns:
+        JSON: 200 when successful
+              202 when a scrape is already running
+              500 when error
+    """
+    start_time = datetime.now()
+    global last_scraped
+    last_scraped = datetime.now()
+    try:
+        print(f"Connecting to {STORAGE_BACKEND}...")
+        repository = get_repository()
+        print(f"Connected to {STORAGE_BACKEND}")
+    except Exception as e:
+        print(f"Error trying to connect to {STORAGE_BACKEND}: {e}")
+        return jsonify({"error": str(e)}), 500
+    try:
+        with span("run_exclusively") as attributes:
+            message = run_exclusively("scrape_and_store", store_new_discs)
+            attributes["coalesced"] = message is None
+        if message is None:
+            message = (
+                "A scrape is already running. It will run once more when it finishes."
+            )
+            write_usage_log(
+                repository,
+                USAGE_COLLECTION,
+                "/scrape_and_store",
+                "POST",
+                202,
+                message,
+                start_time,
+            )
+            return jsonify({"message": message}), 202
         write_usage_log(
-            db, USAGE_COLLECTION, "/scrape_and_store", "POST", 200, message, start_time
+            repository,
+            USAGE_COLLECTION,
+            "/scrape_and_store",
+            "POST",
+            200,
+            message,
+            start_time,
         )
         return (
             jsonify({"message": message}),
@@ -320,51 +595,85 @@ def scrape_and_store():
         )
     except Exception as e:
         write_usage_log(
-            db, USAGE_COLLECTION, "/scrape_and_store", "POST", 500, str(e), start_time
+            repository,
+            USAGE_COLLECTION,
+            "/scrape_and_store",
+            "POST",
+            500,
+            str(e),
+            start_time,
         )
         return jsonify({"error": str(e)}), 500
 
 
-@app.route("/admin", methods=["GET"])
+@blueprint.route("/admin", methods=["GET"])
 def admin():
     auth = request.authorization
 
     if not auth or not check_auth(auth.username, auth.password):
         return authenticate()
 
-    db = connect_to_mongodb()
-    collection = db[USAGE_COLLECTION]
-
-    pipeline = [
-        {
-            "$group": {
-                "_id": "$endpoint",
-                "count": {"$sum": 1},
-                "last_run": {"$max": "$time"},
-                "average_time": {
-                    "$avg": "$response_time"
-                },  # Calculate average response time
-            }
-        },
-    ]
-
-    aggregation_result = list(collection.aggregate(pipeline))
-
-    endpoint_data = {
-        item["_id"]: {
-            "count": item["count"],
-            "last_run": item["last_run"],
-            "average_time": (
-                round(item["average_time"], 2) if item["average_time"] else 0
-            ),  # Round to 2 decimal places
-        }
-        for item in aggregation_result
-    }
+    try:
+        before, before_id = parse_log_cursor(request.args["before"])
+    except (KeyError, ValueError):
+        before, before_id = datetime.now(), None
+    limit = min(max(request.args.get("limit", 100, type=int), 1), ADMIN_LOG_PAGE_LIMIT)
+
+    repository = get_repository()
+    endpoint_data, hourly = repository.usage_summary(USAGE_COLLECTION)
+    entries, next_before = repository.usage_log_page(
+        USAGE_COLLECTION, before, limit, before_id
+    )
+    try:
+        jobs = get_job_queue().counts()
+    except Exception as e:
+        print(f"Error counting jobs: {e}")
+        jobs = {}
+
+    return render_template(
+        "admin.html",
+        endpoint_data=endpoint_data,
+        hourly=hourly,
+        log=entries,
+        next_before=next_before,
+        limit=limit,
+        pool=pool_metrics.snapshot(),
+        process_metrics=summarize_request_metrics(),
+        jobs=jobs,
+    )
 
-    all_entries = list(collection.find({}, {"_id": 0}).sort("time", -1))
 
-    return render_template("admin.html", endpoint_data=endpoint_data, log=all_entries)
+def create_app() -> Flask:
+    """Creates the Flask app of the service. Heavy dependencies and clients are
+    created on first use, so this is quick.
+
+    Returns:
+        Flask: the app
+    """
+    set_app_name(APP_NAME)
+    app = Flask(__name__)
+    app.register_blueprint(blueprint)
+    app.register_blueprint(monitoring.blueprint)
+    app.register_blueprint(tracing.blueprint)
+    return app
+
+
+app = create_app()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scrapes the PDGA approved discs")
+    parser.add_argument(
+        "--backfill-specs",
+        action="store_true",
+        help="add the typed specs to the stored discs that lack them and exit",
+    )
+    args = parser.parse_args()
+
+    if args.backfill_specs:
+        print(f"{backfill_disc_specs(get_repository())} discs backfilled")
+        sys.exit(0)
+
+    # Exit normally on SIGTERM so that buffered usage logs are flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     app.run(host="0.0.0.0", port=8001)
@@ -1,139 +1,262 @@
-import configparser
+import io
+import signal
+import sys
+import threading
 from datetime import datetime
-import pymongo
-import tweepy
-from flask import Flask, jsonify, render_template, request
-from functools import wraps
+from flask import Blueprint, Flask, jsonify, render_template, request
+
+from services.common import monitoring, storage, tracing
+from services.common.auth import authenticate, check_auth, verify_api_key
+from services.common.config import config
+from services.common.jobs import (
+    EVENT_PREDICTIONS_READY,
+    get_job_queue,
+    start_job_worker,
+)
+from services.common.lazy import LazyModule
+from services.common.monitoring import summarize_request_metrics
+from services.common.storage import (
+    create_repository,
+    decode_document,
+    pool_metrics,
+    set_app_name,
+)
+from services.common.tracing import span, traced
+from services.common.usage import (
+    ADMIN_LOG_PAGE_LIMIT,
+    parse_log_cursor,
+    write_usage_log,
+)
+
+tweepy = LazyModule("tweepy")
 
 
 """
 Twitter service which publishes the newly made predictions to the Twitter feed.
 """
-config = configparser.ConfigParser()
-config.read("config.ini")
 
 API_KEY = config["twitter"]["api_key"]
 API_KEY_SECRET = config["twitter"]["api_key_secret"]
 ACCESS_TOKEN = config["twitter"]["access_token"]
 ACCESS_TOKEN_SECRET = config["twitter"]["access_token_secret"]
-URI = config["mongodb"]["uri"]
-DB_NAME = config["mongodb"]["db_name"]
 PREDICTION_COLLECTION = config["mongodb"]["prediction_collection"]
+CHART_COLLECTION = config.get("mongodb", "chart_collection", fallback="charts")
 USAGE_COLLECTION = config["mongodb"]["twitter_usage"]
-ADMIN_USERNAME = config["admin"]["username"]
-ADMIN_PASSWORD = config["admin"]["password"]
+APP_NAME = "pdga-twitter"
 
-app = Flask(__name__)
+blueprint = Blueprint("twitter", __name__)
 
-apiv2 = tweepy.Client(
-    consumer_key=API_KEY,
-    consumer_secret=API_KEY_SECRET,
-    access_token=ACCESS_TOKEN,
-    access_token_secret=ACCESS_TOKEN_SECRET,
-)
+repository = None
+repository_lock = threading.Lock()
 
 
-def connect_to_mongodb() -> pymongo.MongoClient:
-    """Makes connection to MongoDB
+twitter_client = None
+twitter_api = None
+twitter_client_lock = threading.Lock()
 
-    Returns:
-        MongoClient: Instance of MongoDB
+
+class MongoRepository(storage.MongoRepository):
+    """Reads the predictions to tweet and their flight charts from MongoDB.
+
+    Args:
+        db (Database, optional): database to use. Defaults to the one of the shared
+            MongoClient.
     """
 
-    client = pymongo.MongoClient(URI)
+    def untweeted_predictions(self, urls: list = None) -> list:
+        """Returns the predictions that have not been tweeted, of the given discs if
+        there are any."""
+        query = {"tweeted": False}
+        if urls is not None:
+            query["url"] = {"$in": urls}
+        return list(self.db()[PREDICTION_COLLECTION].find(query))
+
+    def mark_tweeted(self, prediction: dict):
+        """Marks a prediction as tweeted."""
+        self.db()[PREDICTION_COLLECTION].update_one(
+            {"_id": prediction["_id"]}, {"$set": {"tweeted": True}}
+        )
+
+    def chart(self, key: str, image_format: str) -> bytes:
+        """Returns a flight chart as svg or png, None if it is not stored."""
+        chart = self.db()[CHART_COLLECTION].find_one({"_id": key}, {image_format: 1})
+        return None if chart is None else bytes(chart[image_format])
+
+
+class SQLiteRepository(storage.SQLiteRepository):
+    """Reads the same data from the embedded SQLite database, for single-node
+    deployments without MongoDB.
+
+    Args:
+        path (str, optional): path of the database file. Defaults to
+            STORAGE_SQLITE_PATH.
+    """
 
-    db = client[DB_NAME]
-    return db
+    def untweeted_predictions(self, urls: list = None) -> list:
+        """Returns the predictions that have not been tweeted, of the given discs if
+        there are any."""
+        query = "SELECT document FROM predictions WHERE tweeted = 0"
+        parameters = []
+        if urls is not None:
+            query += f" AND url IN ({', '.join('?' * len(urls))})"
+            parameters = urls
+        rows = self.connection().execute(query + " ORDER BY id", parameters)
+        predictions = [decode_document(row["document"]) for row in rows]
+        for prediction in predictions:
+            prediction["tweeted"] = False
+        return predictions
+
+    def mark_tweeted(self, prediction: dict):
+        """Marks a prediction as tweeted."""
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE predictions SET tweeted = 1 WHERE url = ?", (prediction["url"],)
+            )
 
+    def chart(self, key: str, image_format: str) -> bytes:
+        """Returns a flight chart as svg or png, None if it is not stored."""
+        row = (
+            self.connection()
+            .execute("SELECT svg, png FROM charts WHERE key = ?", (key,))
+            .fetchone()
+        )
+        return None if row is None else bytes(row[image_format])
 
-def verify_api_key(func):
-    """Used to verify access across APIs"""
 
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        provided_api_key = request.headers.get("X-API-KEY")
-        if not provided_api_key:
-            return jsonify({"message": "API key is missing"}), 401
+def get_repository():
+    """Returns the repository of the configured storage backend, creating it on first
+    use.
 
-        config_api_key = config["auth"]["api_key"]
-        if provided_api_key != config_api_key:
-            return jsonify({"message": "Invalid API key"}), 401
+    Returns:
+        MongoRepository | SQLiteRepository: the repository
+    """
+    global repository
+    with repository_lock:
+        if repository is None:
+            repository = create_repository(MongoRepository, SQLiteRepository)
+        return repository
 
-        return func(*args, **kwargs)
 
-    return wrapper
+def get_twitter_client():
+    """Returns the X API client, creating it on first use.
 
+    Returns:
+        tweepy.Client: the client
+    """
+    global twitter_client
+    with twitter_client_lock:
+        if twitter_client is None:
+            twitter_client = tweepy.Client(
+                consumer_key=API_KEY,
+                consumer_secret=API_KEY_SECRET,
+                access_token=ACCESS_TOKEN,
+                access_token_secret=ACCESS_TOKEN_SECRET,
+            )
+        return twitter_client
 
-def check_auth(username, password):
-    """Check if a username and password are valid to view the admin page."""
-    return username == ADMIN_USERNAME and password == ADMIN_PASSWORD
 
+def get_twitter_api():
+    """Returns the client of the X API v1.1, which media is uploaded with, creating it
+    on first use.
 
-def authenticate():
-    """Send a 401 response that enables basic auth."""
-    return (
-        "Unauthorized access. Please provide valid credentials.",
-        401,
-        {"WWW-Authenticate": 'Basic realm="Login Required"'},
-    )
+    Returns:
+        tweepy.API: the client
+    """
+    global twitter_api
+    with twitter_client_lock:
+        if twitter_api is None:
+            twitter_api = tweepy.API(
+                tweepy.OAuth1UserHandler(
+                    API_KEY, API_KEY_SECRET, ACCESS_TOKEN, ACCESS_TOKEN_SECRET
+                )
+            )
+        return twitter_api
 
 
-def write_usage_log(
-    db: pymongo.MongoClient,
-    collection: str,
-    endpoint: str,
-    method: str,
-    response_code: int,
-    response_message: str,
-    start_time: datetime.now,
-):
-    """Writes a log to MongoDB database
+def compose_tweet(entry: dict) -> str:
+    """Writes the tweet announcing a disc's predicted flight numbers.
 
     Args:
-        db (pymongo.MongoClient): the database to write the log to
-        collection (str): the colleciton within the database
-        endpoint (str): the endpoint called
-        method (str): the ReST method used to call the endpoint
-        response_code (int): the response code returned
-        response_message (str): the message returned
-        start_time (datetime): used to determine the response time of the endpoint
+        entry (dict): prediction of the disc
+
+    Returns:
+        str: text of the tweet
     """
-    response_time = (datetime.now() - start_time).total_seconds() * 1000  # milliseconds
-    db[collection].insert_one(
-        {
-            "endpoint": endpoint,
-            "method": method,
-            "time": datetime.now(),
-            "response_code": response_code,
-            "response_message": response_message,
-            "response_time": response_time,
-        }
-    )
+    return f"{entry['manufacturer']} {entry['name']} has been approved. Estimated flight numbers:\nSPEED: {int(entry['SPEED'])}\nGLIDE: {int(entry['GLIDE'])}\nTURN : {int(entry['TURN'])}\nFADE : {int(entry['FADE'])}\n\nSee it here: {entry['url']}"
 
 
-@app.route("/create_tweet", methods=["POST"])
-@verify_api_key
-def create_tweet():
-    start_time = datetime.now()
-    try:
-        db = connect_to_mongodb()
-        prediction_collection = db[PREDICTION_COLLECTION]
-        entries_to_tweet = prediction_collection.find({"tweeted": False})
+def post_tweet(entry: dict, repository):
+    """Tweets a prediction with its flight chart from the chart cache attached. The
+    tweet is posted without the chart when it is not in the cache or cannot be
+    uploaded.
 
-        new_tweets = 0
-        for entry in entries_to_tweet:
-            tweet_text = f"{entry['manufacturer']} {entry['name']} has been approved. Estimated flight numbers:\nSPEED: {int(entry['SPEED'])}\nGLIDE: {int(entry['GLIDE'])}\nTURN : {int(entry['TURN'])}\nFADE : {int(entry['FADE'])}\n\nSee it here: {entry['url']}"
+    Args:
+        entry (dict): prediction of the disc
+        repository (MongoRepository | SQLiteRepository): where the charts are stored
+    """
+    tweet = {"text": compose_tweet(entry), "user_auth": True}
+    if entry.get("chart"):
+        try:
+            chart = repository.chart(entry["chart"], "png")
+            if chart is not None:
+                with span("upload_chart", chart=entry["chart"]):
+                    media = get_twitter_api().media_upload(
+                        filename=f"{entry['chart']}.png", file=io.BytesIO(chart)
+                    )
+                tweet["media_ids"] = [media.media_id]
+        except Exception as e:
+            print(f"Error attaching the flight chart of {entry['url']}: {e}")
+    get_twitter_client().create_tweet(**tweet)
+
+
+def tweet_predictions(urls: list = None) -> str:
+    """Tweets the predictions that have not been tweeted yet. Each prediction is
+    marked as tweeted before it is posted, so a job that is delivered again does not
+    tweet it twice.
+
+    Args:
+        urls (list, optional): only tweet the predictions of these discs
+
+    Returns:
+        str: status message
+    """
+    repository = get_repository()
+    with span("fetch_untweeted"):
+        entries_to_tweet = repository.untweeted_predictions(urls)
+
+    new_tweets = 0
+    for entry in entries_to_tweet:
+        with span("mark_tweeted", url=entry["url"]):
+            repository.mark_tweeted(entry)
+
+        with span("post_tweet", url=entry["url"]):
+            post_tweet(entry, repository)
+        new_tweets += 1
+
+    return f"{new_tweets} tweets created successfully."
 
-            prediction_collection.update_one(
-                {"_id": entry["_id"]}, {"$set": {"tweeted": True}}
-            )
 
-            apiv2.create_tweet(text=tweet_text, user_auth=True)
-            new_tweets += 1
+def handle_predictions_ready(payload: dict) -> str:
+    """Tweets the predictions of a predictions_ready job."""
+    return tweet_predictions(payload["urls"])
 
-        message = f"{new_tweets} tweets created successfully."
+
+@blueprint.route("/create_tweet", methods=["POST"])
+@verify_api_key
+@traced("create_tweet", APP_NAME)
+def create_tweet():
+    start_time = datetime.now()
+    try:
+        repository = get_repository()
+        message = tweet_predictions()
         write_usage_log(
-            db, USAGE_COLLECTION, "/create_tweet", "POST", 200, message, start_time
+            repository,
+            USAGE_COLLECTION,
+            "/create_tweet",
+            "POST",
+            200,
+            message,
+            start_time,
         )
         return (
             jsonify({"message": message}),
@@ -142,51 +265,76 @@ def create_tweet():
 
     except Exception as e:
         write_usage_log(
-            db, USAGE_COLLECTION, "/create_tweet", "POST", 500, str(e), start_time
+            repository,
+            USAGE_COLLECTION,
+            "/create_tweet",
+            "POST",
+            500,
+            str(e),
+            start_time,
         )
         return jsonify({"error": str(e)}), 500
 
 
-@app.route("/admin", methods=["GET"])
+@blueprint.route("/admin", methods=["GET"])
 def admin():
     auth = request.authorization
 
     if not auth or not check_auth(auth.username, auth.password):
         return authenticate()
 
-    db = connect_to_mongodb()
-    collection = db[USAGE_COLLECTION]
+    try:
+        before, before_id = parse_log_cursor(request.args["before"])
+    except (KeyError, ValueError):
+        before, before_id = datetime.now(), None
+    limit = min(max(request.args.get("limit", 100, type=int), 1), ADMIN_LOG_PAGE_LIMIT)
+
+    repository = get_repository()
+    endpoint_data, hourly = repository.usage_summary(USAGE_COLLECTION)
+    entries, next_before = repository.usage_log_page(
+        USAGE_COLLECTION, before, limit, before_id
+    )
+    try:
+        jobs = get_job_queue().counts()
+    except Exception as e:
+        print(f"Error counting jobs: {e}")
+        jobs = {}
+
+    return render_template(
+        "admin.html",
+        endpoint_data=endpoint_data,
+        hourly=hourly,
+        log=entries,
+        next_before=next_before,
+        limit=limit,
+        pool=pool_metrics.snapshot(),
+        process_metrics=summarize_request_metrics(),
+        jobs=jobs,
+    )
 
-    pipeline = [
-        {
-            "$group": {
-                "_id": "$endpoint",
-                "count": {"$sum": 1},
-                "last_run": {"$max": "$time"},
-                "average_time": {
-                    "$avg": "$response_time"
-                },  # Calculate average response time
-            }
-        },
-    ]
 
-    aggregation_result = list(collection.aggregate(pipeline))
+def create_app() -> Flask:
+    """Creates the Flask app of the service. Heavy dependencies and clients are
+    created on first use, so this is quick.
 
-    endpoint_data = {
-        item["_id"]: {
-            "count": item["count"],
-            "last_run": item["last_run"],
-            "average_time": (
-                round(item["average_time"], 2) if item["average_time"] else 0
-            ),  # Round to 2 decimal places
-        }
-        for item in aggregation_result
-    }
+    Returns:
+        Flask: the app
+    """
+    set_app_name(APP_NAME)
+    app = Flask(__name__)
+    app.register_blueprint(blueprint)
+    app.register_blueprint(monitoring.blueprint)
+    app.register_blueprint(tracing.blueprint)
+    return app
 
-    all_entries = list(collection.find({}, {"_id": 0}).sort("time", -1))
 
-    return render_template("admin.html", endpoint_data=endpoint_data, log=all_entries)
+app = create_app()
 
 
 if __name__ == "__main__":
+    # Exit normally on SIGTERM so that buffered usage logs are flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    start_job_worker(
+        EVENT_PREDICTIONS_READY, handle_predictions_ready, APP_NAME, USAGE_COLLECTION
+    )
     app.run(host="0.0.0.0", port=8004)
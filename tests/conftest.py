@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+
+"""
+Points the services at a throwaway configuration when there is no config.ini to test
+with. It is written before any test module imports a service, since the services read
+their configuration when they are imported.
+"""
+TEST_CONFIG = """\
+[mongodb]
+uri = mongodb://localhost:1/?serverSelectionTimeoutMS=200
+db_name = pdga
+scraper_collection = discs
+prediction_collection = predictions
+frontend_usage = frontend_usage
+scraper_usage = scraper_usage
+prediction_usage = prediction_usage
+twitter_usage = twitter_usage
+[admin]
+username = admin
+password = pw
+[auth]
+api_key = key
+[tebi]
+access_key = a
+secret_key = b
+endpoint_url = http://localhost:1
+bucket_name = models
+[twitter]
+api_key = a
+api_key_secret = b
+access_token = c
+access_token_secret = d
+[urls]
+prediction = http://localhost:1/predict
+twitter = http://localhost:1/create_tweet
+"""
+config_dir = None
+
+
+def pytest_configure(config):
+    global config_dir
+    if "PDGA_CONFIG" in os.environ or os.path.exists("config.ini"):
+        return
+    config_dir = tempfile.mkdtemp(prefix="pdga-test-config-")
+    path = os.path.join(config_dir, "config.ini")
+    with open(path, "w") as file:
+        file.write(TEST_CONFIG)
+    os.environ["PDGA_CONFIG"] = path
+
+
+def pytest_unconfigure(config):
+    if config_dir is not None:
+        os.environ.pop("PDGA_CONFIG", None)
+        shutil.rmtree(config_dir, ignore_errors=True)
@@ -0,0 +1,113 @@
+import pytest
+from unittest.mock import patch, MagicMock
+from werkzeug.test import Client
+
+from services import all_in_one
+from services.all_in_one import create_app, InMemoryJobQueue, run_pipeline
+from services.common import jobs, storage
+
+
+@pytest.fixture(autouse=True)
+def restore_job_queue():
+    saved = jobs.job_queue, jobs.JOB_POLL_INTERVAL, storage.app_name
+    last_scraped = all_in_one.scraper.last_scraped
+    yield
+    all_in_one.scraper.last_scraped = last_scraped
+    jobs.job_queue, jobs.JOB_POLL_INTERVAL, storage.app_name = saved
+
+
+def test_in_memory_job_queue():
+    job_queue = InMemoryJobQueue()
+    assert job_queue.publish("discs_scraped", {"urls": ["a"]}, "key", {})
+    assert not job_queue.publish("discs_scraped", {"urls": ["a"]}, "key", {})
+
+    job = job_queue.claim("discs_scraped")
+    assert job["payload"] == {"urls": ["a"]}
+    assert job["attempts"] == 1
+    with patch("services.all_in_one.CLAIM_TIMEOUT", 0.01):
+        assert job_queue.claim("discs_scraped") is None
+
+    job_queue.ack(job)
+    assert job_queue.counts() == {"discs_scraped": {"done": 1}}
+
+
+def test_in_memory_job_queue_gives_up():
+    job_queue = InMemoryJobQueue()
+    job_queue.publish("discs_scraped", {"urls": ["a"]}, "key", {})
+    with patch("services.common.jobs.JOB_MAX_ATTEMPTS", 1):
+        job_queue.fail(job_queue.claim("discs_scraped"), "error")
+
+    assert job_queue.counts() == {"discs_scraped": {"dead": 1}}
+
+
+def test_create_app_mounts_services():
+    app = create_app(start_workers=False)
+    client = Client(app)
+
+    assert client.get("/scraper/last_scraped").status_code == 401
+    assert client.post("/prediction/predict").status_code == 401
+    assert client.post("/twitter/create_tweet").status_code == 401
+    assert client.get("/metrics").status_code == 401  # the front end's
+    assert isinstance(jobs.job_queue, InMemoryJobQueue)
+    assert storage.app_name == all_in_one.APP_NAME
+
+
+def test_run_pipeline():
+    mock_db = MagicMock()
+    mock_collection = mock_db.__getitem__.return_value
+    mock_collection.find.return_value = [{"url": "known"}]
+    discs = [{"url": "a"}, {"url": "b"}]
+    predictions = [
+        {
+            "url": url,
+            "manufacturer": "M",
+            "name": url,
+            "SPEED": 9,
+            "GLIDE": 5,
+            "TURN": -1,
+            "FADE": 2,
+            "tweeted": False,
+        }
+        for url in ["a", "b"]
+    ]
+
+    with patch.object(
+        all_in_one.scraper, "repository", all_in_one.scraper.MongoRepository(mock_db)
+    ), patch.object(
+        all_in_one.scraper, "scrape_discs", return_value=discs
+    ) as mock_scrape, patch.object(
+        all_in_one.prediction, "predict_discs", return_value=predictions
+    ), patch.object(
+        all_in_one.prediction,
+        "upload_predictions_to_mongodb",
+        side_effect=lambda predictions, collection_name: predictions,
+    ) as mock_upload, patch.object(
+        all_in_one.prediction, "update_aggregate_rollups"
+    ), patch.object(
+        all_in_one.prediction, "update_similarity_index"
+    ), patch.object(
+        all_in_one.prediction, "render_flight_charts"
+    ), patch.object(
+        all_in_one.twitter, "repository", MagicMock(chart=MagicMock(return_value=None))
+    ) as mock_twitter_repository, patch.object(
+        all_in_one.twitter,
+        "get_twitter_client",
+        return_value=MagicMock(
+            create_tweet=MagicMock(side_effect=[None, Exception("error")])
+        ),
+    ):
+        result = run_pipeline()
+
+    mock_scrape.assert_called_once_with({"known"})
+    mock_collection.insert_many.assert_called_once_with(discs, ordered=False)
+    mock_upload.assert_called_once()
+    # Stored as not tweeted, then marked one by one before being tweeted
+    assert [entry["tweeted"] for entry in mock_upload.call_args.args[0]] == [
+        False,
+        False,
+    ]
+    marked = mock_twitter_repository.mark_tweeted.call_args_list
+    assert [call.args[0]["url"] for call in marked] == ["a", "b"]
+    assert result["discs"] == 2
+    assert result["tweets"] == 1
+    assert set(result["seconds"]) == {"scrape", "predict", "tweet", "store"}
@@ -1,21 +1,32 @@
-import configparser
+import gzip
+import json
+import os
 import pytest
-from datetime import datetime
-from unittest.mock import patch
+from datetime import datetime, timedelta
+from unittest.mock import patch, MagicMock
 
+from services.frontend import frontend
 from services.frontend.frontend import (
     app,
     authenticate,
     check_auth,
-    connect_to_mongodb,
+    DiscRow,
+    export_static_site,
     format_date,
+    get_pipeline_dashboard,
+    IndexPage,
+    MongoRepository,
+    page_cache,
+    PredictionSnapshot,
     prepare_for_table,
+    SearchIndex,
+    SQLiteRepository,
+    sync_predictions,
 )
+from services.common.auth import ADMIN_PASSWORD, ADMIN_USERNAME
+from services.common.config import config
+from services.common.storage import close_mongo_client, connect_to_mongodb
 
-config = configparser.ConfigParser()
-config.read("config.ini")
-ADMIN_USERNAME = config["admin"]["username"]
-ADMIN_PASSWORD = config["admin"]["password"]
 API_KEY = config["auth"]["api_key"]
 
 
@@ -27,9 +38,22 @@ def client():
 
 
 def test_connect_to_mongodb():
-    with patch("services.prediction.prediction.pymongo.MongoClient") as mock_client:
+    close_mongo_client()
+    with patch("services.common.storage.pymongo.MongoClient") as mock_client:
+        connect_to_mongodb()
         connect_to_mongodb()
         mock_client.assert_called_once()
+    close_mongo_client()
+
+
+def test_connect_to_mongodb_after_fork():
+    close_mongo_client()
+    with patch("services.common.storage.pymongo.MongoClient") as mock_client:
+        connect_to_mongodb()
+        with patch("services.common.storage.os.getpid", return_value=-1):
+            connect_to_mongodb()
+        assert mock_client.call_count == 2
+    close_mongo_client()
 
 
 def test_check_auth_valid_credentials():
@@ -67,6 +91,13 @@ def test_prepare_for_table(sample_input_dict):
     assert result["other_field"] == "value"
 
 
+def test_prepare_for_table_from_specs(sample_input_dict):
+    sample_input_dict["specs"] = {"approved_date": datetime(2024, 4, 23)}
+    result = prepare_for_table(sample_input_dict)
+
+    assert result["approved_date"].strftime("%Y-%m-%d") == "2024-04-23"
+
+
 def test_format_date():
     date_time = datetime(2024, 4, 23, 12, 0)
     result = format_date(date_time)
@@ -78,3 +109,393 @@ def test_index_returns_200(client):
     response = client.get("/")
 
     assert response.status_code == 200
+
+
+@pytest.fixture
+def cached_page_client(client):
+    frontend.prediction_snapshot = None
+    page_cache.update({"version": None, "page": None})
+    mock_db = MagicMock()
+    mock_db.__getitem__.return_value.find.return_value.sort.return_value = [
+        {
+            "_id": 1,
+            "manufacturer": "TestManufacturer",
+            "name": "TestName",
+            "url": "http://test.url",
+        }
+    ]
+    with patch(
+        "services.common.storage.connect_to_mongodb", return_value=mock_db
+    ), patch("services.frontend.frontend.start_replica_sync") as mock_start:
+        yield client, mock_db, mock_start
+    frontend.prediction_snapshot = None
+    page_cache.update({"version": None, "page": None})
+
+
+def test_snapshot_extend():
+    snapshot = PredictionSnapshot()
+    extended = snapshot.extend(
+        [{"_id": 1, "name": "A", "approved_date": datetime(2024, 4, 23)}]
+    )
+
+    assert len(snapshot.rows) == 0
+    assert len(extended.rows) == 1
+    assert extended.last_id == 1
+    assert extended.rows[0].approved_date == "2024-04-23"
+    assert extended.rows[0].manufacturer == ""
+    assert extended.version != snapshot.version
+    assert snapshot.extend([]) is snapshot
+
+
+def test_disc_row_is_read_only():
+    row = DiscRow({"name": "A"})
+    with pytest.raises(AttributeError):
+        row.name = "B"
+
+
+def test_sync_predictions_is_incremental():
+    mock_db = MagicMock()
+    mock_find = mock_db.__getitem__.return_value.find
+    mock_find.return_value.sort.return_value = [{"_id": 5, "name": "A"}]
+    snapshot = sync_predictions(MongoRepository(mock_db), PredictionSnapshot())
+
+    mock_find.return_value.sort.return_value = []
+    assert sync_predictions(MongoRepository(mock_db), snapshot) is snapshot
+    assert mock_find.call_args[0][0] == {"_id": {"$gt": 5}}
+
+
+def test_index_served_from_cache(cached_page_client):
+    client, mock_db, mock_start = cached_page_client
+    first = client.get("/")
+    second = client.get("/")
+
+    assert first.status_code == 200
+    assert second.data == first.data
+    assert b"TestName" in first.data
+    mock_db.__getitem__.return_value.find.assert_called_once()
+    mock_start.assert_called_once()
+
+
+def test_index_conditional_get(cached_page_client):
+    client, _, _ = cached_page_client
+    first = client.get("/")
+    etag = first.headers["ETag"]
+
+    response = client.get("/", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.data == b""
+
+
+def test_index_gzip(cached_page_client):
+    client, _, _ = cached_page_client
+    response = client.get("/", headers={"Accept-Encoding": "gzip"})
+
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert b"TestName" in gzip.decompress(response.data)
+
+
+def test_index_rerenders_on_new_predictions(cached_page_client):
+    client, mock_db, _ = cached_page_client
+    first = client.get("/")
+    mock_db.__getitem__.return_value.find.return_value.sort.return_value = [
+        {"_id": 2, "name": "NewDisc"}
+    ]
+    frontend.refresh_prediction_snapshot(MongoRepository(mock_db))
+    second = client.get("/")
+
+    assert b"NewDisc" not in first.data
+    assert b"NewDisc" in second.data
+    assert second.headers["ETag"] != first.headers["ETag"]
+
+
+def test_index_page_streams_chunks():
+    snapshot = PredictionSnapshot().extend(
+        [{"_id": i, "name": f"Disc {i}", "url": f"u{i}"} for i in range(50)]
+    )
+    with app.app_context(), patch("services.frontend.frontend.INDEX_CHUNK_SIZE", 1024):
+        page = IndexPage(snapshot, "etag")
+        first, second = page.stream("identity"), page.stream("identity")
+        assert next(first) == next(second)  # rendered once, read by both
+        assert len(page.chunks["identity"]) == 1
+        html = b"".join([page.chunks["identity"][0], *first])
+        compressed = b"".join(page.stream("gzip"))
+
+    assert page.done
+    assert len(page.chunks["identity"]) > 2
+    assert b"Disc 49" in html
+    assert gzip.decompress(compressed) == html
+    assert b"".join(second) == html[len(page.chunks["identity"][0]) :]
+
+
+def test_index_page_fails_every_reader():
+    def pieces():
+        yield "<html>"
+        raise ValueError("template error")
+
+    with app.app_context(), patch("services.frontend.frontend.INDEX_CHUNK_SIZE", 1):
+        page = IndexPage(PredictionSnapshot(), "etag")
+        page.pieces = pieces()
+        first, second = page.stream("identity"), page.stream("identity")
+        assert next(first) == next(second) == b"<html>"
+        with pytest.raises(ValueError):
+            next(first)
+        with pytest.raises(RuntimeError):  # not a page cut short
+            next(second)
+
+    assert not page.done
+
+
+@pytest.fixture
+def search_snapshot():
+    return PredictionSnapshot().extend(
+        [
+            {"_id": 1, "manufacturer": "Innova", "name": "Destroyer"},
+            {"_id": 2, "manufacturer": "Discraft", "name": "Buzzz"},
+            {"_id": 3, "manufacturer": "Innova", "name": "Aviar"},
+        ]
+    )
+
+
+def test_search_prefix(search_snapshot):
+    results = search_snapshot.search("inn", 10)
+    assert [row.name for row in results] == ["Destroyer", "Aviar"]
+
+    results = search_snapshot.search("innova dest", 10)
+    assert [row.name for row in results] == ["Destroyer"]
+
+
+def test_search_fuzzy(search_snapshot):
+    results = search_snapshot.search("destoryer", 10)
+    assert [row.name for row in results] == ["Destroyer"]
+
+
+def test_search_no_match(search_snapshot):
+    assert search_snapshot.search("zzzzqq", 10) == []
+    assert search_snapshot.search("", 10) == []
+
+
+def test_search_index_respects_snapshot_size(search_snapshot):
+    newer = search_snapshot.extend([{"_id": 4, "manufacturer": "MVP", "name": "Atom"}])
+
+    assert newer.search("atom", 10)[0].name == "Atom"
+    assert search_snapshot.search("atom", 10) == []
+
+
+def test_search_index_deduplicates_postings():
+    index = SearchIndex()
+    index.add(0, "Discraft Drive")
+    assert index.prefixes["d"] == [0]
+
+
+def test_search_endpoint(cached_page_client):
+    client, _, _ = cached_page_client
+    response = client.get("/api/search?q=testn")
+
+    assert response.status_code == 200
+    assert response.json["results"][0]["name"] == "TestName"
+
+
+def test_stats_endpoint(client):
+    mock_db = MagicMock()
+    mock_db.__getitem__.return_value.find.return_value = [
+        {
+            "type": "manufacturer",
+            "manufacturer": "Innova",
+            "count": 2,
+            "speed_sum": 19,
+            "glide_sum": 10,
+            "turn_sum": -2,
+            "fade_sum": 4,
+        },
+        {"type": "month", "month": "2024-04", "disc_class": "Putter", "count": 3},
+    ]
+    with patch("services.common.storage.connect_to_mongodb", return_value=mock_db):
+        response = client.get("/api/stats")
+
+    assert response.status_code == 200
+    assert response.json["manufacturers"][0]["average_speed"] == 9.5
+    assert response.json["manufacturers"][0]["average_turn"] == -1
+    assert response.json["months"] == [
+        {"month": "2024-04", "disc_class": "Putter", "count": 3}
+    ]
+
+
+def test_sqlite_repository_predictions(tmp_path):
+    repository = SQLiteRepository(str(tmp_path / "pdga.db"))
+    with repository.transaction() as connection:
+        for url, manufacturer, month, speed in [
+            ("a", "Innova", "2024-04", 12),
+            ("b", "Innova", "2024-04", 7),
+            ("c", "MVP", None, 2),
+        ]:
+            connection.execute(
+                "INSERT INTO predictions (url, manufacturer, approved_month, speed, "
+                "glide, turn, fade, document) VALUES (?, ?, ?, ?, 5, -1, 2, ?)",
+                (url, manufacturer, month, speed, '{"url": "%s", "secret": 1}' % url),
+            )
+        connection.execute(
+            "INSERT INTO manufacturer_rollups VALUES ('Innova', 2, 19, 10, -2, 4)"
+        )
+        connection.execute(
+            "INSERT INTO month_rollups VALUES ('2024-04', 'Distance Driver', 1), "
+            "('2024-04', 'Fairway Driver', 1)"
+        )
+
+    snapshot = sync_predictions(repository, PredictionSnapshot())
+    assert snapshot.last_id == 3
+    assert [row.url for row in snapshot.rows] == ["a", "b", "c"]
+    assert repository.predictions_after(3) == []
+    assert repository.predictions_after(2) == [{"_id": 3, "url": "c"}]
+
+    stats = repository.prediction_stats()
+    assert {
+        "type": "manufacturer",
+        "manufacturer": "Innova",
+        "count": 2,
+        "speed_sum": 19,
+        "glide_sum": 10,
+        "turn_sum": -2,
+        "fade_sum": 4,
+    } in stats
+    months = [rollup for rollup in stats if rollup["type"] == "month"]
+    assert sorted((rollup["disc_class"], rollup["count"]) for rollup in months) == [
+        ("Distance Driver", 1),
+        ("Fairway Driver", 1),
+    ]
+
+
+def test_flight_chart(client, tmp_path):
+    repository = SQLiteRepository(str(tmp_path / "pdga.db"))
+    with repository.transaction() as connection:
+        connection.execute(
+            "INSERT INTO charts VALUES ('abc', '[12, 5, -1, 3]', ?, ?)",
+            (b"<svg></svg>", b"\x89PNG"),
+        )
+
+    with patch("services.frontend.frontend.repository", repository):
+        response = client.get("/charts/abc.svg")
+        assert response.status_code == 200
+        assert response.mimetype == "image/svg+xml"
+        assert response.data == b"<svg></svg>"
+        assert "immutable" in response.headers["Cache-Control"]
+        assert client.get("/charts/abc.png").data == b"\x89PNG"
+        assert client.get("/charts/abc.gif").status_code == 404
+        assert client.get("/charts/missing.svg").status_code == 404
+
+
+def make_usage_log(endpoint, response_code, response_time, time):
+    return {
+        "endpoint": endpoint,
+        "method": "POST",
+        "time": time,
+        "response_code": response_code,
+        "response_message": f"{response_code}",
+        "response_time": response_time,
+    }
+
+
+def test_pipeline_dashboard(client, tmp_path):
+    repository = SQLiteRepository(str(tmp_path / "pdga.db"))
+    now = datetime.now()
+    (scrape, scrape_usage, _), (_, prediction_usage, _), _, _ = frontend.PIPELINE_STAGES
+    repository.insert_usage_logs(
+        scrape_usage, [make_usage_log("/scrape_and_store", 200, 100, now)]
+    )
+    repository.insert_usage_logs(
+        prediction_usage,
+        [
+            make_usage_log("/predict", 200, 100, now - timedelta(minutes=2)),
+            make_usage_log("/jobs/discs_scraped", 500, 300, now - timedelta(minutes=1)),
+            make_usage_log("/admin", 200, 1, now),  # not a run of the stage
+        ],
+    )
+    frontend.pipeline_dashboard.update({"built": 0.0, "dashboard": None})
+
+    with patch("services.frontend.frontend.repository", repository):
+        response = client.get(
+            "/admin/pipeline?format=json", auth=(ADMIN_USERNAME, ADMIN_PASSWORD)
+        )
+        dashboard = get_pipeline_dashboard()
+        repository.insert_usage_logs(
+            scrape_usage, [make_usage_log("/scrape_and_store", 500, 1, now)]
+        )
+        assert get_pipeline_dashboard() is dashboard  # cached
+        html = client.get("/admin/pipeline", auth=(ADMIN_USERNAME, ADMIN_PASSWORD))
+        assert client.get("/admin/pipeline").status_code == 401
+
+    assert response.status_code == 200
+    assert html.status_code == 200 and b"Pipeline Dashboard" in html.data
+    assert dashboard["status"] == "failed"
+    assert dashboard["errors_last_day"] == 1
+    stages = {row["stage"]: row for row in dashboard["stages"]}
+    assert stages[scrape]["status"] == "ok"
+    assert stages["predict"]["status"] == "failed"
+    assert stages["predict"]["last_response_code"] == 500
+    assert stages["predict"]["count"] == 2
+    assert stages["predict"]["average_time"] == 200
+    assert stages["tweet"]["status"] == "unknown"
+    assert [
+        hour["stages"]["predict"]["error_count"]
+        for hour in dashboard["hourly"]
+        if "predict" in hour["stages"]
+    ] in (
+        [1],
+        [1, 0],
+    )  # the logs may fall on both sides of an hour
+    frontend.pipeline_dashboard.update({"built": 0.0, "dashboard": None})
+
+
+def test_export_static_site(tmp_path):
+    snapshot = PredictionSnapshot().extend(
+        [
+            {
+                "_id": 1,
+                "manufacturer": "Innova",
+                "name": "Destroyer",
+                "url": "https://www.pdga.com/discs/destroyer",
+                "SPEED": 12,
+            }
+        ]
+    )
+    frontend.static_site.update({"version": None, "release": None})
+
+    with patch("services.frontend.frontend.STATIC_EXPORT_PATH", str(tmp_path)), patch(
+        "services.frontend.frontend.STATIC_RELEASES_KEPT", 1
+    ):
+        first = export_static_site(snapshot)
+        assert export_static_site(snapshot) is None  # already exported
+        second = export_static_site(
+            snapshot.extend([{"_id": 2, "name": "Roc", "url": "https://x/roc"}])
+        )
+
+    current = tmp_path / "current"
+    assert current.is_symlink()
+    assert os.path.realpath(current) == os.path.realpath(second)
+    assert not os.path.exists(first)  # pruned
+    index = (current / "index.html").read_text()
+    (data_file,) = [name for name in os.listdir(current) if name.endswith(".json")]
+    assert data_file in index
+    data = json.loads(gzip.decompress((current / f"{data_file}.gz").read_bytes()))
+    assert [disc["name"] for disc in data] == ["Destroyer", "Roc"]
+    pages = sorted(os.listdir(current / "discs"))
+    assert pages[0].startswith("destroyer.") and f"discs/{pages[0]}" in index
+    assert "Destroyer" in (current / "discs" / pages[0]).read_text()
+    frontend.static_site.update({"version": None, "release": None})
+
+
+def test_index_logged_once_streamed(cached_page_client):
+    client, _, _ = cached_page_client
+    with patch("services.frontend.frontend.INDEX_CHUNK_SIZE", 16), patch(
+        "services.frontend.frontend.write_usage_log"
+    ) as mock_log:
+        response = client.get("/")
+        assert response.is_streamed
+        mock_log.assert_not_called()
+        count = frontend.summarize_request_metrics().get("/", {}).get("count", 0)
+
+        assert b"TestName" in response.data
+        response.close()
+
+    mock_log.assert_called_once()
+    assert frontend.summarize_request_metrics()["/"]["count"] == count + 1
@@ -1,23 +1,62 @@
-import configparser
+import json
+import joblib
+import numpy as np
+import os
+import pandas as pd
+import pymongo
 import pytest
+import time
+import tracemalloc
+from datetime import datetime, timedelta
 from unittest.mock import patch, MagicMock
 
 from services.prediction.prediction import (
+    AGGREGATE_COLLECTION,
     app,
     authenticate,
     check_auth,
+    build_aggregate_updates,
+    catch_up_snapshot,
     clean_data,
     connect_to_mongodb,
+    disc_class,
+    disc_features,
+    EVENT_DISCS_SCRAPED,
+    export_snapshot,
     download_newest_model_from_s3,
+    feature_matrix,
     fetch_data,
+    fetch_model,
+    flight_paths,
+    load_feature_matrix,
     load_model,
+    load_snapshot,
     make_predictions,
+    measure,
+    model_agreement,
+    MODEL_FEATURES,
+    predict_discs,
+    read_snapshot_manifest,
+    PREDICTION_COLLECTION,
+    publish_event,
+    render_flight_charts,
+    run_exclusively,
+    score_candidate,
+    SimilarityIndex,
+    SQLiteRepository,
+    start_tracing_memory,
+    stop_tracing_memory,
+    summarize_model_runs,
+    update_aggregate_rollups,
+    upload_predictions_to_mongodb,
+    warm_model,
 )
+from services.common.auth import ADMIN_PASSWORD, ADMIN_USERNAME
+from services.common.config import config
+from services.common.jobs import process_job, SQLiteJobQueue
+from services.common.locks import check_lock, LockLost
+from services.common.storage import close_mongo_client
 
-config = configparser.ConfigParser()
-config.read("config.ini")
-ADMIN_USERNAME = config["admin"]["username"]
-ADMIN_PASSWORD = config["admin"]["password"]
 API_KEY = config["auth"]["api_key"]
 
 
@@ -29,9 +68,22 @@ def client():
 
 
 def test_connect_to_mongodb():
-    with patch("services.prediction.prediction.pymongo.MongoClient") as mock_client:
+    close_mongo_client()
+    with patch("services.common.storage.pymongo.MongoClient") as mock_client:
+        connect_to_mongodb()
         connect_to_mongodb()
         mock_client.assert_called_once()
+    close_mongo_client()
+
+
+def test_connect_to_mongodb_after_fork():
+    close_mongo_client()
+    with patch("services.common.storage.pymongo.MongoClient") as mock_client:
+        connect_to_mongodb()
+        with patch("services.common.storage.os.getpid", return_value=-1):
+            connect_to_mongodb()
+        assert mock_client.call_count == 2
+    close_mongo_client()
 
 
 def test_verify_api_key_missing(client):
@@ -64,16 +116,40 @@ def test_authenticate():
     assert response[2]["WWW-Authenticate"] == 'Basic realm="Login Required"'
 
 
-def test_download_newest_model_from_s3():
-    with patch("services.prediction.prediction.boto3.client") as mock_s3_client:
+def test_download_newest_model_from_s3(tmp_path):
+    with patch("services.prediction.prediction.boto3.client") as mock_s3_client, patch(
+        "services.prediction.prediction.MODEL_DIR", str(tmp_path)
+    ):
         mock_response = {
             "Contents": [{"Key": "model_1.pkl", "LastModified": "2024-04-23T12:00:00Z"}]
         }
         mock_s3_client.return_value.list_objects_v2.return_value = mock_response
-        download_newest_model_from_s3("test_bucket")
+        mock_s3_client.return_value.download_file.side_effect = (
+            lambda bucket, key, path: open(path, "wb").close()
+        )
+        assert download_newest_model_from_s3("test_bucket") == "model_1.pkl"
         mock_s3_client.return_value.download_file.assert_called_once()
 
 
+@patch("services.prediction.prediction.connect_to_s3")
+def test_fetch_model_keeps_recent_versions(mock_s3, tmp_path):
+    mock_s3.return_value.download_file.side_effect = lambda bucket, key, path: open(
+        path, "wb"
+    ).close()
+    with patch("services.prediction.prediction.MODEL_DIR", str(tmp_path)):
+        first = fetch_model(("model_1.pkl", '"etag1"'))
+        assert fetch_model(("model_1.pkl", '"etag1"')) == first
+        second = fetch_model(("model_1.pkl", '"etag2"'))  # uploaded again
+        os.utime(first, (0, 0))
+        third = fetch_model(("model_2.pkl", '"etag3"'))
+
+    assert len({first, second, third}) == 3
+    assert mock_s3.return_value.download_file.call_count == 3
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        os.path.basename(path) for path in [second, third]
+    )
+
+
 def test_fetch_data():
     mock_db = MagicMock()
     mock_scraper_collection = MagicMock()
@@ -92,7 +168,7 @@ def test_load_model():
     with patch("builtins.open", create=True), patch(
         "services.prediction.prediction.joblib.load"
     ) as mock_load:
-        load_model()
+        load_model("model.pkl")
         mock_load.assert_called_once()
 
 
@@ -110,6 +186,200 @@ def test_make_predictions():
         mock_load_model.return_value = mock_model
         predictions = make_predictions(mock_model, mock_data)
         assert predictions.shape == (1, 11)
+        mock_load_model.assert_not_called()
+
+
+def test_feature_matrix():
+    specs = {
+        "diameter_cm": 21.1,
+        "height_cm": 1.4,
+        "rim_depth_cm": 1.1,
+        "inside_rim_diameter_cm": 16.7,
+        "rim_depth_diameter_ratio_pct": 5.2,
+        "rim_config": 36.5,
+    }
+    discs = [
+        {"diameter": "0cm", "specs": specs},  # the specs win over the text
+        {
+            "diameter": "21.1cm",
+            "height": "1.4cm",
+            "rim_depth": "1.1cm",
+            "inside_rim_diameter": "16.7cm",
+            "rim_depth_diameter_ratio": "5.2%",
+            "rim_config": "36.50",
+        },
+    ]
+
+    X = feature_matrix(discs)
+    assert X.dtype == np.float64
+    assert X.tolist() == [[21.1, 1.4, 1.1, 16.7, 5.2, 36.5]] * 2
+    assert feature_matrix([]).shape == (0, len(MODEL_FEATURES))
+
+
+def test_warm_model():
+    mock_model = MagicMock()
+    warm_model(mock_model)
+    (features,), _ = mock_model.predict.call_args
+    assert list(features.columns) == list(MODEL_FEATURES.values())
+
+
+@patch("services.prediction.prediction.make_predictions")
+@patch("services.prediction.prediction.load_model")
+@patch("services.prediction.prediction.fetch_model")
+@patch("services.prediction.prediction.get_model_version")
+def test_predict_discs_uses_serving_model(
+    mock_get_model_version, mock_fetch_model, mock_load_model, mock_make_predictions
+):
+    mock_model = MagicMock()
+    mock_make_predictions.return_value.to_dict.return_value = [{"SPEED": 9}]
+    mock_get_model_version.return_value = ("model_1.pkl", '"etag1"')
+    with patch("services.prediction.prediction.serving_model", mock_model), patch(
+        "services.prediction.prediction.serving_model_version",
+        ("model_1.pkl", '"etag1"'),
+    ):
+        assert predict_discs([{"url": "a"}]) == [{"SPEED": 9}]
+
+    mock_fetch_model.assert_not_called()
+    mock_load_model.assert_not_called()
+    mock_make_predictions.assert_called_once_with(mock_model, [{"url": "a"}])
+
+
+@patch("services.prediction.prediction.make_predictions")
+@patch("services.prediction.prediction.load_model")
+@patch("services.prediction.prediction.fetch_model")
+@patch("services.prediction.prediction.get_model_version")
+def test_predict_discs_reloads_newer_model(
+    mock_get_model_version, mock_fetch_model, mock_load_model, mock_make_predictions
+):
+    from services.prediction import prediction
+
+    mock_make_predictions.return_value.to_dict.return_value = [{"SPEED": 9}]
+    mock_get_model_version.return_value = ("model_1.pkl", '"etag2"')  # uploaded again
+    with patch.object(prediction, "serving_model", MagicMock()), patch.object(
+        prediction, "serving_model_version", ("model_1.pkl", '"etag1"')
+    ):
+        predict_discs([{"url": "a"}])
+        assert prediction.serving_model is mock_load_model.return_value
+        assert prediction.serving_model_version == ("model_1.pkl", '"etag2"')
+
+    mock_fetch_model.assert_called_once_with(("model_1.pkl", '"etag2"'))
+    mock_make_predictions.assert_called_once_with(
+        mock_load_model.return_value, [{"url": "a"}]
+    )
+
+
+def test_model_agreement():
+    predictions = [
+        {"SPEED": 9, "GLIDE": 5, "TURN": -1, "FADE": 2},
+        {"SPEED": 2, "GLIDE": 3, "TURN": 0, "FADE": 1},
+    ]
+    agreement = model_agreement(predictions, np.array([[9, 5, -1, 2], [3, 3, 0, 1]]))
+    assert agreement["all_flight_numbers"] == 0.5
+    assert agreement["flight_numbers"] == {
+        "SPEED": 0.5,
+        "GLIDE": 1.0,
+        "TURN": 1.0,
+        "FADE": 1.0,
+    }
+    assert agreement["mean_absolute_difference"]["SPEED"] == 0.5
+
+
+@patch("services.prediction.prediction.make_predictions")
+@patch("services.prediction.prediction.joblib.load")
+@patch("services.prediction.prediction.connect_to_s3")
+@patch(
+    "services.prediction.prediction.list_model_versions_in_s3",
+    return_value={"model_2.pkl": '"etag2"', "model_1.pkl": '"etag1"'},
+)
+def test_score_candidate(
+    mock_list_models, mock_s3, mock_load, mock_make_predictions, tmp_path
+):
+    repository = SQLiteRepository(str(tmp_path / "pdga.db"))
+    predictions = [
+        {"url": url, "SPEED": 9, "GLIDE": 5, "TURN": -1, "FADE": 2} for url in "ab"
+    ]
+    mock_make_predictions.return_value = pd.DataFrame(
+        [[9, 5, -1, 2], [9, 4, -1, 2]], columns=["SPEED", "GLIDE", "TURN", "FADE"]
+    )
+    mock_s3.return_value.download_file.side_effect = lambda bucket, key, path: open(
+        path, "wb"
+    ).close()
+    active = {"model": "model_1.pkl", "inference_seconds": 0.5}
+
+    with patch("services.prediction.prediction.repository", repository), patch(
+        "services.prediction.prediction.MODEL_DIR", str(tmp_path / "models")
+    ), patch("services.prediction.prediction.SHADOW_MODE", True):
+        assert score_candidate([{}, {}], predictions, active) == "model_2.pkl"
+        assert score_candidate([{}, {}], predictions, active) == "model_2.pkl"
+        assert score_candidate([{}, {}], predictions, {"model": "model_2.pkl"}) is None
+
+    mock_s3.return_value.download_file.assert_called_once()  # kept for the next batch
+    (run, _) = repository.model_runs()
+    assert run["discs"] == 2
+    assert run["candidate"]["model"] == "model_2.pkl"
+    assert run["candidate"]["inference_memory_bytes"] >= 0
+    assert run["agreement"]["all_flight_numbers"] == 0.5
+    rows = repository.connection().execute("SELECT * FROM shadow_predictions")
+    assert [(row["model"], row["url"]) for row in rows] == [
+        ("model_2.pkl", "a"),
+        ("model_2.pkl", "b"),
+    ]
+
+    (summary,) = summarize_model_runs(repository.model_runs())
+    assert summary["model"] == "model_2.pkl"
+    assert summary["batches"] == 2
+    assert summary["discs"] == 4
+    assert summary["active_models"] == ["model_1.pkl"]
+    assert summary["active"]["inference_seconds_per_disc"] == 0.25
+    assert summary["active"]["peak_memory_bytes"] is None  # only the candidate's
+    assert summary["candidate"]["peak_memory_bytes"] >= 0
+    assert summary["agreement"]["flight_numbers"]["GLIDE"] == 0.5
+
+
+def test_measure_leaves_tracing_it_did_not_start():
+    stats = {}
+    start_tracing_memory()  # e.g. a memory profile
+    try:
+        with measure(stats, "inference", memory=True):
+            data = [0] * 100_000
+        assert tracemalloc.is_tracing()
+    finally:
+        stop_tracing_memory()
+
+    assert not tracemalloc.is_tracing()
+    assert stats["inference_memory_bytes"] >= len(data) * 8
+    with measure(stats, "load"):
+        pass
+    assert "load_memory_bytes" not in stats
+
+
+@patch(
+    "services.prediction.prediction.list_models_in_s3",
+    return_value=["model_2.pkl", "model_1.pkl"],
+)
+def test_promote_model(mock_list_models, client, tmp_path):
+    repository = SQLiteRepository(str(tmp_path / "pdga.db"))
+    headers = {"X-API-KEY": API_KEY}
+
+    with patch("services.prediction.prediction.repository", repository):
+        response = client.post("/promote_model", headers=headers)
+        assert response.status_code == 400  # nothing has been scored
+        repository.insert_model_run(
+            {"time": datetime.now(), "candidate": {"model": "model_2.pkl"}}
+        )
+        response = client.post("/promote_model", headers=headers)
+        assert response.json["model"] == "model_2.pkl"
+        assert repository.active_model()["key"] == "model_2.pkl"
+
+        response = client.post(
+            "/promote_model", headers=headers, json={"model": "model_1.pkl"}
+        )
+        assert response.status_code == 200
+        assert repository.active_model()["key"] == "model_1.pkl"  # rolled back
+        response = client.post(
+            "/promote_model", headers=headers, json={"model": "unknown.pkl"}
+        )
+        assert response.status_code == 400
 
 
 def test_clean_data():
@@ -136,4 +406,554 @@ def test_clean_data():
     assert cleaned_data["flexibility"] == "Flex"
 
 
+def test_clean_data_from_specs():
+    input_dict = {
+        "diameter": "21.2cm",
+        "rim_config": "36.50",
+        "approved_date": "Apr 23, 2024",
+        "specs": {
+            "approved_date": datetime(2024, 4, 23),
+            "diameter_cm": 21.2,
+            "rim_config": 36.5,
+        },
+    }
+
+    cleaned_data = clean_data(input_dict)
+
+    assert cleaned_data["diameter"] == 21.2
+    assert cleaned_data["rim_config"] == 36.5
+    assert cleaned_data["approved_date"] == datetime(2024, 4, 23)
+
+
+def make_disc(url, diameter, speed):
+    return {
+        "url": url,
+        "manufacturer": "TestManufacturer",
+        "name": url,
+        "diameter": diameter,
+        "height": 1.5,
+        "rim_depth": 1.2,
+        "inside_rim_diameter": 18.0,
+        "rim_depth_diameter_ratio": 5.6,
+        "rim_config": "45.5",
+        "SPEED": speed,
+        "GLIDE": 5,
+        "TURN": -1,
+        "FADE": 2,
+    }
+
+
+def test_disc_features():
+    assert disc_features(make_disc("a", "21.2cm", 7))[:2] == [21.2, 1.5]
+    assert disc_features({"diameter": 21.2}) is None
+
+
+def test_similarity_index_query():
+    index = SimilarityIndex()
+    index.add([make_disc(str(i), 20.0 + i / 10, i % 14 + 1) for i in range(50)])
+
+    distances, positions = index.query(
+        np.array([disc_features(make_disc("q", 21.0, 11))]), 3
+    )
+    assert positions.shape == (1, 3)
+    assert index.discs[positions[0][0]]["url"] == "10"
+    assert np.all(np.diff(distances[0]) >= 0)
+
+
+def test_similarity_index_incremental():
+    index = SimilarityIndex()
+    index.add([make_disc(str(i), 20.0 + i / 10, 7) for i in range(50)])
+    tree = index.tree
+
+    assert index.add([make_disc("new", 30.0, 14), make_disc("0", 20.0, 7)]) == 1
+    assert index.tree is tree
+    distances, positions = index.query(
+        np.array([disc_features(make_disc("q", 30.0, 14))]), 1
+    )
+    assert index.discs[positions[0][0]]["url"] == "new"
+
+    index.add([make_disc(f"more{i}", 25.0, 9) for i in range(10)])
+    assert index.tree is not tree
+    assert index.indexed == len(index)
+
+
+def test_similarity_index_save_load(tmp_path):
+    index = SimilarityIndex()
+    index.add([make_disc(str(i), 20.0 + i / 10, i % 14 + 1) for i in range(20)])
+    copy = index.copy()
+    copy.add([make_disc("new", 30.0, 14)])
+    assert len(index) == 20  # the copy is added to, not the index being queried
+
+    path = str(tmp_path / "similarity_index.pkl")
+    copy.save(path)
+    assert isinstance(joblib.load(path), dict)  # no pickled classes
+    loaded = SimilarityIndex.load(path)
+    assert len(loaded) == 21
+    assert loaded.positions["new"] == 20
+    query = np.array([disc_features(make_disc("q", 30.0, 14))])
+    assert loaded.query(query, 1)[1][0][0] == copy.query(query, 1)[1][0][0]
+
+
+def test_similar_unknown_disc(client):
+    index = SimilarityIndex()
+    index.add([make_disc("a", 21.0, 7)])
+    with patch("services.prediction.prediction.connect_to_mongodb"), patch(
+        "services.prediction.prediction.get_similarity_index", return_value=index
+    ):
+        response = client.post(
+            "/similar", headers={"X-API-KEY": API_KEY}, json={"urls": ["missing"]}
+        )
+        assert response.status_code == 400
+
+
+def test_similar_invalid_k(client):
+    with patch("services.prediction.prediction.connect_to_mongodb"), patch(
+        "services.prediction.prediction.get_similarity_index"
+    ) as get_index:
+        for k in ["x", 2.5, True]:
+            response = client.post(
+                "/similar", headers={"X-API-KEY": API_KEY}, json={"urls": [], "k": k}
+            )
+            assert response.status_code == 400
+        get_index.assert_not_called()
+
+
+def test_similar_excludes_queried_disc(client):
+    index = SimilarityIndex()
+    index.add([make_disc(str(i), 20.0 + i / 10, 7) for i in range(10)])
+    with patch("services.prediction.prediction.connect_to_mongodb"), patch(
+        "services.prediction.prediction.get_similarity_index", return_value=index
+    ):
+        response = client.post(
+            "/similar", headers={"X-API-KEY": API_KEY}, json={"urls": ["5"], "k": 2}
+        )
+        similar = response.json["results"][0]["similar"]
+        assert response.status_code == 200
+        assert {disc["url"] for disc in similar} == {"4", "6"}
+
+
+def test_disc_class():
+    assert disc_class(2) == "Putter"
+    assert disc_class(5) == "Midrange"
+    assert disc_class(7) == "Fairway Driver"
+    assert disc_class(12) == "Distance Driver"
+
+
+def test_build_aggregate_updates():
+    predictions = [
+        {
+            "manufacturer": "Innova",
+            "approved_date": datetime(2024, 4, 23),
+            "SPEED": speed,
+            "GLIDE": 5,
+            "TURN": -1,
+            "FADE": 2,
+        }
+        for speed in [12, 13]
+    ]
+    updates = build_aggregate_updates(predictions)
+
+    assert len(updates) == 2
+    manufacturer, month = (update._doc["$inc"] for update in updates)
+    assert manufacturer["count"] == 2
+    assert manufacturer["speed_sum"] == 25
+    assert month == {"count": 2}
+    assert updates[1]._filter == {
+        "type": "month",
+        "month": "2024-04",
+        "disc_class": "Distance Driver",
+    }
+
+
+def test_update_aggregate_rollups_repairs_missed_batch():
+    import mongomock
+
+    db = mongomock.MongoClient().db
+
+    def store(speeds):
+        predictions = [
+            {"url": str(speed), "manufacturer": "Innova", "SPEED": speed}
+            for speed in speeds
+        ]
+        for prediction in predictions:
+            prediction.update(GLIDE=5, TURN=-1, FADE=2)
+        db[PREDICTION_COLLECTION].insert_many([dict(p) for p in predictions])
+        return predictions
+
+    update_aggregate_rollups(db, store([7, 9]))
+    store([12])  # folding this batch in failed
+    update_aggregate_rollups(db, store([2]))
+    update_aggregate_rollups(db, [])  # folding in nothing is safe to repeat
+
+    (rollup,) = db[AGGREGATE_COLLECTION].find({"type": "manufacturer"})
+    assert rollup["count"] == 4
+    assert rollup["speed_sum"] == 30
+
+
+def test_update_aggregate_rollups_does_not_scan():
+    collection = MagicMock()
+    collection.find.return_value = [{"count": 2}]
+    collection.estimated_document_count.return_value = 3
+    db = MagicMock(__getitem__=MagicMock(return_value=collection))
+    prediction = {"manufacturer": "Innova", "SPEED": 9, "GLIDE": 5, "TURN": -1}
+
+    update_aggregate_rollups(db, [dict(prediction, FADE=2)])
+
+    collection.count_documents.assert_not_called()
+    collection.bulk_write.assert_called_once()
+
+
 # Note: You can add more tests for other functions and endpoints in a similar fashion.
+
+
+@pytest.fixture
+def job_queue(tmp_path):
+    return SQLiteJobQueue(str(tmp_path / "jobs.db"))
+
+
+def test_job_queue_dedup(job_queue):
+    assert job_queue.publish(EVENT_DISCS_SCRAPED, {"urls": ["a"]}, "key", {})
+    assert not job_queue.publish(EVENT_DISCS_SCRAPED, {"urls": ["a"]}, "key", {})
+
+    job = job_queue.claim(EVENT_DISCS_SCRAPED)
+    assert job["payload"] == {"urls": ["a"]}
+    assert job["attempts"] == 1
+    assert job_queue.claim(EVENT_DISCS_SCRAPED) is None
+
+    job_queue.ack(job)
+    assert job_queue.counts() == {EVENT_DISCS_SCRAPED: {"done": 1}}
+    assert not job_queue.publish(EVENT_DISCS_SCRAPED, {"urls": ["a"]}, "key", {})
+
+
+def test_job_queue_redelivers_expired_lease(job_queue):
+    job_queue.publish(EVENT_DISCS_SCRAPED, {"urls": ["a"]}, "key", {})
+    with patch("services.common.jobs.JOB_VISIBILITY_TIMEOUT", timedelta(seconds=-1)):
+        first = job_queue.claim(EVENT_DISCS_SCRAPED)
+    second = job_queue.claim(EVENT_DISCS_SCRAPED)
+
+    assert second["id"] == first["id"]
+    assert second["attempts"] == 2
+
+    job_queue.ack(first)  # the first lease is no longer valid
+    assert job_queue.counts() == {EVENT_DISCS_SCRAPED: {"pending": 1}}
+
+
+def test_job_queue_retries_then_gives_up(job_queue):
+    job_queue.publish(EVENT_DISCS_SCRAPED, {"urls": ["a"]}, "key", {})
+    with patch("services.common.jobs.JOB_RETRY_DELAY", 0), patch(
+        "services.common.jobs.JOB_MAX_ATTEMPTS", 2
+    ):
+        job_queue.fail(job_queue.claim(EVENT_DISCS_SCRAPED), "error")
+        job = job_queue.claim(EVENT_DISCS_SCRAPED)
+        assert job["attempts"] == 2
+        job_queue.fail(job, "error")
+
+    assert job_queue.claim(EVENT_DISCS_SCRAPED) is None
+    assert job_queue.counts() == {EVENT_DISCS_SCRAPED: {"dead": 1}}
+
+
+def test_publish_event(job_queue):
+    with patch("services.common.jobs.get_job_queue", return_value=job_queue):
+        assert publish_event(EVENT_DISCS_SCRAPED, {"urls": ["a", "b"]})
+        assert not publish_event(EVENT_DISCS_SCRAPED, {"urls": ["a", "b"]})
+        assert publish_event(EVENT_DISCS_SCRAPED, {"urls": ["c"]})
+        with pytest.raises(ValueError):
+            publish_event("unknown", {"urls": []})
+        with pytest.raises(ValueError):
+            publish_event(EVENT_DISCS_SCRAPED, {})
+
+
+@patch("services.common.jobs.write_usage_log")
+@patch("services.common.jobs.write_trace")
+@patch("services.common.jobs.get_repository")
+def test_process_job(
+    mock_repository, mock_write_trace, mock_write_usage_log, job_queue
+):
+    job_queue.publish(EVENT_DISCS_SCRAPED, {"urls": ["a"]}, "a", {})
+    job_queue.publish(EVENT_DISCS_SCRAPED, {"urls": ["b"]}, "b", {})
+
+    for handler in [lambda payload: "ok", MagicMock(side_effect=Exception("error"))]:
+        job = job_queue.claim(EVENT_DISCS_SCRAPED)
+        process_job(job_queue, job, handler, "pdga-prediction", "prediction_usage")
+
+    handler.assert_called_once_with({"urls": ["b"]})
+    assert job_queue.counts() == {EVENT_DISCS_SCRAPED: {"done": 1, "pending": 1}}
+    statuses = [call.args[4] for call in mock_write_usage_log.call_args_list]
+    assert statuses == [200, 500]
+
+
+@patch("services.common.locks.release_lock", side_effect=[True, False])
+@patch("services.common.locks.acquire_lock", return_value=True)
+def test_run_exclusively_runs_follow_up(mock_acquire, mock_release):
+    func = MagicMock(side_effect=["first", "follow-up"])
+    assert run_exclusively("predict", func) == "follow-up"
+    assert func.call_count == 2
+
+
+@patch("services.common.locks.get_repository")
+@patch("services.common.locks.release_lock", side_effect=[True, False])
+@patch("services.common.locks.acquire_lock", return_value=True)
+def test_run_exclusively_runs_follow_up_after_failure(
+    mock_acquire, mock_release, mock_repository
+):
+    func = MagicMock(side_effect=[Exception("error"), "follow-up"])
+    assert run_exclusively("predict", func) == "follow-up"
+    assert func.call_count == 2
+    mock_repository.return_value.drop_lock.assert_not_called()
+
+
+@patch("services.common.locks.get_repository")
+@patch("services.common.locks.release_lock", return_value=False)
+@patch("services.common.locks.acquire_lock", return_value=True)
+def test_run_exclusively_raises_without_follow_up(
+    mock_acquire, mock_release, mock_repository
+):
+    func = MagicMock(side_effect=Exception("error"))
+    with pytest.raises(Exception):
+        run_exclusively("predict", func)
+    assert func.call_count == 1
+
+
+@patch("services.common.locks.request_follow_up", return_value=True)
+@patch("services.common.locks.acquire_lock", return_value=False)
+def test_run_exclusively_coalesces(mock_acquire, mock_request_follow_up):
+    func = MagicMock()
+    assert run_exclusively("predict", func) is None
+    func.assert_not_called()
+
+
+@patch("services.common.locks.get_repository")
+@patch("services.common.locks.LOCK_LEASE", timedelta(seconds=0.03))
+@patch("services.common.locks.renew_lock", return_value=False)
+@patch("services.common.locks.release_lock", return_value=True)
+@patch("services.common.locks.acquire_lock", return_value=True)
+def test_run_exclusively_stops_once_lock_is_lost(
+    mock_acquire, mock_release, mock_renew, mock_repository
+):
+    def func():
+        check_lock()  # still held
+        time.sleep(0.2)
+        check_lock()
+
+    with pytest.raises(LockLost):
+        run_exclusively("predict", func)
+    mock_release.assert_not_called()  # nor is a follow-up run
+    check_lock()  # outside a run
+
+
+@patch("services.prediction.prediction.connect_to_mongodb")
+def test_upload_predictions_skips_duplicates(mock_connect):
+    mock_collection = mock_connect.return_value.__getitem__.return_value
+    mock_collection.insert_many.side_effect = pymongo.errors.BulkWriteError(
+        {"writeErrors": [{"index": 0, "code": 11000, "errmsg": "duplicate key"}]}
+    )
+    predictions = [{"url": "a"}, {"url": "b"}]
+
+    assert upload_predictions_to_mongodb(predictions, "predictions") == [{"url": "b"}]
+    mock_collection.create_index.assert_called_once_with("url", unique=True)
+    mock_collection.insert_many.assert_called_once_with(predictions, ordered=False)
+
+
+def make_scraped_disc(url, approved_date, diameter):
+    return {
+        "url": url,
+        "manufacturer": "TestManufacturer",
+        "name": url,
+        "approved_date": approved_date,
+        "diameter": f"{diameter}cm",
+        "height": "1.5cm",
+        "rim_depth": "1.2cm",
+        "inside_rim_diameter": "18.0cm",
+        "rim_depth_diameter_ratio": "5.7%",
+        "rim_config": "40.00",
+    }
+
+
+def test_export_snapshot(tmp_path):
+    discs = [
+        make_scraped_disc("a", "Apr 23, 2024", 21.1),
+        make_scraped_disc("b", "May 01, 2024", 21.2),
+    ]
+    predictions = [
+        dict(clean_data(dict(disc)), SPEED=9, GLIDE=5, TURN=-1, FADE=2)
+        for disc in discs
+    ]
+
+    with patch("services.prediction.prediction.SNAPSHOT_PATH", str(tmp_path)):
+        assert export_snapshot(discs, predictions) == 4
+        X, urls, sequence = load_feature_matrix()
+        assert export_snapshot([make_scraped_disc("c", "Apr 30, 2024", 21.3)], []) == 1
+        discs_table, _ = load_snapshot("discs", since=sequence)
+
+    assert (tmp_path / "predictions" / "approved_month=2024-04").is_dir()
+    assert urls == ["a", "b"]
+    assert X.tolist() == [
+        [21.1, 1.5, 1.2, 18.0, 5.7, 40.0],
+        [21.2, 1.5, 1.2, 18.0, 5.7, 40.0],
+    ]
+    assert sequence == 4
+    assert discs_table.column("url").to_pylist() == ["c"]
+    assert discs_table.column("approved_date").to_pylist() == [datetime(2024, 4, 30)]
+
+
+def test_catch_up_snapshot(tmp_path):
+    discs = [
+        make_scraped_disc(url, "Apr 23, 2024", 21.1 + i / 10)
+        for i, url in enumerate("abc")
+    ]
+    predictions = [
+        dict(clean_data(dict(disc)), SPEED=9, GLIDE=5, TURN=-1, FADE=2)
+        for disc in discs
+    ]
+    repository = SQLiteRepository(str(tmp_path / "pdga.db"))
+    with repository.transaction() as connection:
+        for disc in discs:
+            connection.execute(
+                "INSERT INTO discs (url, created_at, document) VALUES (?, 0, ?)",
+                (disc["url"], json.dumps(disc)),
+            )
+    snapshot_path = str(tmp_path / "snapshots")
+
+    with patch("services.prediction.prediction.SNAPSHOT_PATH", snapshot_path):
+        repository.insert_predictions(predictions[:1])
+        export_snapshot(discs[:1], predictions[:1])  # before the mark was kept
+        repository.insert_predictions(predictions[1:2])  # the export of b failed
+        repository.insert_predictions(predictions[2:])
+        with patch.object(
+            repository, "discs_with_urls", wraps=repository.discs_with_urls
+        ) as mock_discs:
+            # c, this run's disc, is given; b is read from storage
+            assert catch_up_snapshot(repository, discs[2:]) == 2
+            mock_discs.assert_called_once_with(["b"])
+        assert read_snapshot_manifest()["exported"] == 3
+        with patch.object(repository, "predictions_since") as mock_since:
+            mock_since.return_value = [], 3
+            assert catch_up_snapshot(repository) == 0
+            mock_since.assert_called_once_with(3)  # only what is newer is read
+        discs_table, _ = load_snapshot("discs")
+        predictions_table, _ = load_snapshot("predictions")
+
+    assert sorted(discs_table.column("url").to_pylist()) == ["a", "b", "c"]
+    assert sorted(predictions_table.column("url").to_pylist()) == ["a", "b", "c"]
+
+
+def test_export_snapshot_disabled(tmp_path):
+    with patch("services.prediction.prediction.SNAPSHOT_PATH", ""):
+        assert export_snapshot([make_scraped_disc("a", "Apr 23, 2024", 21.1)], []) == 0
+
+
+def test_sqlite_repository_predictions(tmp_path):
+    repository = SQLiteRepository(str(tmp_path / "pdga.db"))
+    with repository.transaction() as connection:
+        for disc in [
+            make_scraped_disc("a", "Apr 23, 2024", 21.1),
+            make_scraped_disc("b", "May 01, 2024", 21.2),
+        ]:
+            connection.execute(
+                "INSERT INTO discs (url, created_at, document) VALUES (?, 0, ?)",
+                (disc["url"], json.dumps(disc)),
+            )
+    predictions = [
+        dict(clean_data(disc), SPEED=np.int64(9), GLIDE=5, TURN=-1, FADE=2)
+        for disc in repository.unpredicted_discs()
+    ]
+
+    assert repository.insert_predictions(predictions[:1]) == predictions[:1]
+    assert repository.insert_predictions(predictions) == predictions[1:]
+    assert repository.unpredicted_discs() == []
+    rollups = repository.connection().execute("SELECT * FROM manufacturer_rollups")
+    assert [tuple(row) for row in rollups] == [("TestManufacturer", 2, 18, 10, -2, 4)]
+    months = repository.connection().execute("SELECT * FROM month_rollups")
+    assert sorted(tuple(row) for row in months) == [
+        ("2024-04", "Distance Driver", 1),
+        ("2024-05", "Distance Driver", 1),
+    ]
+    assert repository.rebuild_prediction_stats() == 3
+    rollups = repository.connection().execute("SELECT * FROM manufacturer_rollups")
+    assert [tuple(row) for row in rollups] == [("TestManufacturer", 2, 18, 10, -2, 4)]
+    stored = repository.all_predictions(["url", "approved_date", "SPEED", "tweeted"])
+    assert stored[0] == {
+        "url": "a",
+        "approved_date": datetime(2024, 4, 23),
+        "SPEED": 9,
+        "tweeted": False,
+    }
+
+
+def test_flight_paths():
+    paths = flight_paths(np.array([[12, 5, -1, 3], [5, 5, -3, 0]]))
+    assert paths.shape == (2, 100, 2)
+    assert paths[0, -1, 1] > paths[1, -1, 1]  # faster discs fly further
+    assert paths[0, -1, 0] < 0  # overstable discs fade left
+    assert paths[1, -1, 0] > 0  # understable discs turn right
+    assert np.allclose(
+        flight_paths(np.array([12, 5, -1, 3]), "LHBH")[0, :, 0], -paths[0, :, 0]
+    )
+
+
+def test_render_flight_charts(tmp_path):
+    repository = SQLiteRepository(str(tmp_path / "pdga.db"))
+    predictions = [
+        {"url": url, "SPEED": 12, "GLIDE": 5, "TURN": -1, "FADE": 3.0}
+        for url in ["a", "b"]
+    ] + [{"url": "c", "SPEED": 2, "GLIDE": 3, "TURN": 0, "FADE": 1}]
+
+    with patch("services.prediction.prediction.repository", repository):
+        assert render_flight_charts(predictions) == 2  # a and b share a chart
+        assert render_flight_charts([dict(predictions[2])]) == 0  # cached
+
+    assert predictions[0]["chart"] == predictions[1]["chart"]
+    assert predictions[0]["chart"] != predictions[2]["chart"]
+    row = (
+        repository.connection()
+        .execute("SELECT * FROM charts WHERE key = ?", (predictions[0]["chart"],))
+        .fetchone()
+    )
+    assert json.loads(row["flight_numbers"]) == [12, 5, -1, 3]
+    assert row["svg"].startswith(b"<svg") and b"12 | 5 | -1 | 3" in row["svg"]
+    assert row["png"].startswith(b"\x89PNG")
+
+
+def test_sqlite_repository_usage_logs(tmp_path):
+    repository = SQLiteRepository(str(tmp_path / "pdga.db"))
+    now = datetime.now()
+    logs = [
+        {
+            "endpoint": "/predict",
+            "method": "POST",
+            "time": now - timedelta(seconds=seconds),
+            "response_code": code,
+            "response_message": "",
+            "response_time": latency,
+        }
+        for seconds, code, latency in [(2, 200, 10.0), (1, 500, 30.0)]
+    ]
+    repository.insert_usage_logs("usage", logs[:1])
+    repository.insert_usage_logs("usage", logs[1:])
+
+    totals, hourly = repository.usage_summary("usage")
+    assert totals["/predict"]["count"] == 2
+    assert totals["/predict"]["error_count"] == 1
+    assert (totals["/predict"]["min_time"], totals["/predict"]["max_time"]) == (
+        10.0,
+        30.0,
+    )
+    assert sum(bucket["count"] for bucket in hourly) == 2
+    entries, next_before = repository.usage_log_page("usage", now, 1)
+    assert entries[0]["time"] == logs[1]["time"]
+    assert next_before == f"{logs[1]['time'].isoformat()},2"
+
+    # Logs at the same time as the last one of a page and older than a day are paged to
+    older = [
+        dict(logs[1], response_code=201),
+        dict(logs[1], time=now - timedelta(days=3)),
+    ]
+    repository.insert_usage_logs("usage", older)
+    pages, cursor = [], f"{now.isoformat()}"
+    while cursor is not None:
+        before, _, before_id = cursor.partition(",")
+        entries, cursor = repository.usage_log_page(
+            "usage", datetime.fromisoformat(before), 1, before_id or None
+        )
+        pages.extend(entry["response_code"] for entry in entries)
+    assert pages == [201, 500, 200, 500]
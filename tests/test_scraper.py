@@ -1,18 +1,51 @@
-import configparser
 import pytest
-from unittest.mock import patch
+from datetime import datetime, timedelta
+from unittest.mock import patch, MagicMock
 
 from services.scraper.scraper import (
     app,
+    backfill_disc_specs,
+    build_disc_specs,
     capitalize_words_after_last_slash,
     check_auth,
-    connect_to_mongodb,
+    MongoRepository,
+    parse_disc_page,
+    parse_measurement,
+    PUBLISH_ATTEMPTS,
+    SQLiteRepository,
+    store_new_discs,
+    unpublished_urls,
+)
+from services.common.auth import ADMIN_PASSWORD, ADMIN_USERNAME
+from services.common.config import config
+from services.common.storage import close_mongo_client, connect_to_mongodb
+from services.common.tracing import (
+    build_waterfall,
+    current_trace,
+    span,
+    Trace,
+    trace_headers,
+)
+from services.common.usage import (
+    build_usage_rollups,
+    get_usage_log_page,
+    parse_log_cursor,
 )
 
-config = configparser.ConfigParser()
-config.read("config.ini")
-ADMIN_USERNAME = config["admin"]["username"]
-ADMIN_PASSWORD = config["admin"]["password"]
+DISC_PAGE = b"""
+<div class="views-field-field-equipment-manuf-ref"><span>Innova Champion Discs</span></div>
+<span class="date-display-single">Apr 23, 2024</span>
+<div class="views-field-field-disc-max-weight"><span class="field-content">175.0gr</span></div>
+<div class="views-field-field-disc-outside-diameter"><span class="field-content">21.1cm</span></div>
+<div class="views-field-field-disc-height"><span class="field-content">1.4cm</span></div>
+<div class="views-field-field-disc-rim-depth"><span class="field-content">1.1cm</span></div>
+<div class="views-field-field-disc-rim-thickness"><span class="field-content">2.2cm</span></div>
+<div class="views-field-field-disc-inside-rim-diameter"><span class="field-content">16.7cm</span></div>
+<div class="views-field-field-disc-depth-diameter-ratio"><span class="field-content">5.2%</span></div>
+<div class="views-field-field-disc-rim-config"><span class="field-content">36.50</span></div>
+<div class="views-field-field-disc-flexibility"><span class="field-content">9.51kg</span></div>
+"""
+
 API_KEY = config["auth"]["api_key"]
 
 
@@ -24,9 +57,22 @@ def client():
 
 
 def test_connect_to_mongodb():
+    close_mongo_client()
     with patch("pymongo.MongoClient") as mock_client:
+        connect_to_mongodb()
         connect_to_mongodb()
         mock_client.assert_called_once()
+    close_mongo_client()
+
+
+def test_connect_to_mongodb_after_fork():
+    close_mongo_client()
+    with patch("pymongo.MongoClient") as mock_client:
+        connect_to_mongodb()
+        with patch("services.common.storage.os.getpid", return_value=-1):
+            connect_to_mongodb()
+        assert mock_client.call_count == 2
+    close_mongo_client()
 
 
 def test_verify_api_key_missing(client):
@@ -55,7 +101,7 @@ def test_admin_unauthorized(client):
 
 def test_scrape_and_store_failure(client):
     with patch(
-        "services.scraper.scraper.connect_to_mongodb"
+        "services.common.storage.connect_to_mongodb"
     ) as mock_connect_to_mongodb, patch(
         "services.scraper.scraper.requests.get"
     ) as mock_requests_get:
@@ -94,7 +140,282 @@ def test_check_auth_invalid_credentials():
     assert check_auth(username, password) == False
 
 
+def test_store_new_discs_retries_publish():
+    repository = MagicMock()
+    repository.insert_discs.return_value = [{"url": "a"}]
+    with patch(
+        "services.scraper.scraper.get_repository", return_value=repository
+    ), patch(
+        "services.scraper.scraper.scrape_discs", return_value=[{"url": "a"}]
+    ) as mock_scrape, patch(
+        "services.scraper.scraper.PUBLISH_RETRY_DELAY", 0
+    ), patch(
+        "services.scraper.scraper.publish_event", side_effect=Exception("queue down")
+    ) as mock_publish:
+        with pytest.raises(RuntimeError):
+            store_new_discs()
+        assert mock_publish.call_count == PUBLISH_ATTEMPTS
+
+        # The stored discs are not new to the next scrape but are queued by it
+        mock_scrape.return_value = []
+        mock_publish.side_effect = None
+        assert "Prediction job queued" in store_new_discs()
+        mock_publish.assert_called_with("discs_scraped", {"urls": ["a"]})
+    assert unpublished_urls == []
+
+
 def test_capitalize_words_after_last_slash():
     url = "https://www.pdga.com/test-disc-name"
     result = capitalize_words_after_last_slash(url)
     assert result == "Test Disc Name"
+
+
+def test_build_usage_rollups():
+    time_of_log = datetime(2024, 4, 23, 12, 30, 15)
+    logs = [
+        {
+            "endpoint": "/scrape_and_store",
+            "time": time_of_log,
+            "response_code": code,
+            "response_time": response_time,
+        }
+        for code, response_time in [(200, 10.0), (500, 30.0)]
+    ]
+    updates = build_usage_rollups(logs)
+
+    assert [update._filter["granularity"] for update in updates] == [
+        "minute",
+        "hour",
+        "total",
+    ]
+    assert updates[0]._filter["bucket"] == datetime(2024, 4, 23, 12, 30)
+    assert updates[1]._filter["bucket"] == datetime(2024, 4, 23, 12)
+    assert updates[2]._doc["$inc"] == {
+        "count": 2,
+        "error_count": 1,
+        "latency_sum": 40.0,
+    }
+    assert updates[2]._doc["$min"] == {"latency_min": 10.0}
+    assert updates[2]._doc["$max"]["latency_max"] == 30.0
+    assert "$set" not in updates[2]._doc
+    assert updates[0]._doc["$set"]["expire_at"] > time_of_log
+
+
+def test_get_usage_log_page():
+    import mongomock
+
+    before = datetime(2024, 4, 23, 12)
+    db = mongomock.MongoClient().db
+    db["usage"].insert_many(
+        [
+            {"time": before - timedelta(minutes=1), "response_code": 200},
+            {"time": before - timedelta(minutes=2), "response_code": 201},
+            {"time": before - timedelta(minutes=2), "response_code": 202},
+            {"time": before - timedelta(days=3), "response_code": 203},
+        ]
+    )
+
+    entries, next_before = get_usage_log_page(db, "usage", before, 2)
+    assert [entry["response_code"] for entry in entries] == [200, 202]
+    assert "_id" not in entries[0]
+    assert next_before.startswith((before - timedelta(minutes=2)).isoformat() + ",")
+
+    # The log at the same time as the last one and the one days older are not skipped
+    next_time, next_id = parse_log_cursor(next_before)
+    entries, next_before = get_usage_log_page(db, "usage", next_time, 3, next_id)
+    assert [entry["response_code"] for entry in entries] == [201, 203]
+    assert next_before is None
+
+
+def test_admin_authorized(client):
+    totals = [
+        {
+            "endpoint": "/scrape_and_store",
+            "count": 2,
+            "error_count": 1,
+            "latency_sum": 40.0,
+            "latency_min": 10.0,
+            "latency_max": 30.0,
+            "last_run": datetime(2024, 4, 23, 12),
+        }
+    ]
+    mock_db = MagicMock()
+    mock_find = mock_db.__getitem__.return_value.find
+    mock_find.side_effect = lambda query, *args: (
+        totals if query == {"granularity": "total"} else MagicMock()
+    )
+    with patch("services.common.storage.connect_to_mongodb", return_value=mock_db):
+        response = client.get(
+            "/admin?before=2024-04-23T12:00:00", auth=(ADMIN_USERNAME, ADMIN_PASSWORD)
+        )
+
+    assert response.status_code == 200
+    assert b"/scrape_and_store" in response.data
+
+
+def test_parse_disc_page():
+    url = "https://www.pdga.com/technical-standards/equipment-certification/discs/test-disc"
+    disc = parse_disc_page(DISC_PAGE, url)
+
+    assert disc["name"] == "Test Disc"
+    assert disc["manufacturer"] == "Innova Champion Discs"
+    assert disc["approved_date"] == "Apr 23, 2024"
+    assert disc["diameter"] == "21.1cm"
+    assert disc["flexibility"] == "9.51kg"
+    assert disc["specs"] == {
+        "version": 1,
+        "approved_date": datetime(2024, 4, 23),
+        "max_weight_gr": 175.0,
+        "diameter_cm": 21.1,
+        "height_cm": 1.4,
+        "rim_depth_cm": 1.1,
+        "rim_thickness_cm": 2.2,
+        "inside_rim_diameter_cm": 16.7,
+        "rim_depth_diameter_ratio_pct": 5.2,
+        "rim_config": 36.5,
+        "flexibility_kg": 9.51,
+    }
+
+
+def test_parse_measurement():
+    assert parse_measurement(" 21.1cm ", "cm", 0, 50) == 21.1
+    assert parse_measurement("36.50", "", 0, 100) == 36.5
+    assert parse_measurement("21.1in", "cm", 0, 50) is None
+    assert parse_measurement("nan", "cm", 0, 50) is None
+    assert parse_measurement("211cm", "cm", 0, 50) is None
+
+
+def test_build_disc_specs_invalid():
+    specs = build_disc_specs({"approved_date": "soon", "diameter": "21.1cm"})
+
+    assert specs["approved_date"] is None
+    assert specs["diameter_cm"] == 21.1
+    assert specs["height_cm"] is None
+
+
+def test_backfill_disc_specs():
+    mock_db = MagicMock()
+    mock_collection = mock_db.__getitem__.return_value
+    mock_collection.find.return_value = [
+        {"_id": 1, "url": "a", "approved_date": "Apr 23, 2024", "diameter": "21.1cm"}
+    ]
+
+    assert backfill_disc_specs(MongoRepository(mock_db)) == 1
+    (updates,), _ = mock_collection.bulk_write.call_args
+    assert updates[0]._filter == {"url": "a"}
+    assert updates[0]._doc["$set"]["specs"]["diameter_cm"] == 21.1
+
+
+def test_mongo_repository_skips_stored_discs():
+    import mongomock
+
+    repository = MongoRepository(mongomock.MongoClient().db)
+    assert len(repository.insert_discs([{"url": "a"}])) == 1
+
+    inserted = repository.insert_discs([{"url": "a"}, {"url": "b"}])
+
+    assert [disc["url"] for disc in inserted] == ["b"]
+    assert repository.disc_urls() == {"a", "b"}
+
+
+def test_sqlite_repository_discs(tmp_path):
+    repository = SQLiteRepository(str(tmp_path / "pdga.db"))
+    disc = {"url": "a", "approved_date": "Apr 23, 2024", "diameter": "21.1cm"}
+    assert repository.insert_discs([disc]) == [disc]
+    assert repository.insert_discs([disc, {"url": "b"}]) == [{"url": "b"}]
+    assert repository.disc_urls() == {"a", "b"}
+
+    assert backfill_disc_specs(repository) == 2
+    assert backfill_disc_specs(repository) == 0
+    specs = {disc["url"]: disc["specs"] for disc in repository.discs_missing_specs(0)}
+    assert specs["a"]["diameter_cm"] == 21.1
+    assert specs["a"]["approved_date"] == datetime(2024, 4, 23)
+
+
+def test_sqlite_repository_locks(tmp_path):
+    repository = SQLiteRepository(str(tmp_path / "pdga.db"))
+
+    assert repository.acquire_lock("scrape", "first")
+    assert not repository.acquire_lock("scrape", "second")
+    assert repository.request_follow_up("scrape")
+    assert repository.release_lock("scrape", "first")  # kept for the follow-up
+    assert not repository.release_lock("scrape", "first")
+    assert repository.acquire_lock("scrape", "second")
+    assert not repository.renew_lock("scrape", "first")
+    repository.drop_lock("scrape", "second")
+    assert not repository.request_follow_up("scrape")
+
+
+def test_spans_nest_and_propagate():
+    trace = Trace("pdga-scraper")
+    token = current_trace.set(trace)
+    try:
+        with span("outer") as attributes:
+            attributes["count"] = 1
+            with span("inner"):
+                headers = trace_headers()
+    finally:
+        current_trace.reset(token)
+
+    inner, outer = trace.spans
+    assert inner["parentSpanId"] == outer["spanId"]
+    assert outer["parentSpanId"] is None
+    assert outer["attributes"] == {"count": 1}
+    assert headers == {
+        "X-Trace-Id": trace.trace_id,
+        "X-Parent-Span-Id": inner["spanId"],
+    }
+    assert trace_headers() == {}
+
+
+def test_span_records_errors():
+    trace = Trace("pdga-scraper")
+    token = current_trace.set(trace)
+    with pytest.raises(ValueError):
+        with span("failing"):
+            raise ValueError("boom")
+    current_trace.reset(token)
+
+    assert trace.spans[0]["status"] == {"code": "STATUS_CODE_ERROR", "message": "boom"}
+
+
+def test_build_waterfall():
+    spans = [
+        {
+            "traceId": "t",
+            "spanId": "root",
+            "parentSpanId": None,
+            "name": "scrape_and_store",
+            "service": "pdga-scraper",
+            "status": {"code": "STATUS_CODE_OK"},
+            "startTimeUnixNano": 0,
+            "endTimeUnixNano": 1_000_000_000,
+        },
+        {
+            "traceId": "t",
+            "spanId": "child",
+            "parentSpanId": "root",
+            "name": "fetch_listing",
+            "service": "pdga-scraper",
+            "status": {"code": "STATUS_CODE_OK"},
+            "startTimeUnixNano": 500_000_000,
+            "endTimeUnixNano": 750_000_000,
+        },
+    ]
+    waterfall = build_waterfall(spans)
+
+    assert waterfall["duration"] == 1000.0
+    root, child = waterfall["spans"]
+    assert (root["depth"], root["offset"], root["width"]) == (0, 0.0, 100.0)
+    assert (child["depth"], child["offset"], child["width"]) == (1, 50.0, 25.0)
+
+
+def test_parse_benchmark_disc_page():
+    from benchmarks.pdga_server import render_disc_page
+
+    disc = parse_disc_page(
+        render_disc_page(7), "https://www.pdga.com/discs/bench-disc-7"
+    )
+    assert disc["name"] == "Bench Disc 7"
+    assert disc["diameter"].endswith("cm")
+    assert disc["rim_depth_diameter_ratio"].endswith("%")
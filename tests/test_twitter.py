@@ -1,25 +1,31 @@
-import configparser
 import pytest
+import queue
+import subprocess
+import sys
+import tracemalloc
 from datetime import datetime
 from unittest.mock import patch, MagicMock
 from services.twitter.twitter import (
     app,
     authenticate,
     check_auth,
-    connect_to_mongodb,
+    LazyModule,
+    MongoRepository,
+    post_tweet,
+    pool_metrics,
+    SQLiteRepository,
+    summarize_request_metrics,
+    USAGE_COLLECTION,
     verify_api_key,
     write_usage_log,
 )
+from services.common.auth import ADMIN_PASSWORD, ADMIN_USERNAME
+from services.common.config import config
+from services.common.monitoring import finish_profiling, fold_stack, LatencyHistogram
+from services.common.storage import close_mongo_client, connect_to_mongodb
+from services.common.usage import enqueue_usage_log, flush_usage_logs, usage_log_stats
 
-config = configparser.ConfigParser()
-config.read("config.ini")
-ADMIN_USERNAME = config["admin"]["username"]
-ADMIN_PASSWORD = config["admin"]["password"]
 API_KEY = config["auth"]["api_key"]
-URI = config["mongodb"]["uri"]
-DB_NAME = config["mongodb"]["db_name"]
-PREDICTION_COLLECTION = config["mongodb"]["prediction_collection"]
-USAGE_COLLECTION = config["mongodb"]["twitter_usage"]
 
 
 @pytest.fixture
@@ -41,6 +47,31 @@ def test_check_auth_invalid_credentials():
     assert not check_auth(username, password)
 
 
+def test_connect_to_mongodb():
+    close_mongo_client()
+    with patch("services.common.storage.pymongo.MongoClient") as mock_client:
+        connect_to_mongodb()
+        connect_to_mongodb()
+        mock_client.assert_called_once()
+        assert pool_metrics in mock_client.call_args.kwargs["event_listeners"]
+    close_mongo_client()
+
+
+def test_pool_metrics():
+    pool_metrics.reset()
+    pool_metrics.connection_created(None)
+    pool_metrics.connection_check_out_started(None)
+    pool_metrics.connection_checked_out(None)
+    snapshot = pool_metrics.snapshot()
+    assert snapshot["checked_out"] == 1
+    assert snapshot["open_connections"] == 1
+    assert snapshot["check_outs"] == 1
+
+    pool_metrics.connection_checked_in(None)
+    assert pool_metrics.snapshot()["checked_out"] == 0
+    pool_metrics.reset()
+
+
 def test_verify_api_key_missing(client):
     response = client.post("/create_tweet")
     assert response.status_code == 401
@@ -65,7 +96,7 @@ def test_write_usage_log():
     start_time = datetime.now()
 
     write_usage_log(
-        mock_db,
+        MongoRepository(mock_db),
         USAGE_COLLECTION,
         endpoint,
         method,
@@ -73,8 +104,45 @@ def test_write_usage_log():
         response_message,
         start_time,
     )
+    flush_usage_logs()
+
+    mock_collection.insert_many.assert_called_once()
+    log = mock_collection.insert_many.call_args[0][0][0]
+    assert log["endpoint"] == endpoint
+    assert log["response_code"] == response_code
+
+
+def test_usage_logs_are_batched():
+    mock_db = MagicMock()
+    repository = MongoRepository(mock_db)
+    flush_usage_logs()
+    with patch("services.common.usage.start_usage_log_writer"):
+        for _ in range(3):
+            write_usage_log(
+                repository,
+                USAGE_COLLECTION,
+                "/create_tweet",
+                "POST",
+                200,
+                "",
+                datetime.now(),
+            )
+    flush_usage_logs()
 
-    mock_collection.insert_one.assert_called_once()
+    mock_db.__getitem__.return_value.insert_many.assert_called_once()
+    assert len(mock_db.__getitem__.return_value.insert_many.call_args[0][0]) == 3
+
+
+def test_usage_log_overflow_drops():
+    mock_db = MagicMock()
+    flush_usage_logs()
+    dropped = usage_log_stats["dropped"]
+    with patch("services.common.usage.start_usage_log_writer"), patch(
+        "services.common.usage.usage_log_queue.put_nowait",
+        side_effect=queue.Full,
+    ):
+        enqueue_usage_log(mock_db, USAGE_COLLECTION, {"response_code": 200})
+    assert usage_log_stats["dropped"] == dropped + 1
 
 
 def test_create_tweet(client):
@@ -96,9 +164,239 @@ def test_create_tweet(client):
         }
     ].__iter__()
 
-    with patch("services.twitter.twitter.connect_to_mongodb", return_value=mock_db):
-        with patch("services.twitter.twitter.apiv2.create_tweet") as mock_create_tweet:
+    with patch("services.common.storage.connect_to_mongodb", return_value=mock_db):
+        with patch("services.twitter.twitter.get_twitter_client") as mock_client:
             response = client.post("/create_tweet", headers={"X-API-KEY": API_KEY})
             assert response.status_code == 200
             assert response.json["message"] == "1 tweets created successfully."
-            mock_create_tweet.assert_called_once()
+            mock_client.return_value.create_tweet.assert_called_once()
+
+
+def test_post_tweet_attaches_chart():
+    entry = {
+        "manufacturer": "M",
+        "name": "N",
+        "SPEED": 9,
+        "GLIDE": 5,
+        "TURN": -1,
+        "FADE": 2,
+        "url": "a",
+        "chart": "abc",
+    }
+    repository = MagicMock()
+    repository.chart.return_value = b"\x89PNG"
+
+    with patch("services.twitter.twitter.get_twitter_client") as mock_client, patch(
+        "services.twitter.twitter.get_twitter_api"
+    ) as mock_api:
+        mock_api.return_value.media_upload.return_value.media_id = 7
+        post_tweet(entry, repository)
+        repository.chart.assert_called_once_with("abc", "png")
+        assert mock_client.return_value.create_tweet.call_args.kwargs["media_ids"] == [
+            7
+        ]
+
+        mock_api.return_value.media_upload.side_effect = Exception("error")
+        post_tweet(entry, repository)  # posted without the chart
+        assert "media_ids" not in mock_client.return_value.create_tweet.call_args.kwargs
+
+
+def test_sqlite_repository_tweets_once(client, tmp_path):
+    repository = SQLiteRepository(str(tmp_path / "pdga.db"))
+    with repository.transaction() as connection:
+        for url in ["a", "b"]:
+            connection.execute(
+                "INSERT INTO predictions (url, tweeted, document) VALUES (?, 0, ?)",
+                (
+                    url,
+                    '{"url": "%s", "manufacturer": "M", "name": "N", "SPEED": 9, '
+                    '"GLIDE": 5, "TURN": -1, "FADE": 2, "tweeted": false}' % url,
+                ),
+            )
+
+    with patch("services.twitter.twitter.repository", repository), patch(
+        "services.twitter.twitter.get_twitter_client"
+    ) as mock_client:
+        response = client.post("/create_tweet", headers={"X-API-KEY": API_KEY})
+        assert response.json["message"] == "2 tweets created successfully."
+        response = client.post("/create_tweet", headers={"X-API-KEY": API_KEY})
+        assert response.json["message"] == "0 tweets created successfully."
+        flush_usage_logs()
+
+    assert mock_client.return_value.create_tweet.call_count == 2
+    assert repository.untweeted_predictions() == []
+    totals, _ = repository.usage_summary(USAGE_COLLECTION)
+    assert totals["/create_tweet"]["count"] == 2
+
+
+def test_sqlite_repository_traces(tmp_path):
+    repository = SQLiteRepository(str(tmp_path / "pdga.db"))
+    spans = [
+        {
+            "traceId": trace_id,
+            "spanId": f"{trace_id}-{span_id}",
+            "parentSpanId": None if span_id == "root" else f"{trace_id}-root",
+            "startTimeUnixNano": start,
+        }
+        for trace_id, start in [("old", 1), ("new", 2)]
+        for span_id in ["root", "child"]
+    ]
+    repository.insert_spans(spans)
+
+    assert repository.recent_trace_ids(1) == ["new"]
+    assert [record["spanId"] for record in repository.trace_spans(["old"])] == [
+        "old-root",
+        "old-child",
+    ]
+    assert repository.trace_spans([]) == []
+
+
+def test_latency_histogram_quantiles():
+    histogram = LatencyHistogram()
+    for latency in range(1, 1001):
+        histogram.record(float(latency))
+
+    assert histogram.count == 1000
+    assert 500 <= histogram.quantile(0.5) <= 500 * 1.19
+    assert 990 <= histogram.quantile(0.99) <= 990 * 1.19
+    assert LatencyHistogram().quantile(0.99) == 0.0
+
+
+def test_latency_histogram_merge():
+    first, second = LatencyHistogram(), LatencyHistogram()
+    first.record(1.0)
+    second.record(1000.0)
+    first.merge(second)
+
+    assert first.count == 2
+    assert first.sum == 1001.0
+    assert first.quantile(0.99) >= 1000.0
+
+
+def test_metrics_unauthorized(client):
+    response = client.get("/metrics")
+    assert response.status_code == 401
+
+
+def test_metrics(client):
+    client.post("/create_tweet")
+    response = client.get("/metrics", auth=(ADMIN_USERNAME, ADMIN_PASSWORD))
+
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    assert (
+        b'pdga_request_duration_seconds_bucket{service="pdga-twitter",endpoint="/create_tweet",le="+Inf"}'
+        in response.data
+    )
+    assert summarize_request_metrics()["/create_tweet"]["count"] >= 1
+
+
+def test_fold_stack():
+    import sys
+
+    def inner():
+        return fold_stack(sys._getframe())
+
+    stack = inner()
+    assert stack.endswith(
+        ";inner (test_twitter.py:{})".format(inner.__code__.co_firstlineno)
+    )
+    assert "test_fold_stack (test_twitter.py:" in stack
+
+
+def test_profile_unauthorized(client):
+    response = client.post("/admin/profile", json={"requests": 1})
+    assert response.status_code == 401
+
+
+def test_profile_invalid(client):
+    auth = (ADMIN_USERNAME, ADMIN_PASSWORD)
+    assert client.post("/admin/profile", json={}, auth=auth).status_code == 400
+    assert (
+        client.post(
+            "/admin/profile", json={"requests": 1, "seconds": 1}, auth=auth
+        ).status_code
+        == 400
+    )
+    for options in [
+        {"requests": "x"},
+        {"requests": 0},
+        {"requests": -1},
+        {"requests": 1.5},
+        {"requests": "1.5"},
+        {"requests": True},
+        {"seconds": 0},
+        {"seconds": "nan"},
+    ]:
+        assert client.post("/admin/profile", json=options, auth=auth).status_code == 400
+    assert client.get("/admin/profile", auth=auth).json["running"] is False
+
+
+def test_profile_requests(client):
+    auth = (ADMIN_USERNAME, ADMIN_PASSWORD)
+    response = client.post(
+        "/admin/profile", json={"requests": 2, "memory": True}, auth=auth
+    )
+    assert response.status_code == 202
+    assert (
+        client.post("/admin/profile", json={"seconds": 1}, auth=auth).status_code == 409
+    )
+
+    client.post("/create_tweet")
+    assert client.get("/admin/profile", auth=auth).json["remaining_requests"] == 1
+    client.post("/create_tweet")
+
+    result = client.get("/admin/profile", auth=auth).json
+    assert not result["running"]
+    assert result["requests"] == 2
+    assert "function calls" in result["pstats"]
+    assert isinstance(result["memory"], list)
+
+    folded = client.get("/admin/profile?format=folded", auth=auth)
+    assert folded.mimetype == "text/plain"
+
+
+def test_profile_leaves_tracing_it_did_not_start(client):
+    auth = (ADMIN_USERNAME, ADMIN_PASSWORD)
+    tracemalloc.start()
+    try:
+        client.post("/admin/profile", json={"requests": 1, "memory": True}, auth=auth)
+        client.post("/create_tweet")
+        assert isinstance(client.get("/admin/profile", auth=auth).json["memory"], list)
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+
+
+def test_profile_stopped_early(client):
+    auth = (ADMIN_USERNAME, ADMIN_PASSWORD)
+    client.post("/admin/profile", json={"seconds": 60}, auth=auth)
+    result = client.delete("/admin/profile", auth=auth).json
+
+    assert not result["running"]
+    assert result["requests"] == 0
+    assert result["memory"] is None
+    assert finish_profiling() is not None
+
+
+def test_lazy_module():
+    json_module = LazyModule("json")
+    assert json_module._lazy_module is None
+
+    assert json_module.dumps([1]) == "[1]"
+    assert json_module._lazy_module is sys.modules["json"]
+
+
+def test_heavy_imports_deferred():
+    # A fresh interpreter, since the tests may already have imported them
+    script = (
+        "import sys\n"
+        "import services.prediction.prediction, services.scraper.scraper\n"
+        "import services.twitter.twitter\n"
+        "heavy = ['boto3', 'bs4', 'joblib', 'pandas', 'sklearn', 'tweepy']\n"
+        "print(','.join(module for module in heavy if module in sys.modules))\n"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", script], capture_output=True, text=True, check=True
+    )
+    assert output.stdout.strip() == ""